@@ -3,30 +3,106 @@ import os
 # Добавляем корневую папку проекта в sys.path, чтобы Vercel мог найти модуль bot
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import asyncio
 import logging
 import json
-from fastapi import FastAPI, Request, HTTPException, Header
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, HTTPException, Header, BackgroundTasks
+from fastapi.responses import PlainTextResponse
 from aiogram import Bot, Dispatcher
 from aiogram.types import Update
-from bot.config import TELEGRAM_BOT_TOKEN, WEBHOOK_SECRET
+from bot.config import (
+    TELEGRAM_BOT_TOKEN, WEBHOOK_SECRET, CRON_SECRET,
+    WEBHOOK_ACK_FIRST, UPDATE_DEDUP_TTL, UPDATE_CLAIM_TTL, GENERATION_QUEUE, CHAT_LOCK_ENABLED, REQUEST_BUDGET,
+    WARMUP_ON_STARTUP, LOOP_MONITOR_ENABLED, LOOP_STALL_THRESHOLD,
+    LOOP_STALL_CAPTURE_STACKS, LOOP_MONITOR_ASYNCIO_DEBUG,
+)
+from bot.database import claim_update, finish_update
 from bot.handlers import register_handlers
+from bot.services import telegram_session
+from bot.middlewares import ChatSerializationMiddleware, install_handler_tags
+from bot.counters import aggregator
+from bot import deadline, metrics, redis_usage
 
 # Настраиваем логирование
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+_background_tasks: set[asyncio.Task] = set()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if WARMUP_ON_STARTUP:
+        # In the background: the first update must not wait for the warm-up itself
+        from bot.warmup import warm_up
+        task = asyncio.create_task(warm_up(bot))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    monitor = None
+    if LOOP_MONITOR_ENABLED:
+        from bot.loop_monitor import LoopMonitor
+        monitor = LoopMonitor(LOOP_STALL_THRESHOLD, capture_stacks=LOOP_STALL_CAPTURE_STACKS)
+        monitor.start(asyncio_debug=LOOP_MONITOR_ASYNCIO_DEBUG)
+    yield
+    if monitor:
+        await monitor.stop()
+    await asyncio.to_thread(aggregator.flush, "shutdown")
+    await asyncio.to_thread(metrics.flush_to_redis, True)
+
+
+app = FastAPI(lifespan=lifespan)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
 
 # Инициализируем бота и диспетчер
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
+bot = Bot(token=TELEGRAM_BOT_TOKEN, session=telegram_session())
 dp  = Dispatcher()
 
 # Регистрируем все обработчики сообщений
 register_handlers(dp, bot)
+install_handler_tags(dp)
+if CHAT_LOCK_ENABLED:
+    dp.update.outer_middleware(ChatSerializationMiddleware())
+
+
+def _flush_after_invocation() -> None:
+    """Write buffered counters (always) and metrics (per interval) before the instance may freeze."""
+    aggregator.flush(reason="invocation")
+    metrics.flush_to_redis()
+
+
+async def process_update(update: Update, received_at: float, claimed: bool = False) -> None:
+    """Feed one update to the dispatcher, recording queueing lag and duration.
+
+    A ``claimed`` update (ack-first mode) is marked handled for the full
+    UPDATE_DEDUP_TTL once it has run.
+    """
+    started = time.time()
+    metrics.observe("webhook_lag_seconds", started - received_at)
+    try:
+        # The budget runs from the request's arrival (ack-first mode starts later)
+        with deadline.budget(REQUEST_BUDGET - (started - received_at), "update"), \
+                redis_usage.track("update"):
+            await dp.feed_update(bot=bot, update=update)
+    except Exception as e:
+        metrics.incr("webhook_errors_total")
+        logger.error(f"Error processing update: {e}", exc_info=True)
+    finally:
+        metrics.observe("webhook_processing_seconds", time.time() - started)
+        if claimed:
+            try:
+                await asyncio.to_thread(finish_update, update.update_id, UPDATE_DEDUP_TTL)
+            except Exception as e:
+                logger.warning(f"Could not mark update {update.update_id} handled: {e}")
+        await asyncio.to_thread(_flush_after_invocation)
+
 
 @app.post("/api/webhook")
 async def telegram_webhook(
     request: Request,
+    background_tasks: BackgroundTasks,
     x_telegram_bot_api_secret_token: str = Header(None)
 ):
     # Если секрет задан в настройках, проверяем его наличие в заголовке от Telegram
@@ -34,13 +110,33 @@ async def telegram_webhook(
         logger.warning("Unauthorized webhook access attempt")
         raise HTTPException(status_code=401, detail="Unauthorized")
 
+    received_at = time.time()
+    metrics.incr("webhook_updates_total")
     try:
         update_dict = await request.json()
         update = Update(**update_dict)
-        await dp.feed_update(bot=bot, update=update)
     except Exception as e:
-        logger.error(f"Error processing update: {e}", exc_info=True)
+        logger.error(f"Error parsing update: {e}", exc_info=True)
         # We still return 200 OK to Telegram so it doesn't infinitely retry broken updates
+        return {"status": "ok"}
+
+    if not WEBHOOK_ACK_FIRST:
+        await process_update(update, received_at)
+        return {"status": "ok"}
+
+    # Ack-first mode: drop redeliveries, answer 200 now and run handlers after the response.
+    # The claim only covers processing, so an update lost with a frozen instance
+    # can still be redelivered.
+    try:
+        is_new = claim_update(update.update_id, UPDATE_CLAIM_TTL)
+    except Exception as e:
+        logger.warning(f"Update dedup unavailable, processing anyway: {e}")
+        is_new = True
+    if not is_new:
+        metrics.incr("webhook_duplicates_total")
+        logger.info(f"WEBHOOK: duplicate update_id={update.update_id} ignored")
+        return {"status": "ok"}
+    background_tasks.add_task(process_update, update, received_at, is_new)
     return {"status": "ok"}
 
 
@@ -63,6 +159,7 @@ async def kie_callback(request: Request):
         "msg": "..."
     }
     """
+    received_at = time.time()
     try:
         payload = await request.json()
         logger.info(f"KIE CALLBACK: received payload code={payload.get('code')}")
@@ -87,16 +184,33 @@ async def kie_callback(request: Request):
             result_json = result_json_str if isinstance(result_json_str, dict) else {}
         
         fail_msg = data.get("failMsg")
+
+        if GENERATION_QUEUE:
+            from bot.jobs import enqueue_job
+            enqueue_job("complete", {
+                "task_id": task_id,
+                "state": state,
+                "result_json": result_json,
+                "fail_msg": fail_msg,
+                "received_at": received_at,
+            })
+            return {"status": "ok", "message": "Callback queued"}
         
         # Process callback asynchronously
         from bot.services import process_kie_callback
-        success = await process_kie_callback(
-            task_id=task_id,
-            state=state,
-            result_json=result_json,
-            fail_msg=fail_msg,
-            bot=bot,
-        )
+        try:
+            with deadline.budget(REQUEST_BUDGET - (time.time() - received_at), "kie_callback"), \
+                    redis_usage.track("process_kie_callback"):
+                success = await process_kie_callback(
+                    task_id=task_id,
+                    state=state,
+                    result_json=result_json,
+                    fail_msg=fail_msg,
+                    bot=bot,
+                    received_at=received_at,
+                )
+        finally:
+            await asyncio.to_thread(_flush_after_invocation)
         
         if success:
             return {"status": "ok", "message": "Callback processed successfully"}
@@ -109,6 +223,74 @@ async def kie_callback(request: Request):
         return {"status": "error", "message": str(e)}
 
 
+def _require_service_token(authorization: str | None) -> None:
+    """Service routes (cron, warm-up, metrics) require `Authorization: Bearer <CRON_SECRET>`."""
+    if not CRON_SECRET or authorization != f"Bearer {CRON_SECRET}":
+        logger.warning("Unauthorized service route access attempt")
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+
+@app.get("/api/cron/broadcast")
+async def cron_broadcast(authorization: str = Header(None)):
+    """Continue the current broadcast job for one time budget, if it is unfinished."""
+    _require_service_token(authorization)
+    from bot.broadcast import run_broadcast
+    from bot.database import get_current_broadcast
+
+    job = get_current_broadcast()
+    if not job or job["status"] != "running":
+        return {"status": "idle"}
+    job = await run_broadcast(bot, job["id"])
+    return {
+        "status": job["status"],
+        "job_id": job["id"],
+        "sent": job["sent"],
+        "failed": job["failed"],
+        "blocked": job["blocked"],
+        "rate": round(job["last_rate"], 1),
+    }
+
+
+@app.get("/api/cron/scheduled")
+async def cron_scheduled(authorization: str = Header(None)):
+    """Send the scheduled postcards that are due, for one time budget."""
+    _require_service_token(authorization)
+    from bot.database import count_scheduled_postcards
+    from bot.scheduled import deliver_due
+
+    counts = await deliver_due(bot)
+    if counts is None:
+        return {"status": "busy"}
+    await asyncio.to_thread(_flush_after_invocation)
+    return {"status": "ok", **counts, "scheduled": count_scheduled_postcards()}
+
+
+@app.get("/api/warmup")
+async def warmup(authorization: str = Header(None)):
+    """Keep-warm ping: run the warm-up routine and report per-phase durations."""
+    _require_service_token(authorization)
+    from bot.warmup import warm_up
+    return await warm_up(bot)
+
+
+@app.get("/api/metrics")
+async def metrics_endpoint(scope: str = "cluster", authorization: str = Header(None)):
+    """Prometheus scrape target.
+
+    ``scope=cluster`` (default) flushes this instance's deltas and returns
+    the histograms aggregated in Redis across all instances;
+    ``scope=local`` returns only this process's values.
+    """
+    _require_service_token(authorization)
+    if scope == "local":
+        return PlainTextResponse(metrics.render_prometheus(), media_type=PROMETHEUS_CONTENT_TYPE)
+    await asyncio.to_thread(metrics.flush_to_redis, True)
+    counters, histograms = await asyncio.to_thread(metrics.load_from_redis)
+    return PlainTextResponse(
+        metrics.render_prometheus(counters, histograms), media_type=PROMETHEUS_CONTENT_TYPE,
+    )
+
+
 @app.get("/")
 def root():
     return {"message": "Pozdravish Bot is running and secure"}
@@ -0,0 +1,85 @@
+"""Binary blobs kept next to the regular keys (Kie backgrounds for re-renders).
+
+Values in the key-value store are strings, so blobs are stored base64
+encoded with a TTL and a per-blob size cap on the encoded value (a third
+larger than the bytes): a background over the cap is re-encoded as JPEG
+first and dropped if it still doesn't fit.  A
+byte-capped LRU in front of it keeps recent blobs in process memory, so
+a warm instance re-renders without reading the blob back at all.
+"""
+import base64
+import logging
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+logger = logging.getLogger(__name__)
+
+# Kept free under the cap for the rest of the write: the SET command and the
+# drawing context pipelined with it
+_REQUEST_MARGIN = 4096
+
+
+def encoded_size(n: int) -> int:
+    """Length of the base64 text for ``n`` bytes."""
+    return 4 * ((n + 2) // 3)
+
+
+def _reencode_jpeg(data: bytes, quality: int) -> bytes:
+    from PIL import Image
+
+    buf = BytesIO()
+    Image.open(BytesIO(data)).convert("RGB").save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def pack(data: bytes, max_bytes: int) -> str | None:
+    """Encode a blob for storage, or None if its encoded form can't be made to fit ``max_bytes``."""
+    limit = max_bytes - _REQUEST_MARGIN
+    for quality in (None, 90, 80):
+        if quality is not None:
+            try:
+                data = _reencode_jpeg(data, quality)
+            except Exception as e:
+                logger.warning(f"BLOBS: re-encode failed: {e}")
+                return None
+        if encoded_size(len(data)) <= limit:
+            return base64.b64encode(data).decode("ascii")
+    return None
+
+
+def unpack(text: str) -> bytes:
+    return base64.b64decode(text)
+
+
+class LocalBlobCache:
+    """Least recently used blobs of this process, capped by their total size."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items: OrderedDict[str, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, blob_id: str) -> bytes | None:
+        with self._lock:
+            data = self._items.get(blob_id)
+            if data is not None:
+                self._items.move_to_end(blob_id)
+            return data
+
+    def put(self, blob_id: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(blob_id, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[blob_id] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def __len__(self) -> int:
+        return len(self._items)
@@ -0,0 +1,221 @@
+"""Resumable, rate-limited broadcast engine.
+
+A broadcast is a persistent job in Redis (see ``bot.database``).  Each
+invocation of ``run_broadcast`` takes a lease on the job, walks the user set
+with SSCAN from the saved cursor, sends one batch at a time concurrently
+within a token-bucket budget and checkpoints progress after every batch.
+
+The time budget is checked before every send: once it is spent no more
+tokens are taken, and the batch's unsent recipients are saved with the
+checkpoint (``carry``) for the next invocation (``/broadcast_resume`` or
+the cron route).  A RetryAfter that would run past the budget ends the run
+the same way, so a run never outlives its lease.  Batches are no larger
+than the rate allows within the budget; a recipient may still receive the
+message twice if an invocation is killed in the middle of a batch.
+"""
+import asyncio
+import logging
+import time
+import uuid
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+from bot import deadline
+from bot.config import (
+    BROADCAST_RATE_PER_SEC,
+    BROADCAST_CONCURRENCY,
+    BROADCAST_BATCH_SIZE,
+    BROADCAST_TIME_BUDGET,
+    BROADCAST_MAX_RETRIES,
+)
+from bot.database import (
+    BROADCAST_LEASE_KEY,
+    acquire_lock,
+    release_lock,
+    get_broadcast_job,
+    save_broadcast_job,
+    set_current_broadcast,
+    get_total_users,
+    iter_user_batches,
+    remove_user,
+)
+
+logger = logging.getLogger(__name__)
+
+_LEASE_MARGIN = 30.0  # seconds the lease outlives the budget (sends in flight, checkpoint)
+_CHECKPOINT_RESERVE = 5.0  # seconds of the invocation budget kept after the last send
+
+
+class TokenBucket:
+    """Async token bucket: ``rate`` tokens per second, bursts up to ``capacity``.
+
+    ``pause`` blocks every waiter until the given moment, which is how a
+    Telegram ``RetryAfter`` is applied to the whole bot rather than to a
+    single recipient.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+async def _send_one(bot: Bot, user_id: int, text: str, bucket: TokenBucket, stop_at: float) -> str | None:
+    """Deliver ``text`` to one user; returns "sent", "blocked", "failed" or None if out of time."""
+    for _ in range(BROADCAST_MAX_RETRIES + 1):
+        try:  # stop taking tokens once the budget is spent, even during a pause
+            await asyncio.wait_for(bucket.acquire(), timeout=max(stop_at - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            return None
+        try:
+            await bot.send_message(user_id, text)
+            return "sent"
+        except TelegramRetryAfter as e:
+            logger.warning(f"BROADCAST: RetryAfter {e.retry_after}s on user {user_id}")
+            bucket.pause(e.retry_after)
+            if time.monotonic() + e.retry_after >= stop_at:
+                return None
+        except TelegramForbiddenError:
+            remove_user(user_id)
+            return "blocked"
+        except Exception as e:
+            logger.warning(f"BROADCAST: failed to send to {user_id}: {e}")
+            return "failed"
+    return "failed"
+
+
+def create_broadcast(text: str) -> dict:
+    """Create a new broadcast job, mark it current and return its record."""
+    now = time.time()
+    job = {
+        "id": uuid.uuid4().hex[:8],
+        "text": text,
+        "status": "running",
+        "cursor": 0,
+        "total": get_total_users(),
+        "sent": 0,
+        "failed": 0,
+        "blocked": 0,
+        "active_secs": 0.0,
+        "created_at": now,
+        "updated_at": now,
+        "last_rate": 0.0,
+    }
+    save_broadcast_job(job)
+    set_current_broadcast(job["id"])
+    return job
+
+
+async def run_broadcast(bot: Bot, job_id: str, time_budget: float = BROADCAST_TIME_BUDGET) -> dict | None:
+    """Continue a broadcast job for at most ``time_budget`` seconds.
+
+    Inside an invocation budget (``bot.deadline``) the run is cut to what it
+    leaves.  Returns the job record after the last checkpoint.  If another
+    invocation currently holds the lease, returns the record untouched.
+    """
+    job = get_broadcast_job(job_id)
+    if not job or job["status"] != "running":
+        return job
+
+    left = deadline.remaining()
+    if left is not None:
+        time_budget = max(min(time_budget, left - _CHECKPOINT_RESERVE), 0.0)
+    token = uuid.uuid4().hex
+    lease_ms = int((time_budget + _LEASE_MARGIN) * 1000)
+    if not acquire_lock(BROADCAST_LEASE_KEY, token, lease_ms):
+        logger.info(f"BROADCAST: job {job_id} is being sent by another invocation")
+        return job
+
+    bucket = TokenBucket(BROADCAST_RATE_PER_SEC)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    started = time.monotonic()
+    stop_at = started + time_budget
+
+    async def send(user_id: int) -> str | None:
+        async with semaphore:
+            return await _send_one(bot, user_id, job["text"], bucket, stop_at)
+
+    batch_size = max(1, min(BROADCAST_BATCH_SIZE, int(BROADCAST_RATE_PER_SEC * time_budget)))
+
+    def pages():
+        # Recipients left over from the previous run's last batch go first
+        if job.get("carry"):
+            yield job["cursor"], job["carry"]
+            if job["cursor"] == 0:
+                return
+        yield from iter_user_batches(batch_size, cursor=job["cursor"])
+
+    sent_before = job["sent"]
+    try:
+        for next_cursor, user_ids in pages():
+            batch_started = time.monotonic()
+            results = await asyncio.gather(*(send(uid) for uid in user_ids))
+            for outcome in ("sent", "failed", "blocked"):
+                job[outcome] += results.count(outcome)
+
+            job["cursor"] = next_cursor
+            job["carry"] = [uid for uid, outcome in zip(user_ids, results) if outcome is None]
+            job["active_secs"] += time.monotonic() - batch_started
+            elapsed = time.monotonic() - started
+            job["last_rate"] = (job["sent"] - sent_before) / elapsed if elapsed else 0.0
+            job["updated_at"] = time.time()
+            if next_cursor == 0 and not job["carry"]:
+                job["status"] = "done"
+            save_broadcast_job(job)
+
+            if job["status"] == "done" or time.monotonic() >= stop_at:
+                break
+    finally:
+        release_lock(BROADCAST_LEASE_KEY, token)
+
+    logger.info(
+        f"BROADCAST: job {job_id} status={job['status']} sent={job['sent']} "
+        f"failed={job['failed']} blocked={job['blocked']} rate={job['last_rate']:.1f}/s"
+    )
+    return job
+
+
+def format_broadcast_status(job: dict) -> str:
+    """Human-readable progress report for /broadcast_status."""
+    processed = job["sent"] + job["failed"] + job["blocked"]
+    total = max(job["total"], processed, 1)
+    overall_rate = job["sent"] / job["active_secs"] if job["active_secs"] else 0.0
+    status = {"running": "⏳ идёт", "done": "✅ завершена"}.get(job["status"], job["status"])
+    text = (
+        f"📣 <b>Рассылка #{job['id']}</b> — {status}\n\n"
+        f"Обработано: <b>{processed}</b> из {job['total']} ({processed * 100 // total}%)\n"
+        f"Успешно: {job['sent']}\n"
+        f"Ошибок: {job['failed']}\n"
+        f"Заблокировали бота: {job['blocked']}\n"
+        f"Скорость: {job['last_rate']:.1f} сообщ./с (средняя {overall_rate:.1f})"
+    )
+    if job["status"] == "running" and overall_rate:
+        eta = (job["total"] - processed) / overall_rate
+        text += f"\nОсталось примерно: {int(eta // 60)} мин {int(eta % 60)} с"
+    return text
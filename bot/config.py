@@ -10,8 +10,94 @@ PROTALK_FUNCTION_ID  = os.getenv("PROTALK_FUNCTION_ID", "609")
 YUKASSA_TOKEN        = os.getenv("YUKASSA_PROVIDER_TOKEN", "")
 ADMIN_ID             = int(os.getenv("ADMIN_ID", "128247430"))
 
+# External API endpoints; overridable to point the bot at local stand-ins (scripts/loadtest.py)
+KIE_API_BASE         = os.getenv("KIE_API_BASE", "https://api.kie.ai")
+PROTALK_API_BASE     = os.getenv("PROTALK_API_BASE", "https://api.pro-talk.ru")
+TELEGRAM_API_BASE    = os.getenv("TELEGRAM_API_BASE", "")  # empty: the official https://api.telegram.org
+CRON_SECRET          = os.getenv("CRON_SECRET", "")  # Bearer token for scheduled /api/cron/* calls
+
+# Storage backend: upstash | redis | sqlite | memory (see bot/storage)
+STORAGE_BACKEND      = os.getenv("STORAGE_BACKEND", "upstash")
+REDIS_URL            = os.getenv("REDIS_URL", "redis://localhost:6379/0")  # for STORAGE_BACKEND=redis
+REDIS_POOL_SIZE      = int(os.getenv("REDIS_POOL_SIZE", "10"))             # idle TCP connections kept
+SQLITE_PATH          = os.getenv("SQLITE_PATH", "pozdravish.db")           # for STORAGE_BACKEND=sqlite
+
+# Acknowledge Telegram updates before handling them (handlers run after the 200 is sent)
+WEBHOOK_ACK_FIRST    = os.getenv("WEBHOOK_ACK_FIRST", "0") == "1"
+UPDATE_DEDUP_TTL     = int(os.getenv("UPDATE_DEDUP_TTL", "3600"))  # seconds an update_id is remembered
+UPDATE_CLAIM_TTL     = int(os.getenv("UPDATE_CLAIM_TTL", "90"))    # seconds it is held while processing (> REQUEST_BUDGET)
+
+# Per-chat serialization: updates from one chat are handled one at a time across instances
+CHAT_LOCK_ENABLED    = os.getenv("CHAT_LOCK_ENABLED", "1") == "1"
+CHAT_LOCK_TTL_MS     = int(os.getenv("CHAT_LOCK_TTL_MS", "15000"))  # lease expiry if a holder dies
+# Seconds to wait for the lock before asking the user to resend; at least the
+# TTL, so a lease left by a dead holder is always taken over
+CHAT_LOCK_MAX_WAIT   = max(float(os.getenv("CHAT_LOCK_MAX_WAIT", "0")), CHAT_LOCK_TTL_MS / 1000 + 1)
+
+# Warm-up (fonts, connection pools, codecs) in the background right after startup
+WARMUP_ON_STARTUP    = os.getenv("WARMUP_ON_STARTUP", "1") == "1"
+
+# Event-loop stall detector (bot.loop_monitor), off by default
+LOOP_MONITOR_ENABLED      = os.getenv("LOOP_MONITOR_ENABLED", "0") == "1"
+LOOP_STALL_THRESHOLD      = float(os.getenv("LOOP_STALL_THRESHOLD", "0.1"))  # seconds the loop may be blocked
+LOOP_STALL_CAPTURE_STACKS = os.getenv("LOOP_STALL_CAPTURE_STACKS", "0") == "1"  # log the sampled stack
+LOOP_MONITOR_ASYNCIO_DEBUG = os.getenv("LOOP_MONITOR_ASYNCIO_DEBUG", "0") == "1"  # asyncio slow-callback logs
+
+# Time budget of one webhook / Kie callback / worker job; outbound timeouts are cut to fit it.
+# Keep it below the platform's function time limit (Vercel maxDuration).
+REQUEST_BUDGET       = float(os.getenv("REQUEST_BUDGET", "55"))  # seconds
+
+# Generation job queue (Redis Streams). When enabled, webhooks only enqueue jobs
+# and `python -m bot.worker` does task creation, callback completion, render and send.
+GENERATION_QUEUE     = os.getenv("GENERATION_QUEUE", "0") == "1"
+WORKER_CONCURRENCY   = int(os.getenv("WORKER_CONCURRENCY", "4"))       # consumers per worker process
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "1.0"))  # seconds to sleep on an empty stream
+JOB_RECLAIM_IDLE_MS  = int(os.getenv("JOB_RECLAIM_IDLE_MS", "60000"))   # pending this long -> reclaimed
+JOB_MAX_DELIVERIES   = 3  # after this many attempts a job goes to the dead-letter stream
+
+# Kie submission scheduler: tasks created but not yet called back, across all instances.
+# Submissions beyond the cap wait in a Redis queue (paying users first, fair between users).
+KIE_MAX_INFLIGHT     = int(os.getenv("KIE_MAX_INFLIGHT", "20"))        # 0 disables the queue
+KIE_QUEUE_TIMEOUT    = float(os.getenv("KIE_QUEUE_TIMEOUT", "120"))    # seconds to wait for a slot
+KIE_SLOT_TTL         = int(os.getenv("KIE_SLOT_TTL", "300"))           # a slot whose callback never came frees itself
+
+# Write-behind buffering of global counters (stats:generations, stats:revenue, stats buckets).
+# Buffers are also flushed at the end of every webhook/callback invocation and on shutdown.
+COUNTER_FLUSH_INTERVAL  = float(os.getenv("COUNTER_FLUSH_INTERVAL", "5"))   # seconds
+COUNTER_FLUSH_THRESHOLD = int(os.getenv("COUNTER_FLUSH_THRESHOLD", "100"))  # buffered increments
+
 FREE_CREDITS = 3
 MAX_CUSTOM_TEXT_LENGTH = 300  # Maximum characters allowed for custom greeting text
+GROUP_MAX_NAMES = 20  # Names per group postcard (one background, one credit)
+
+# Instant re-render: Kie backgrounds of recent postcards are kept to redraw the text
+RERENDER_TTL             = int(os.getenv("RERENDER_TTL", str(2 * 86400)))           # seconds
+RERENDER_MAX_BLOB_BYTES  = int(os.getenv("RERENDER_MAX_BLOB_BYTES", "700000"))      # per background, base64-encoded
+RERENDER_CACHE_BYTES     = int(os.getenv("RERENDER_CACHE_BYTES", str(64 * 1024 * 1024)))  # in-process LRU
+RERENDER_MAX_TEXT_LENGTH = 100
+
+# Progressive delivery: a low-res preview as soon as the background arrives, then the full card
+PROGRESSIVE_DELIVERY = os.getenv("PROGRESSIVE_DELIVERY", "0") == "1"
+PREVIEW_MAX_SIDE     = int(os.getenv("PREVIEW_MAX_SIDE", "320"))  # pixels
+
+# Background variants (/variants): several Kie tasks per postcard, the user picks one
+VARIANTS_COUNT    = int(os.getenv("VARIANTS_COUNT", "3"))
+VARIANTS_DEADLINE = float(os.getenv("VARIANTS_DEADLINE", "45"))  # seconds after submission to wait for all
+USER_SCAN_BATCH_SIZE = int(os.getenv("USER_SCAN_BATCH_SIZE", "500"))  # SSCAN COUNT hint for user iteration
+
+# Broadcast engine. Telegram allows ~30 messages/s per bot in total, keep a margin.
+BROADCAST_RATE_PER_SEC = float(os.getenv("BROADCAST_RATE_PER_SEC", "25"))
+BROADCAST_CONCURRENCY  = int(os.getenv("BROADCAST_CONCURRENCY", "25"))    # parallel send_message calls
+BROADCAST_BATCH_SIZE   = int(os.getenv("BROADCAST_BATCH_SIZE", "200"))    # users per checkpoint
+BROADCAST_TIME_BUDGET  = float(os.getenv("BROADCAST_TIME_BUDGET", "8"))   # seconds of sending per invocation
+BROADCAST_MAX_RETRIES  = 3  # RetryAfter retries per recipient
+
+# Scheduled postcards: due jobs are sent by GET /api/cron/scheduled (call it every minute)
+# at the broadcast rate; one invocation sends for at most SCHEDULED_TIME_BUDGET seconds.
+SCHEDULE_UTC_OFFSET    = int(os.getenv("SCHEDULE_UTC_OFFSET", "3"))        # hours; users type Moscow time
+SCHEDULE_MAX_DAYS      = 366
+SCHEDULED_BATCH_SIZE   = int(os.getenv("SCHEDULED_BATCH_SIZE", "200"))     # jobs claimed at once
+SCHEDULED_TIME_BUDGET  = float(os.getenv("SCHEDULED_TIME_BUDGET", "50"))   # seconds of sending per invocation
 
 PACKAGES = {
     3:  {"rub": 90,  "amount": 9000,  "label": "Пакет: 3 открытки"},
@@ -0,0 +1,112 @@
+"""Write-behind aggregation of hot global counters.
+
+Keys such as ``stats:generations`` and ``stats:revenue`` (and the hourly /
+daily statistics hashes) are shared by every instance.  Instead of a Redis
+call per event, increments are summed in process and written in one
+INCRBY/HINCRBY pipeline when
+
+* COUNTER_FLUSH_INTERVAL seconds have passed since the last flush,
+* COUNTER_FLUSH_THRESHOLD increments are buffered,
+* a serverless invocation ends (``flush(reason="invocation")``), or
+* the process shuts down (lifespan/worker shutdown and ``atexit``).
+
+A failed flush puts the deltas back into the buffer, so they are retried
+with the next one.  Flushes are counted in ``counter_flushes_total``.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from bot import metrics
+from bot.config import COUNTER_FLUSH_INTERVAL, COUNTER_FLUSH_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+
+class CounterAggregator:
+    def __init__(self, flush_interval: float = COUNTER_FLUSH_INTERVAL,
+                 flush_threshold: int = COUNTER_FLUSH_THRESHOLD):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.flushes = 0
+        self._lock = threading.Lock()
+        self._keys: dict[str, int] = {}
+        self._fields: dict[tuple[str, str], int] = {}
+        self._ttls: dict[str, int] = {}
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+
+    def incrby(self, key: str, amount: int = 1) -> None:
+        with self._lock:
+            self._keys[key] = self._keys.get(key, 0) + amount
+            self._buffered += 1
+        self.maybe_flush()
+
+    def hincrby(self, key: str, field: str, amount: int = 1, ttl: int | None = None) -> None:
+        """Buffer a hash field increment; ``ttl`` is (re)applied to ``key`` on flush."""
+        with self._lock:
+            self._fields[(key, field)] = self._fields.get((key, field), 0) + amount
+            if ttl:
+                self._ttls[key] = ttl
+            self._buffered += 1
+        self.maybe_flush()
+
+    def pending(self, key: str) -> int:
+        """Increments of ``key`` not written to Redis yet (for read-your-writes)."""
+        with self._lock:
+            return self._keys.get(key, 0)
+
+    def maybe_flush(self) -> bool:
+        """Flush if the threshold or the interval has been reached."""
+        if self._buffered >= self.flush_threshold:
+            return self.flush(reason="threshold")
+        if self._buffered and time.monotonic() - self._last_flush >= self.flush_interval:
+            return self.flush(reason="interval")
+        return False
+
+    def flush(self, reason: str = "manual") -> bool:
+        """Write all buffered increments in one pipeline.  Returns True if anything was sent."""
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._buffered:
+                return False
+            keys, fields, ttls = self._keys, self._fields, self._ttls
+            self._keys, self._fields, self._ttls = {}, {}, {}
+            buffered, self._buffered = self._buffered, 0
+
+        from bot.database import kv
+
+        pipe = kv.pipeline()
+        for key, amount in keys.items():
+            pipe.incrby(key, amount)
+        for (key, field), amount in fields.items():
+            pipe.hincrby(key, field, amount)
+        for key, ttl in ttls.items():
+            pipe.expire(key, ttl)
+        try:
+            pipe.exec()
+        except Exception as e:
+            logger.warning(f"COUNTERS: flush failed, keeping {buffered} increments buffered: {e}")
+            metrics.incr("counter_flush_failures_total")
+            self._restore(keys, fields, ttls, buffered)
+            return False
+
+        self.flushes += 1
+        metrics.incr("counter_flushes_total", reason=reason)
+        logger.debug(f"COUNTERS: flushed {buffered} increments ({reason})")
+        return True
+
+    def _restore(self, keys: dict, fields: dict, ttls: dict, buffered: int) -> None:
+        with self._lock:
+            for key, amount in keys.items():
+                self._keys[key] = self._keys.get(key, 0) + amount
+            for key_field, amount in fields.items():
+                self._fields[key_field] = self._fields.get(key_field, 0) + amount
+            for key, ttl in ttls.items():
+                self._ttls.setdefault(key, ttl)
+            self._buffered += buffered
+
+
+aggregator = CounterAggregator()
+atexit.register(aggregator.flush, reason="shutdown")
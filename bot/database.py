@@ -1,11 +1,65 @@
 import json
-from upstash_redis import Redis
-from bot.config import FREE_CREDITS
+import time
 
-# We assume Upstash Redis REST URL and token are in environment variables
-# UPSTASH_REDIS_REST_URL
-# UPSTASH_REDIS_REST_TOKEN
-kv = Redis.from_env()
+from bot import redis_usage
+from bot.counters import aggregator
+from bot.storage import register_script
+from bot.config import FREE_CREDITS, USER_SCAN_BATCH_SIZE, OCCASION_TEXT_MAP
+
+
+class _LazyRedis:
+    """Create the storage client on first use instead of at import time.
+
+    The backend is chosen by STORAGE_BACKEND (see ``bot.storage``).  Creating
+    it lazily keeps its imports — e.g. upstash_redis pulls in `requests` —
+    out of cold starts that never reach storage (e.g. rejected webhooks).
+
+    Every command issued through the proxy is counted as one round trip
+    (a pipeline counts once, with all its queued operations), see
+    ``bot.redis_usage``.  Internal housekeeping uses ``kv.client`` directly
+    to stay out of it.
+    """
+
+    def __init__(self):
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from bot.storage import create_backend
+            self._client = create_backend()
+        return self._client
+
+    def __getattr__(self, name: str):
+        if name == "pipeline":
+            return lambda: _CountedPipeline(self.client.pipeline())
+        redis_usage.record()
+        return getattr(self.client, name)
+
+
+class _CountedPipeline:
+    """Counts the operations queued on a pipeline; ``exec`` is one round trip."""
+
+    def __init__(self, pipe):
+        self._pipe = pipe
+        self._ops = 0
+
+    def exec(self):
+        redis_usage.record(self._ops)
+        return self._pipe.exec()
+
+    def __getattr__(self, name: str):
+        command = getattr(self._pipe, name)
+
+        def queue(*args, **kwargs):
+            self._ops += 1
+            result = command(*args, **kwargs)
+            return self if result is self._pipe else result
+
+        return queue
+
+
+kv = _LazyRedis()
 
 
 # ---------------------------------------------------------------------------
@@ -28,10 +82,125 @@ def template_file_id_key(template_id: str) -> str:
     """Global Redis key for a template's Telegram file_id."""
     return f"template:file_id:{template_id}"
 
+def media_file_id_key(digest: str) -> str:
+    """Telegram file_id of a bundled asset, keyed by its content hash."""
+    return f"media:file_id:{digest}"
+
 def pending_image_key(task_id: str) -> str:
     """Redis key for storing pending image generation task data."""
     return f"pending_image:{task_id}"
 
+def image_task_done_key(task_id: str) -> str:
+    """Completion marker for a Kie task — set once the callback is fully handled."""
+    return f"pending_image:{task_id}:done"
+
+def image_task_lease_key(task_id: str) -> str:
+    """Processing lease held by the invocation currently handling a Kie callback."""
+    return f"pending_image:{task_id}:lease"
+
+def variants_pref_key(user_id: int) -> str:
+    """Set while the user wants several background variants per postcard."""
+    return f"user:{user_id}:variants"
+
+def variant_set_key(set_id: str) -> str:
+    return f"variants:{set_id}"
+
+def variant_results_key(set_id: str) -> str:
+    """Hash of task_id -> image URL ("" for a failed variant)."""
+    return f"variants:{set_id}:results"
+
+def variant_collector_key(set_id: str) -> str:
+    """Taken by the first callback of a set, which waits for the rest."""
+    return f"variants:{set_id}:collector"
+
+def variant_cards_key(set_id: str) -> str:
+    """The delivered variants, for the pick-one buttons."""
+    return f"variants:{set_id}:cards"
+
+def rerender_key(task_id: str) -> str:
+    """What was drawn on a delivered postcard, for instant re-renders."""
+    return f"rerender:{task_id}"
+
+def background_blob_key(task_id: str) -> str:
+    """The Kie background of a delivered postcard (base64, see bot.blobs)."""
+    return f"blob:bg:{task_id}"
+
+def chat_lock_key(chat_id: int) -> str:
+    """Lease serializing update handling for one chat."""
+    return f"lock:chat:{chat_id}"
+
+def update_seen_key(update_id: int) -> str:
+    """Marker for a Telegram update that has already been accepted."""
+    return f"update:seen:{update_id}"
+
+def broadcast_job_key(job_id: str) -> str:
+    return f"broadcast:job:{job_id}"
+
+BROADCAST_CURRENT_KEY = "broadcast:current"
+BROADCAST_LEASE_KEY = "broadcast:lease"
+
+PAID_USERS_KEY = "users:paid"  # users who bought a package (Kie queue priority)
+KIE_WAITING_KEY = "kie:queue:waiting"    # ticket -> priority score
+KIE_SEEN_KEY = "kie:queue:seen"          # ticket -> last poll, ms
+KIE_INFLIGHT_KEY = "kie:queue:inflight"  # ticket -> slot expiry, ms
+
+SCHEDULED_DUE_KEY = "scheduled:due"          # job id -> due time
+SCHEDULED_CLAIMED_KEY = "scheduled:claimed"  # job id -> lease expiry, while being sent
+SCHEDULED_LEASE_KEY = "scheduled:lease"
+
+def scheduled_job_key(job_id: str) -> str:
+    return f"scheduled:job:{job_id}"
+
+def kie_user_round_key(user_id: int) -> str:
+    """The user's waiting submissions, a set of tickets (fairness between users)."""
+    return f"kie:queue:user:{user_id}"
+
+
+# ---------------------------------------------------------------------------
+# Leases (short-lived distributed locks)
+# ---------------------------------------------------------------------------
+
+# Delete the lock only if we still own it, so an expired lease taken over by
+# another instance is never released by the previous holder.
+_RELEASE_LOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+@register_script(_RELEASE_LOCK_SCRIPT)
+def _release_lock_fallback(call, keys, args):
+    if call("GET", keys[0]) == args[0]:
+        return call("DEL", keys[0])
+    return 0
+
+def acquire_lock(key: str, token: str, ttl_ms: int) -> bool:
+    """Try to take a lease on ``key``; returns True if ``token`` now owns it."""
+    return bool(kv.set(key, token, nx=True, px=ttl_ms))
+
+def release_lock(key: str, token: str) -> bool:
+    """Release a lease previously taken with ``acquire_lock``."""
+    return bool(kv.eval(_RELEASE_LOCK_SCRIPT, keys=[key], args=[token]))
+
+
+# ---------------------------------------------------------------------------
+# Webhook update deduplication
+# ---------------------------------------------------------------------------
+
+def claim_update(update_id: int, ttl: int) -> bool:
+    """Return True the first time an update_id is seen, False for redeliveries.
+
+    ``ttl`` should only cover processing; once the update is handled,
+    ``finish_update`` keeps it for the full dedup window.  If the handler
+    dies first the claim lapses and a redelivery is processed.
+    """
+    return bool(kv.set(update_seen_key(update_id), 1, nx=True, ex=ttl))
+
+def finish_update(update_id: int, ttl: int) -> None:
+    """Remember a handled update_id for ``ttl`` seconds."""
+    kv.set(update_seen_key(update_id), 2, ex=ttl)
+
 
 # ---------------------------------------------------------------------------
 # Credits
@@ -44,19 +213,47 @@ def get_credits(user_id: int) -> int:
         return FREE_CREDITS
     return int(val)
 
+def get_generation_options(user_id: int) -> tuple[int, bool]:
+    """``(credits, variants enabled)`` in one MGET; initializes credits like ``get_credits``."""
+    credits, variants = kv.mget(credits_key(user_id), variants_pref_key(user_id))
+    if credits is None:
+        kv.set(credits_key(user_id), FREE_CREDITS)
+        credits = FREE_CREDITS
+    return int(credits), bool(variants)
+
+def set_variants_enabled(user_id: int, enabled: bool) -> None:
+    if enabled:
+        kv.set(variants_pref_key(user_id), 1)
+    else:
+        kv.delete(variants_pref_key(user_id))
+
 def add_credits(user_id: int, amount: int) -> int:
     current = get_credits(user_id)
     new_val = current + amount
     kv.set(credits_key(user_id), new_val)
     return new_val
 
+def add_purchased_credits(user_id: int, amount: int) -> int:
+    """``add_credits`` for a bought package; also marks the user as paying."""
+    pipe = kv.pipeline()
+    pipe.get(credits_key(user_id))
+    pipe.sadd(PAID_USERS_KEY, user_id)
+    current, _ = pipe.exec()
+    new_val = (FREE_CREDITS if current is None else int(current)) + amount
+    kv.set(credits_key(user_id), new_val)
+    return new_val
+
 
 # ---------------------------------------------------------------------------
 # User state (FSM stored in Redis — survives Vercel cold starts)
 # ---------------------------------------------------------------------------
 
 def set_user_state(user_id: int, state: dict):
-    kv.set(state_key(user_id), json.dumps(state))
+    """Save the wizard state; the same round trip marks the user active today."""
+    pipe = kv.pipeline()
+    pipe.set(state_key(user_id), json.dumps(state))
+    add_active_user(pipe, user_id)
+    pipe.exec()
 
 def get_user_state(user_id: int) -> dict:
     val = kv.get(state_key(user_id))
@@ -97,12 +294,136 @@ def pop_pending(user_id: int) -> dict:
 # Statistics & Analytics
 # ---------------------------------------------------------------------------
 
+# Time-bucketed counters, buffered by the write-behind aggregator (bot.counters):
+#
+#   stats:h:{YYYYMMDDHH}   hash, hourly bucket (UTC); expires after STATS_HOURLY_TTL
+#   stats:d:{YYYYMMDD}     hash, daily bucket (UTC); expires after STATS_DAILY_TTL
+#   stats:dau:{YYYYMMDD}   HyperLogLog of active user IDs
+#
+# Bucket fields: generations, new_users, payments, revenue and
+# "{dimension}:{value}" for occasion, style, font and text_mode.
+
+STATS_HOURLY_TTL = 3 * 86_400
+STATS_DAILY_TTL = 400 * 86_400
+STATS_DIMENSIONS = ("occasion", "style", "font", "text_mode")
+
+def stats_hour_key(ts: float) -> str:
+    return "stats:h:" + time.strftime("%Y%m%d%H", time.gmtime(ts))
+
+def stats_day_key(ts: float) -> str:
+    return "stats:d:" + time.strftime("%Y%m%d", time.gmtime(ts))
+
+def dau_key(ts: float) -> str:
+    return "stats:dau:" + time.strftime("%Y%m%d", time.gmtime(ts))
+
+def add_stat_counts(fields: dict[str, int], now: float | None = None) -> None:
+    """Buffer increments of the current hourly and daily buckets."""
+    now = now or time.time()
+    for key, ttl in ((stats_hour_key(now), STATS_HOURLY_TTL), (stats_day_key(now), STATS_DAILY_TTL)):
+        for field, amount in fields.items():
+            aggregator.hincrby(key, field, amount, ttl=ttl)
+
+def add_active_user(pipe, user_id: int, now: float | None = None) -> None:
+    """Queue a PFADD of ``user_id`` into today's active-users HyperLogLog."""
+    key = dau_key(now or time.time())
+    pipe.pfadd(key, user_id)
+    pipe.expire(key, STATS_DAILY_TTL)
+
+def generation_stat_fields(payload: dict) -> dict[str, int]:
+    """Bucket fields for one delivered postcard.
+
+    Custom occasions are free text, so they are counted as one "custom"
+    value to keep the number of hash fields bounded.
+    """
+    occasion = payload.get("occasion") or ""
+    values = {
+        "occasion": OCCASION_TEXT_MAP.get(occasion, "custom"),
+        "style": payload.get("style") or "unknown",
+        "font": payload.get("font") or "unknown",
+        "text_mode": payload.get("text_mode") or "ai",
+    }
+    fields = {"generations": 1}
+    for dimension, value in values.items():
+        fields[f"{dimension}:{value}"] = 1
+    if payload.get("addressees"):
+        fields["group_cards"] = len(payload["addressees"])
+    return fields
+
+def get_stat_buckets(days: int = 7, now: float | None = None) -> dict:
+    """Summarise the last ``days`` daily buckets with one pipeline.
+
+    Returns ``{"days": [(day, fields, dau), ...], "totals": fields,
+    "unique_users": n}`` — newest day first; ``unique_users`` is the
+    HyperLogLog union over the whole period.
+    """
+    now = now or time.time()
+    stamps = [now - i * 86_400 for i in range(days)]
+    pipe = kv.pipeline()
+    for ts in stamps:
+        pipe.hgetall(stats_day_key(ts))
+    for ts in stamps:
+        pipe.pfcount(dau_key(ts))
+    pipe.pfcount(*[dau_key(ts) for ts in stamps])
+    results = pipe.exec()
+
+    summary = {"days": [], "totals": {}, "unique_users": int(results[-1] or 0)}
+    for i, ts in enumerate(stamps):
+        fields = {k: int(float(v)) for k, v in (results[i] or {}).items()}
+        for k, v in fields.items():
+            summary["totals"][k] = summary["totals"].get(k, 0) + v
+        day = time.strftime("%Y-%m-%d", time.gmtime(ts))
+        summary["days"].append((day, fields, int(results[days + i] or 0)))
+    return summary
+
+def get_hourly_stats(hours: int = 24, now: float | None = None) -> list[tuple[str, dict]]:
+    """Return ``(hour, fields)`` for the last ``hours`` hourly buckets, newest first."""
+    now = now or time.time()
+    stamps = [now - i * 3600 for i in range(hours)]
+    pipe = kv.pipeline()
+    for ts in stamps:
+        pipe.hgetall(stats_hour_key(ts))
+    return [
+        (time.strftime("%Y-%m-%d %H:00", time.gmtime(ts)), {k: int(float(v)) for k, v in (fields or {}).items()})
+        for ts, fields in zip(stamps, pipe.exec())
+    ]
+
 def record_new_user(user_id: int):
     kv.sadd("stats:users", user_id)
+    add_stat_counts({"new_users": 1})
+
+def iter_user_batches(batch_size: int = USER_SCAN_BATCH_SIZE, cursor: int = 0):
+    """Yield pages of user IDs from ``stats:users`` using SSCAN.
+
+    Each item is ``(next_cursor, user_ids)``.  Persisting ``next_cursor``
+    lets a caller resume the scan later; a cursor of 0 means the scan is
+    complete.  Only one page is held in memory at a time.
+
+    Args:
+        batch_size: COUNT hint passed to SSCAN (Redis may return more or fewer).
+        cursor: Cursor to resume from, 0 to start a new scan.
+    """
+    while True:
+        cursor, members = kv.sscan("stats:users", cursor, count=batch_size)
+        cursor = int(cursor)
+        yield cursor, [int(uid) for uid in members]
+        if cursor == 0:
+            return
+
+def iter_users(batch_size: int = USER_SCAN_BATCH_SIZE, cursor: int = 0):
+    """Lazily yield every user ID that has started the bot."""
+    for _, user_ids in iter_user_batches(batch_size, cursor):
+        yield from user_ids
 
 def get_all_users() -> list:
-    """Returns a list of all user IDs that have started the bot."""
-    return [int(uid) for uid in kv.smembers("stats:users")]
+    """Returns a list of all user IDs that have started the bot.
+
+    Materialises the whole set — prefer ``iter_users`` for large audiences.
+    """
+    return list(iter_users())
+
+def remove_user(user_id: int):
+    """Drop a user from the audience (e.g. they blocked the bot)."""
+    kv.srem("stats:users", user_id)
 
 def is_user_exists(user_id: int) -> bool:
     return kv.sismember("stats:users", user_id)
@@ -111,18 +432,51 @@ def get_total_users() -> int:
     return kv.scard("stats:users")
 
 def increment_generations():
-    kv.incr("stats:generations")
+    aggregator.incrby("stats:generations")
 
 def get_total_generations() -> int:
     val = kv.get("stats:generations")
-    return int(val) if val else 0
+    return (int(val) if val else 0) + aggregator.pending("stats:generations")
 
 def record_payment(amount_rub: int):
-    kv.incrby("stats:revenue", amount_rub)
+    aggregator.incrby("stats:revenue", amount_rub)
+    add_stat_counts({"payments": 1, "revenue": amount_rub})
 
 def get_total_revenue() -> int:
     val = kv.get("stats:revenue")
-    return int(val) if val else 0
+    return (int(val) if val else 0) + aggregator.pending("stats:revenue")
+
+
+# ---------------------------------------------------------------------------
+# Broadcast jobs
+#
+# A job record is checkpointed after every batch so that any later
+# invocation (admin command or cron) can continue from the saved SSCAN cursor.
+# ---------------------------------------------------------------------------
+
+def save_broadcast_job(job: dict) -> None:
+    kv.set(broadcast_job_key(job["id"]), json.dumps(job))
+
+def get_broadcast_job(job_id: str) -> dict | None:
+    val = kv.get(broadcast_job_key(job_id))
+    if isinstance(val, str):
+        try:
+            return json.loads(val)
+        except json.JSONDecodeError:
+            return None
+    if isinstance(val, dict):
+        return val
+    return None
+
+def set_current_broadcast(job_id: str) -> None:
+    kv.set(BROADCAST_CURRENT_KEY, job_id)
+
+def get_current_broadcast() -> dict | None:
+    """Return the most recently started broadcast job, if any."""
+    job_id = kv.get(BROADCAST_CURRENT_KEY)
+    if not job_id:
+        return None
+    return get_broadcast_job(job_id)
 
 
 # ---------------------------------------------------------------------------
@@ -150,6 +504,57 @@ def save_postcard(user_id: int, file_id: str, caption: str):
 
     kv.set(key, json.dumps(cards))
 
+def _decode_cards(val) -> list:
+    if isinstance(val, str):
+        try:
+            return json.loads(val)
+        except Exception:
+            return []
+    return val or []
+
+def get_delivery_context(user_id: int) -> tuple[int | None, list]:
+    """Return ``(credits, gallery)`` for a user in a single MGET.
+
+    ``credits`` is None if the user has no credit record yet.
+    """
+    credits, cards = kv.mget(credits_key(user_id), postcards_key(user_id))
+    return (int(credits) if credits is not None else None), _decode_cards(cards)
+
+def finalize_postcard(
+    user_id: int,
+    task_id: str,
+    file_id: str | None,
+    caption: str,
+    gallery: list,
+    credits: int | None,
+    payload: dict | None = None,
+    done_ttl: int = 86_400,
+) -> int:
+    """Record a delivered postcard with one pipelined round trip.
+
+    Marks the Kie task done, debits one credit, marks the user active and
+    prepends the card to the user's gallery (``gallery`` is the list read by
+    ``get_delivery_context``).  The generation counters (lifetime and
+    time-bucketed by the ``payload`` choices) go through the write-behind
+    aggregator.  Returns the remaining credits.
+    """
+    pipe = kv.pipeline()
+    pipe.set(image_task_done_key(task_id), 1, ex=done_ttl)
+    pipe.delete(pending_image_key(task_id))
+    pipe.delete(image_task_lease_key(task_id))
+    if credits is None:
+        pipe.set(credits_key(user_id), FREE_CREDITS - 1)
+    else:
+        pipe.decrby(credits_key(user_id), 1)
+    if file_id:
+        cards = [{"file_id": file_id, "caption": caption}] + list(gallery)
+        pipe.set(postcards_key(user_id), json.dumps(cards[:5]))
+    add_active_user(pipe, user_id)
+    results = pipe.exec()
+    increment_generations()
+    add_stat_counts(generation_stat_fields(payload or {}))
+    return FREE_CREDITS - 1 if credits is None else int(results[3])
+
 def get_postcards(user_id: int) -> list:
     """Returns the user's saved postcards (newest first, max 5)."""
     key = postcards_key(user_id)
@@ -213,6 +618,316 @@ def templates_are_ready() -> bool:
     return all(get_all_template_file_ids().values())
 
 
+# ---------------------------------------------------------------------------
+# Static media registry — file_ids of bundled assets (see bot.media)
+# ---------------------------------------------------------------------------
+
+def get_media_file_id(digest: str) -> str | None:
+    val = kv.get(media_file_id_key(digest))
+    if isinstance(val, bytes):
+        return val.decode()
+    return val
+
+def set_media_file_id(digest: str, file_id: str) -> None:
+    kv.set(media_file_id_key(digest), file_id)
+
+def delete_media_file_id(digest: str) -> None:
+    kv.delete(media_file_id_key(digest))
+
+
+# ---------------------------------------------------------------------------
+# Kie submission queue — see bot.kie_queue
+# ---------------------------------------------------------------------------
+
+_KIE_TIER_WEIGHT = 10 ** 15   # every paying user's ticket goes before any free one
+_KIE_ROUND_WEIGHT = 10 ** 13  # a user's n-th waiting ticket goes after everyone's (n-1)-th
+
+# Queue a ticket behind the user's other tickets that are still waiting: the
+# round is counted from the user's set, dropping members no longer in the
+# queue (admitted, withdrawn or dropped as abandoned), so it never drifts.
+# Returns 1 if the user has paid before.
+_ENQUEUE_KIE_TICKET_SCRIPT = """
+local ahead = 0
+for _, t in ipairs(redis.call("SMEMBERS", KEYS[4])) do
+    if t ~= ARGV[1] then
+        if redis.call("ZSCORE", KEYS[1], t) then
+            ahead = ahead + 1
+        else
+            redis.call("SREM", KEYS[4], t)
+        end
+    end
+end
+redis.call("SADD", KEYS[4], ARGV[1])
+redis.call("EXPIRE", KEYS[4], ARGV[5])
+local paid = redis.call("SISMEMBER", KEYS[3], ARGV[2])
+local score = tonumber(ARGV[3]) + ahead * tonumber(ARGV[4])
+if paid == 0 then
+    score = score + tonumber(ARGV[6])
+end
+redis.call("ZADD", KEYS[1], score, ARGV[1])
+redis.call("ZADD", KEYS[2], ARGV[3], ARGV[1])
+return paid
+"""
+
+@register_script(_ENQUEUE_KIE_TICKET_SCRIPT)
+def _enqueue_kie_ticket_fallback(call, keys, args):
+    ahead = 0
+    for t in call("SMEMBERS", keys[3]):
+        if t != args[0]:
+            if call("ZSCORE", keys[0], t) is not None:
+                ahead += 1
+            else:
+                call("SREM", keys[3], t)
+    call("SADD", keys[3], args[0])
+    call("EXPIRE", keys[3], args[4])
+    paid = call("SISMEMBER", keys[2], args[1])
+    score = int(args[2]) + ahead * int(args[3]) + (0 if paid else int(args[5]))
+    call("ZADD", keys[0], score, args[0])
+    call("ZADD", keys[1], args[2], args[0])
+    return paid
+
+def enqueue_kie_ticket(user_id: int, ticket: str, round_ttl: int = 600) -> bool:
+    """Put a submission in the queue (again, after a drop); returns True if the user has paid before."""
+    now_ms = int(time.time() * 1000)
+    return bool(kv.eval(
+        _ENQUEUE_KIE_TICKET_SCRIPT,
+        keys=[KIE_WAITING_KEY, KIE_SEEN_KEY, PAID_USERS_KEY, kie_user_round_key(user_id)],
+        args=[ticket, user_id, now_ms, _KIE_ROUND_WEIGHT, round_ttl, _KIE_TIER_WEIGHT],
+    ))
+
+# Drop expired slots and abandoned tickets, then admit the ticket if fewer
+# tickets are ahead of it than there are free slots.  Returns 0 when admitted,
+# the 1-based queue position otherwise, or -1 if the ticket is gone.
+_ADMIT_KIE_TICKET_SCRIPT = """
+for _, t in ipairs(redis.call("ZRANGEBYSCORE", KEYS[2], "-inf", ARGV[2])) do
+    redis.call("ZREM", KEYS[2], t)
+end
+for _, t in ipairs(redis.call("ZRANGEBYSCORE", KEYS[3], "-inf", "(" .. ARGV[5])) do
+    redis.call("ZREM", KEYS[1], t)
+    redis.call("ZREM", KEYS[3], t)
+end
+local score = redis.call("ZSCORE", KEYS[1], ARGV[1])
+if not score then
+    return -1
+end
+local ahead = #redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", "(" .. score)
+if ahead < tonumber(ARGV[3]) - redis.call("ZCARD", KEYS[2]) then
+    redis.call("ZREM", KEYS[1], ARGV[1])
+    redis.call("ZREM", KEYS[3], ARGV[1])
+    redis.call("ZADD", KEYS[2], tonumber(ARGV[2]) + tonumber(ARGV[4]), ARGV[1])
+    redis.call("SREM", KEYS[4], ARGV[1])
+    return 0
+end
+redis.call("ZADD", KEYS[3], ARGV[2], ARGV[1])
+return ahead + 1
+"""
+
+@register_script(_ADMIT_KIE_TICKET_SCRIPT)
+def _admit_kie_ticket_fallback(call, keys, args):
+    for t in call("ZRANGEBYSCORE", keys[1], "-inf", args[1]):
+        call("ZREM", keys[1], t)
+    for t in call("ZRANGEBYSCORE", keys[2], "-inf", "(" + args[4]):
+        call("ZREM", keys[0], t)
+        call("ZREM", keys[2], t)
+    score = call("ZSCORE", keys[0], args[0])
+    if score is None:
+        return -1
+    ahead = len(call("ZRANGEBYSCORE", keys[0], "-inf", "(" + score))
+    if ahead < int(args[2]) - call("ZCARD", keys[1]):
+        call("ZREM", keys[0], args[0])
+        call("ZREM", keys[2], args[0])
+        call("ZADD", keys[1], int(args[1]) + int(args[3]), args[0])
+        call("SREM", keys[3], args[0])
+        return 0
+    call("ZADD", keys[2], args[1], args[0])
+    return ahead + 1
+
+def admit_kie_ticket(user_id: int, ticket: str, capacity: int, slot_ms: int, stale_ms: int) -> int:
+    """Try to move a waiting ticket into a Kie slot; see ``_ADMIT_KIE_TICKET_SCRIPT``."""
+    now_ms = int(time.time() * 1000)
+    return int(kv.eval(
+        _ADMIT_KIE_TICKET_SCRIPT,
+        keys=[KIE_WAITING_KEY, KIE_INFLIGHT_KEY, KIE_SEEN_KEY, kie_user_round_key(user_id)],
+        args=[ticket, now_ms, capacity, slot_ms, now_ms - stale_ms],
+    ))
+
+def leave_kie_queue(user_id: int, ticket: str) -> None:
+    """Withdraw a ticket that is still waiting (timeout or error)."""
+    pipe = kv.pipeline()
+    pipe.zrem(KIE_WAITING_KEY, ticket)
+    pipe.zrem(KIE_SEEN_KEY, ticket)
+    pipe.srem(kie_user_round_key(user_id), ticket)
+    pipe.exec()
+
+def release_kie_slot(ticket: str) -> None:
+    """Free the Kie slot of a finished (or failed) submission."""
+    kv.zrem(KIE_INFLIGHT_KEY, ticket)
+
+def kie_queue_depth() -> tuple[int, int]:
+    """``(waiting, in flight)`` submissions."""
+    pipe = kv.pipeline()
+    pipe.zcard(KIE_WAITING_KEY)
+    pipe.zcard(KIE_INFLIGHT_KEY)
+    waiting, inflight = pipe.exec()
+    return int(waiting or 0), int(inflight or 0)
+
+
+# ---------------------------------------------------------------------------
+# Scheduled postcards — see bot.scheduled
+# ---------------------------------------------------------------------------
+
+def save_scheduled_postcard(job: dict, keep_after_due: int = 7 * 86400) -> None:
+    """Store a job and put it on the due set (``job["due"]`` is a unix time)."""
+    ttl = max(int(job["due"] - time.time()), 0) + keep_after_due
+    pipe = kv.pipeline()
+    pipe.set(scheduled_job_key(job["id"]), json.dumps(job), ex=ttl)
+    pipe.zadd(SCHEDULED_DUE_KEY, {job["id"]: job["due"]})
+    pipe.zrem(SCHEDULED_CLAIMED_KEY, job["id"])
+    pipe.exec()
+
+# Return claims whose lease expired (the sender died) to the front of the due
+# set, then move up to ARGV[2] due jobs, earliest first, to the claimed set.
+_CLAIM_DUE_POSTCARDS_SCRIPT = """
+for _, id in ipairs(redis.call("ZRANGEBYSCORE", KEYS[2], "-inf", ARGV[1])) do
+    redis.call("ZREM", KEYS[2], id)
+    redis.call("ZADD", KEYS[1], 0, id)
+end
+local ids = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, ARGV[2])
+for _, id in ipairs(ids) do
+    redis.call("ZREM", KEYS[1], id)
+    redis.call("ZADD", KEYS[2], ARGV[3], id)
+end
+return ids
+"""
+
+@register_script(_CLAIM_DUE_POSTCARDS_SCRIPT)
+def _claim_due_postcards_fallback(call, keys, args):
+    for job_id in call("ZRANGEBYSCORE", keys[1], "-inf", args[0]):
+        call("ZREM", keys[1], job_id)
+        call("ZADD", keys[0], 0, job_id)
+    ids = call("ZRANGEBYSCORE", keys[0], "-inf", args[0], "LIMIT", 0, args[1])
+    for job_id in ids:
+        call("ZREM", keys[0], job_id)
+        call("ZADD", keys[1], args[2], job_id)
+    return ids
+
+def claim_due_postcards(limit: int, lease_secs: float) -> list[dict]:
+    """Atomically claim up to ``limit`` due jobs and load them (two round trips).
+
+    Claimed jobs go back to the due set if they aren't finished within
+    ``lease_secs``, so a killed sender can't lose them.
+    """
+    now = time.time()
+    ids = kv.eval(
+        _CLAIM_DUE_POSTCARDS_SCRIPT,
+        keys=[SCHEDULED_DUE_KEY, SCHEDULED_CLAIMED_KEY],
+        args=[now, limit, now + lease_secs],
+    ) or []
+    if not ids:
+        return []
+    jobs = []
+    for job_id, raw in zip(ids, kv.mget(*(scheduled_job_key(i) for i in ids))):
+        if raw:
+            jobs.append(json.loads(raw))
+        else:  # expired record: nothing to send
+            kv.zrem(SCHEDULED_CLAIMED_KEY, job_id)
+    return jobs
+
+def finish_scheduled_postcards(job_ids: list[str]) -> None:
+    if not job_ids:
+        return
+    pipe = kv.pipeline()
+    pipe.delete(*(scheduled_job_key(i) for i in job_ids))
+    pipe.zrem(SCHEDULED_CLAIMED_KEY, *job_ids)
+    pipe.exec()
+
+def count_scheduled_postcards() -> int:
+    return int(kv.zcard(SCHEDULED_DUE_KEY) or 0)
+
+
+# ---------------------------------------------------------------------------
+# Variant sets — several Kie backgrounds for one postcard (see bot.variants)
+# ---------------------------------------------------------------------------
+
+def create_variant_set(set_id: str, meta: dict, ttl: int) -> None:
+    kv.set(variant_set_key(set_id), json.dumps(meta), ex=ttl)
+
+def record_variant_result(
+    set_id: str, task_id: str, url: str, ttl: int, collector_lease: int
+) -> tuple[dict | None, dict, bool]:
+    """Store one variant's outcome in one round trip.
+
+    Returns ``(meta, results so far, is_collector)``.  The first variant to
+    arrive becomes the collector that waits for the others; its role is a
+    lease of ``collector_lease`` seconds, so once it lapses a later callback
+    of an undelivered set takes over.
+    """
+    pipe = kv.pipeline()
+    pipe.get(variant_set_key(set_id))
+    pipe.hset(variant_results_key(set_id), task_id, url)
+    pipe.expire(variant_results_key(set_id), ttl)
+    pipe.hgetall(variant_results_key(set_id))
+    pipe.set(variant_collector_key(set_id), task_id, nx=True, ex=collector_lease)
+    pipe.exists(variant_cards_key(set_id))
+    meta, _, _, results, collector, delivered = pipe.exec()
+    return (json.loads(meta) if meta else None), results or {}, bool(collector) and not delivered
+
+def release_variant_collector(set_id: str, task_id: str) -> None:
+    """Give up the collector role so a later callback can deliver the set."""
+    release_lock(variant_collector_key(set_id), task_id)
+
+def record_failed_variants(set_id: str, count: int, ttl: int) -> None:
+    """Count variants that couldn't be created as empty results.
+
+    Only the results hash is written: the collector role is left to the
+    first real callback, since nothing else would deliver the set.
+    """
+    pipe = kv.pipeline()
+    pipe.hset(variant_results_key(set_id), values={f"failed-{i}": "" for i in range(count)})
+    pipe.expire(variant_results_key(set_id), ttl)
+    pipe.exec()
+
+def get_variant_progress(set_id: str) -> tuple[dict | None, dict]:
+    """``(meta, results so far)`` of a set in one round trip."""
+    pipe = kv.pipeline()
+    pipe.get(variant_set_key(set_id))
+    pipe.hgetall(variant_results_key(set_id))
+    meta, results = pipe.exec()
+    return (json.loads(meta) if meta else None), results or {}
+
+def save_variant_cards(set_id: str, cards: dict, ttl: int) -> None:
+    kv.set(variant_cards_key(set_id), json.dumps(cards), ex=ttl)
+
+def get_variant_cards(set_id: str) -> dict | None:
+    raw = kv.get(variant_cards_key(set_id))
+    return json.loads(raw) if raw else None
+
+
+# ---------------------------------------------------------------------------
+# Re-render sources — background and text of recent postcards (see bot.rerender)
+# ---------------------------------------------------------------------------
+
+def save_rerender_source(task_id: str, context: dict, blob: str | None, ttl: int) -> None:
+    """Store the drawing context and (if given) the encoded background in one round trip."""
+    pipe = kv.pipeline()
+    pipe.set(rerender_key(task_id), json.dumps(context), ex=ttl)
+    if blob is not None:
+        pipe.set(background_blob_key(task_id), blob, ex=ttl)
+    pipe.exec()
+
+def get_rerender_context(task_id: str) -> dict | None:
+    raw = kv.get(rerender_key(task_id))
+    return json.loads(raw) if raw else None
+
+def get_rerender_source(task_id: str) -> tuple[dict | None, str | None]:
+    """``(context, encoded background)``; either is None once expired."""
+    raw, blob = kv.mget(rerender_key(task_id), background_blob_key(task_id))
+    return (json.loads(raw) if raw else None), blob
+
+def update_rerender_context(task_id: str, context: dict, ttl: int) -> None:
+    kv.set(rerender_key(task_id), json.dumps(context), ex=ttl)
+
+
 # ---------------------------------------------------------------------------
 # Pending image generation tasks (async callback workflow)
 # ---------------------------------------------------------------------------
@@ -234,20 +949,91 @@ def save_pending_image_task(task_id: str, data: dict, ttl: int = 300) -> None:
 
 
 def get_pending_image_task(task_id: str) -> dict | None:
-    """Retrieve and delete pending image generation task data.
+    """Retrieve and delete pending image generation task data (atomic GETDEL).
     
     Returns:
         Dictionary with task data or None if not found
     """
-    key = pending_image_key(task_id)
-    val = kv.get(key)
-    if val:
-        kv.delete(key)
-        if isinstance(val, str):
-            try:
-                return json.loads(val)
-            except Exception:
-                return None
-        if isinstance(val, dict):
-            return val
+    return _decode_task(kv.getdel(pending_image_key(task_id)))
+
+
+def _decode_task(val) -> dict | None:
+    if isinstance(val, str):
+        try:
+            return json.loads(val)
+        except Exception:
+            return None
+    if isinstance(val, dict):
+        return val
     return None
+
+
+# Claim a callback in one round trip: report "done" if the completion marker
+# exists, "missing" if the task is unknown or expired, "busy" if another
+# invocation holds the processing lease; otherwise take the lease and return
+# the task data.
+_CLAIM_IMAGE_TASK_SCRIPT = """
+if redis.call("EXISTS", KEYS[2]) == 1 then
+    return {"done"}
+end
+local data = redis.call("GET", KEYS[1])
+if not data then
+    return {"missing"}
+end
+if not redis.call("SET", KEYS[3], ARGV[1], "NX", "PX", ARGV[2]) then
+    return {"busy"}
+end
+return {"claimed", data}
+"""
+
+@register_script(_CLAIM_IMAGE_TASK_SCRIPT)
+def _claim_image_task_fallback(call, keys, args):
+    if call("EXISTS", keys[1]) == 1:
+        return ["done"]
+    data = call("GET", keys[0])
+    if data is None:
+        return ["missing"]
+    if not call("SET", keys[2], args[0], "NX", "PX", args[1]):
+        return ["busy"]
+    return ["claimed", data]
+
+def claim_pending_image_task(task_id: str, token: str, lease_ms: int = 120_000) -> tuple[str, dict | None]:
+    """Atomically claim a Kie callback for processing.
+
+    Returns ``(status, data)`` where status is "claimed", "done", "missing"
+    or "busy".  Only "claimed" carries the task data; the caller then owns a
+    processing lease and must finish with ``complete_pending_image_task``
+    or hand the task back with ``release_pending_image_task``.
+    """
+    reply = kv.eval(
+        _CLAIM_IMAGE_TASK_SCRIPT,
+        keys=[pending_image_key(task_id), image_task_done_key(task_id), image_task_lease_key(task_id)],
+        args=[token, lease_ms],
+    )
+    status = reply[0]
+    if status != "claimed":
+        return status, None
+    return status, _decode_task(reply[1])
+
+
+def complete_pending_image_task(task_id: str, done_ttl: int = 86_400) -> None:
+    """Mark a Kie task as handled so any redelivery is dropped immediately."""
+    pipe = kv.pipeline()
+    pipe.set(image_task_done_key(task_id), 1, ex=done_ttl)
+    pipe.delete(pending_image_key(task_id))
+    pipe.delete(image_task_lease_key(task_id))
+    pipe.exec()
+
+
+def release_pending_image_task(task_id: str, token: str) -> None:
+    """Give up the processing lease so a retried callback can claim the task again."""
+    release_lock(image_task_lease_key(task_id), token)
+
+
+def is_image_task_open(task_id: str) -> bool:
+    """Whether a Kie task is still waiting to be handled (known and not done)."""
+    pipe = kv.pipeline()
+    pipe.exists(pending_image_key(task_id))
+    pipe.exists(image_task_done_key(task_id))
+    pending, done = pipe.exec()
+    return bool(pending) and not done
@@ -0,0 +1,83 @@
+"""Time budget of one invocation, shared by every outbound call it makes.
+
+A serverless function is killed at its execution limit; independent
+timeouts (ProTalk, Kie, image download with retries) can add up past it and
+the user then gets nothing at all.  Each webhook, Kie callback and worker
+job therefore runs inside ``budget()``, and the calls below it ask for
+their timeout instead of hardcoding one:
+
+    timeout = deadline.timeout("kie_create", 10.0, reserve=2.0)
+
+That is at most 10 s, leaving 2 s of the budget for what follows.  If even
+``minimum`` is not left, ``DeadlineExceeded`` is raised and counted in
+``deadline_exhausted_total{stage}``; optional work catches it and is
+skipped.  Outside a budget (tests, scripts) the caps apply unchanged.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+from bot import metrics
+
+
+class DeadlineExceeded(TimeoutError):
+    """Not enough of the invocation's time budget is left for a call."""
+
+
+@dataclass
+class Deadline:
+    name: str
+    expires_at: float  # time.monotonic()
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+
+_current: ContextVar[Deadline | None] = ContextVar("deadline", default=None)
+
+
+@contextmanager
+def budget(seconds: float, name: str = "unknown"):
+    """Run the block (and the tasks it spawns) with ``seconds`` to spare."""
+    token = _current.set(Deadline(name, time.monotonic() + seconds))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def current() -> Deadline | None:
+    return _current.get()
+
+
+def remaining() -> float | None:
+    """Seconds left in the budget, or None outside one."""
+    deadline = _current.get()
+    return None if deadline is None else deadline.remaining()
+
+
+def ensure(stage: str, seconds: float) -> None:
+    """Raise DeadlineExceeded unless ``seconds`` of the budget are left."""
+    left = remaining()
+    if left is not None and left < seconds:
+        metrics.incr("deadline_exhausted_total", stage=stage)
+        raise DeadlineExceeded(f"timeout: {left:.1f}s left of the budget, {stage} needs {seconds:.1f}s")
+
+
+def timeout(stage: str, cap: float, reserve: float = 0.0, minimum: float = 0.5) -> float:
+    """Timeout for a call at ``stage``: ``cap``, cut to what the budget allows after ``reserve``."""
+    left = remaining()
+    if left is None:
+        return cap
+    ensure(stage, reserve + minimum)
+    return min(cap, left - reserve)
+
+
+def allows(stage: str, seconds: float) -> bool:
+    """Whether optional work needing ``seconds`` fits; a refusal is counted like ``ensure``."""
+    try:
+        ensure(stage, seconds)
+    except DeadlineExceeded:
+        return False
+    return True
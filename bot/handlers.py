@@ -1,25 +1,36 @@
-import os
-import asyncio
 import logging
 import traceback as tb
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command, CommandStart
-from aiogram.types import LabeledPrice, PreCheckoutQuery, CallbackQuery, BufferedInputFile, InlineQueryResultCachedPhoto
+from aiogram.types import (
+    LabeledPrice, PreCheckoutQuery, CallbackQuery, InlineQueryResultCachedPhoto,
+    BufferedInputFile, InputMediaPhoto,
+)
 from aiogram.utils.deep_linking import create_start_link
 
-from bot.config import ADMIN_ID, OCCASIONS, STYLES, FONTS_LIST, PACKAGES, YUKASSA_TOKEN, MAX_CUSTOM_TEXT_LENGTH, TEMPLATE_POSTCARDS
+from bot.config import ADMIN_ID, OCCASIONS, STYLES, FONTS_LIST, PACKAGES, YUKASSA_TOKEN, MAX_CUSTOM_TEXT_LENGTH, TEMPLATE_POSTCARDS, GENERATION_QUEUE, GROUP_MAX_NAMES, RERENDER_MAX_TEXT_LENGTH, VARIANTS_COUNT, KIE_MAX_INFLIGHT
 from bot.database import (
     kv, credits_key, get_credits, set_user_state, get_user_state,
     add_credits, pending_key, pop_pending, save_pending,
     record_new_user, get_total_users, get_total_generations,
-    get_total_revenue, record_payment, get_all_users, is_user_exists,
-    get_postcards
+    get_total_revenue, record_payment, is_user_exists,
+    get_postcards, get_current_broadcast, get_stat_buckets, STATS_DIMENSIONS,
+    save_postcard, get_generation_options, set_variants_enabled, get_variant_cards,
+    add_purchased_credits, kie_queue_depth, get_rerender_context,
 )
+from bot.broadcast import create_broadcast, run_broadcast, format_broadcast_status
 from bot.keyboards import (
     build_occasion_keyboard, build_style_keyboard,
-    build_font_keyboard, build_packages_keyboard, build_text_mode_keyboard
+    build_font_keyboard, build_packages_keyboard, build_text_mode_keyboard,
+    build_rerender_keyboard,
 )
 from bot.services import generate_postcard
+from bot.jobs import queue_depth
+from bot.media import send_static_photo
+from bot.middlewares import release_chat_lock
+from bot.perf import build_perf_report
+from bot.rerender import RerenderUnavailable, rerender
+from bot.scheduled import parse_schedule_time, schedule_postcard
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +47,42 @@ DEFAULT_STATE = {
 }
 
 
+ADDRESSEE_PROMPT = (
+    "Теперь напишите <b>имя адресата</b> (как его вывести на открытке).\n"
+    f"Для группы пришлите до {GROUP_MAX_NAMES} имён, каждое с новой строки — "
+    "фон будет один, открытка с именем для каждого, спишется один кредит."
+)
+
+
+def parse_addressees(text: str) -> list[str]:
+    """Names from the addressee step: one per line, blank lines and duplicates dropped."""
+    names = []
+    for line in text.split("\n"):
+        name = line.strip()
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+def format_period_stats(summary: dict) -> str:
+    """Render today's numbers, the period totals and the top choice per dimension."""
+    _, today, today_dau = summary["days"][0]
+    totals = summary["totals"]
+    lines = [
+        f"📅 <b>Сегодня:</b> {today.get('generations', 0)} открыток, "
+        f"{today_dau} активных, {today.get('new_users', 0)} новых, {today.get('revenue', 0)} руб.",
+        f"🗓 <b>{len(summary['days'])} дней:</b> {totals.get('generations', 0)} открыток, "
+        f"{summary['unique_users']} уникальных, {totals.get('revenue', 0)} руб.",
+    ]
+    for dimension in STATS_DIMENSIONS:
+        prefix = f"{dimension}:"
+        counts = {k[len(prefix):]: v for k, v in totals.items() if k.startswith(prefix)}
+        if counts:
+            top = sorted(counts.items(), key=lambda kv: kv[1], reverse=True)[:3]
+            lines.append(f"• {dimension}: " + ", ".join(f"{name} — {n}" for name, n in top))
+    return "\n".join(lines)
+
+
 def register_handlers(dp: Dispatcher, bot: Bot):
 
     # ---------------- ADMIN PANEL ----------------
@@ -51,10 +98,26 @@ def register_handlers(dp: Dispatcher, bot: Bot):
             f"📊 <b>Статистика проекта:</b>\n\n"
             f"👥 Всего пользователей: <b>{users}</b>\n"
             f"🖼 Сгенерировано открыток: <b>{generations}</b>\n"
-            f"💰 Общая выручка: <b>{revenue} руб.</b>"
+            f"💰 Общая выручка: <b>{revenue} руб.</b>\n\n"
+            + format_period_stats(get_stat_buckets(days=7))
         )
+        if GENERATION_QUEUE:
+            depth = queue_depth()
+            text += (
+                f"\n\n📥 Очередь генерации: <b>{depth['waiting']}</b> ждут, "
+                f"<b>{depth['in_progress']}</b> в работе, {depth['dead']} с ошибкой"
+            )
+        if KIE_MAX_INFLIGHT > 0:
+            waiting, inflight = kie_queue_depth()
+            text += f"\n🎨 Kie: <b>{inflight}</b>/{KIE_MAX_INFLIGHT} в работе, <b>{waiting}</b> в очереди"
         await message.answer(text, parse_mode="HTML")
 
+    @dp.message(Command("perf"))
+    async def admin_perf(message: types.Message):
+        if message.chat.id != ADMIN_ID:
+            return
+        await message.answer(build_perf_report(), parse_mode="HTML")
+
     @dp.message(Command("broadcast"))
     async def admin_broadcast(message: types.Message):
         if message.chat.id != ADMIN_ID:
@@ -63,24 +126,43 @@ def register_handlers(dp: Dispatcher, bot: Bot):
         if not text_to_send:
             await message.answer("Использование: `/broadcast Ваш текст для рассылки`", parse_mode="Markdown")
             return
-        users = get_all_users()
-        if not users:
+        current = get_current_broadcast()
+        if current and current["status"] == "running":
+            await message.answer(
+                f"Рассылка #{current['id']} ещё не завершена. "
+                f"Прогресс: /broadcast_status, продолжить: /broadcast_resume"
+            )
+            return
+        if not get_total_users():
             await message.answer("В базе нет пользователей для рассылки.")
             return
-        await message.answer(f"⏳ Начинаю рассылку для {len(users)} пользователей...")
-        success, failed = 0, 0
-        for uid in users:
-            try:
-                await bot.send_message(uid, text_to_send)
-                success += 1
-                await asyncio.sleep(0.05)
-            except Exception as e:
-                failed += 1
-                logger.warning(f"Failed to send broadcast to {uid}: {e}")
-        await message.answer(
-            f"✅ <b>Рассылка завершена!</b>\n\nУспешно: {success}\nОшибок: {failed}",
-            parse_mode="HTML"
-        )
+        job = create_broadcast(text_to_send)
+        await message.answer(f"⏳ Рассылка #{job['id']} запущена для {job['total']} пользователей...")
+        release_chat_lock()  # the broadcast doesn't touch this chat's state
+        job = await run_broadcast(bot, job["id"])
+        await message.answer(format_broadcast_status(job), parse_mode="HTML")
+
+    @dp.message(Command("broadcast_resume"))
+    async def admin_broadcast_resume(message: types.Message):
+        if message.chat.id != ADMIN_ID:
+            return
+        job = get_current_broadcast()
+        if not job or job["status"] != "running":
+            await message.answer("Нет незавершённой рассылки.")
+            return
+        release_chat_lock()  # the broadcast doesn't touch this chat's state
+        job = await run_broadcast(bot, job["id"])
+        await message.answer(format_broadcast_status(job), parse_mode="HTML")
+
+    @dp.message(Command("broadcast_status"))
+    async def admin_broadcast_status(message: types.Message):
+        if message.chat.id != ADMIN_ID:
+            return
+        job = get_current_broadcast()
+        if not job:
+            await message.answer("Рассылок ещё не было.")
+            return
+        await message.answer(format_broadcast_status(job), parse_mode="HTML")
 
     @dp.message(Command("reset"))
     async def reset_credits(message: types.Message):
@@ -230,6 +312,19 @@ def register_handlers(dp: Dispatcher, bot: Bot):
             parse_mode="HTML",
         )
 
+    @dp.message(Command("variants"))
+    async def toggle_variants(message: types.Message):
+        chat_id = message.chat.id
+        _, enabled = get_generation_options(chat_id)
+        set_variants_enabled(chat_id, not enabled)
+        if enabled:
+            await message.answer("Варианты выключены: нейросеть будет рисовать один фон.")
+        else:
+            await message.answer(
+                f"Варианты включены: нейросеть нарисует {VARIANTS_COUNT} фона, а вы выберете лучший. "
+                f"Спишется один кредит. Выключить — /variants"
+            )
+
     @dp.message(F.text.in_(OCCASIONS))
     async def choose_occasion(message: types.Message):
         chat_id = message.chat.id
@@ -263,12 +358,9 @@ def register_handlers(dp: Dispatcher, bot: Bot):
             st["ai_context"] = None
             st["addressee"] = None
             set_user_state(chat_id, st)
-            preview_path = os.path.join(os.path.dirname(__file__), "..", "fonts", "fonts_preview.jpg")
             try:
-                with open(preview_path, "rb") as f:
-                    preview_bytes = f.read()
-                await message.answer_photo(
-                    photo=BufferedInputFile(preview_bytes, filename="fonts_preview.jpg"),
+                await send_static_photo(
+                    bot, chat_id, "fonts/fonts_preview.jpg",
                     caption="Отлично! Теперь выберите шрифт для надписи:",
                     reply_markup=build_font_keyboard()
                 )
@@ -344,6 +436,81 @@ def register_handlers(dp: Dispatcher, bot: Bot):
             prices=[LabeledPrice(label=pkg["label"], amount=pkg["amount"])],
         )
 
+    # ---------------- RE-RENDER ----------------
+
+    @dp.callback_query(F.data.startswith("rr:"))
+    async def rerender_postcard(query: CallbackQuery):
+        chat_id = query.message.chat.id
+        _, task_id, action, *rest = query.data.split(":")
+        if action == "t":
+            st = get_user_state(chat_id)
+            st["rerender"] = task_id
+            set_user_state(chat_id, st)
+            await query.answer()
+            await query.message.answer(
+                f"Напишите новый текст для открытки (до {RERENDER_MAX_TEXT_LENGTH} символов):"
+            )
+            return
+        font = FONTS_LIST[int(rest[0])]
+        try:
+            card, context = await rerender(task_id, chat_id, font=font)
+        except RerenderUnavailable:
+            await query.answer("Фон этой открытки уже удалён. Создайте новую: /start", show_alert=True)
+            return
+        await query.answer()
+        msg = await query.message.edit_media(
+            InputMediaPhoto(
+                media=BufferedInputFile(card, filename="postcard.jpg"),
+                caption=context["caption"],
+                parse_mode="HTML",
+            ),
+            reply_markup=build_rerender_keyboard(task_id, font),
+        )
+        if isinstance(msg, types.Message) and msg.photo:
+            save_postcard(chat_id, msg.photo[-1].file_id, context["greeting"])
+
+    # ---------------- SCHEDULED ----------------
+
+    @dp.callback_query(F.data.startswith("sc:"))
+    async def schedule_postcard_prompt(query: CallbackQuery):
+        chat_id = query.message.chat.id
+        if not query.message.photo:
+            await query.answer()
+            return
+        st = get_user_state(chat_id)
+        st["schedule"] = {"file_id": query.message.photo[-1].file_id, "task_id": query.data.split(":")[1]}
+        set_user_state(chat_id, st)
+        await query.answer()
+        await query.message.answer(
+            "Когда прислать открытку? Напишите дату и время по Москве, например:\n"
+            "<code>31.12 00:00</code> или <code>08.03.2027 09:00</code>\n\n"
+            "В назначенный момент открытка придёт сюда — останется переслать её адресату.",
+            parse_mode="HTML",
+        )
+
+    @dp.callback_query(F.data.startswith("vp:"))
+    async def pick_variant(query: CallbackQuery):
+        chat_id = query.message.chat.id
+        _, set_id, index = query.data.split(":")
+        variants = get_variant_cards(set_id)
+        if not variants or variants["chat_id"] != chat_id:
+            await query.answer("Эти варианты уже удалены. Создайте новую открытку: /start", show_alert=True)
+            return
+        card = variants["cards"][int(index)]
+        await query.answer()
+        msg = await query.message.answer_photo(
+            card["file_id"],
+            caption=variants["caption"],
+            parse_mode="HTML",
+            reply_markup=build_rerender_keyboard(card["task_id"], variants["font"]),
+        )
+        if msg.photo:
+            save_postcard(chat_id, msg.photo[-1].file_id, variants["greeting"])
+        try:
+            await query.message.edit_text(f"Выбран вариант {int(index) + 1}.")
+        except Exception:
+            pass
+
     @dp.pre_checkout_query()
     async def pre_checkout(q: PreCheckoutQuery):
         await q.answer(ok=True)
@@ -363,7 +530,7 @@ def register_handlers(dp: Dispatcher, bot: Bot):
             await message.answer("Оплата прошла, но пакет не распознан. Напишите /start.")
             return
         record_payment(PACKAGES[n]["rub"])
-        new_credits = add_credits(chat_id, n)
+        new_credits = add_purchased_credits(chat_id, n)
         await message.answer(f"✅ Оплата успешна! Начислено {n} кредитов. Теперь доступно: {new_credits}")
         pending = pop_pending(chat_id)
         if pending:
@@ -383,6 +550,48 @@ def register_handlers(dp: Dispatcher, bot: Bot):
             await message.answer("Текст слишком длинный (макс. 500 символов).")
             return
 
+        # 0. Новый текст для уже готовой открытки (кнопка «Другой текст»)
+        if st.get("rerender"):
+            if len(text_input) > RERENDER_MAX_TEXT_LENGTH:
+                await message.answer(f"Текст слишком длинный (макс. {RERENDER_MAX_TEXT_LENGTH} символов).")
+                return
+            task_id = st.pop("rerender")
+            set_user_state(chat_id, st)
+            try:
+                card, context = await rerender(task_id, chat_id, text=text_input)
+            except RerenderUnavailable:
+                await message.answer("Фон этой открытки уже удалён. Создайте новую: /start")
+                return
+            msg = await message.answer_photo(
+                BufferedInputFile(card, filename="postcard.jpg"),
+                caption=context["caption"],
+                parse_mode="HTML",
+                reply_markup=build_rerender_keyboard(task_id, context["font"]),
+            )
+            if msg.photo:
+                save_postcard(chat_id, msg.photo[-1].file_id, context["greeting"])
+            return
+
+        # 0б. Дата и время отложенной открытки (кнопка «Прислать к празднику»)
+        if st.get("schedule"):
+            due = parse_schedule_time(text_input)
+            if due is None:
+                await message.answer(
+                    "Не получилось разобрать дату. Напишите в формате <code>ДД.ММ ЧЧ:ММ</code> "
+                    "(по Москве, в пределах года), например <code>31.12 00:00</code>.",
+                    parse_mode="HTML",
+                )
+                return
+            target = st.pop("schedule")
+            set_user_state(chat_id, st)
+            context = get_rerender_context(target["task_id"]) or {}
+            caption = "🎉 Сегодня праздник! Ваша открытка готова — перешлите её адресату."
+            if context.get("greeting"):
+                caption += f"\n\n..., {context['greeting']}"
+            schedule_postcard(chat_id, target["file_id"], caption, due)
+            await message.answer(f"✅ Открытка придёт {due:%d.%m.%Y в %H:%M} (мск).")
+            return
+
         # 1. Пользователь вводит название собственного повода
         if st.get("occasion") == "WAITING_CUSTOM_OCCASION":
             if len(text_input) > 50:
@@ -405,7 +614,7 @@ def register_handlers(dp: Dispatcher, bot: Bot):
                 return
             st["ai_context"] = text_input
             set_user_state(chat_id, st)
-            await message.answer("Теперь напишите <b>имя адресата</b> (как его вывести на открытке):", parse_mode="HTML")
+            await message.answer(ADDRESSEE_PROMPT, parse_mode="HTML")
             return
 
         # 3б. Режим Custom: получаем текст поздравления (xранится в ai_context)
@@ -418,14 +627,18 @@ def register_handlers(dp: Dispatcher, bot: Bot):
                 return
             st["ai_context"] = text_input
             set_user_state(chat_id, st)
-            await message.answer("Теперь напишите <b>имя адресата</b> (как его вывести на открытке):", parse_mode="HTML")
+            await message.answer(ADDRESSEE_PROMPT, parse_mode="HTML")
             return
 
         # 4. Ждём имя адресата (для обоих режимов)
         if st.get("addressee") is None:
-            if len(text_input) > 50:
+            names = parse_addressees(text_input)
+            if any(len(name) > 50 for name in names):
                 await message.answer("Имя адресата слишком длинное (макс. 50 символов).")
                 return
+            if len(names) > GROUP_MAX_NAMES:
+                await message.answer(f"Слишком много имён (макс. {GROUP_MAX_NAMES}).")
+                return
             st["addressee"] = text_input
             set_user_state(chat_id, st)
 
@@ -435,10 +648,14 @@ def register_handlers(dp: Dispatcher, bot: Bot):
                 "font": st["font"],
                 "text_mode": st["text_mode"],
                 "text_input": st["ai_context"],  # для ai — контекст, для custom — текст
-                "addressee": text_input,
+                "addressee": ", ".join(names),
             }
+            if len(names) > 1:
+                payload["addressees"] = names  # групповая открытка: один фон на всех
             set_user_state(chat_id, DEFAULT_STATE.copy())
-            credits = get_credits(chat_id)
+            credits, variants = get_generation_options(chat_id)
+            if variants and len(names) == 1:
+                payload["variants"] = VARIANTS_COUNT  # несколько фонов, пользователь выберет один
             if credits > 0:
                 await generate_postcard(chat_id, message, payload, bot)
             else:
@@ -0,0 +1,136 @@
+"""Postcard generation job queue on Redis Streams.
+
+Producers (the webhook routes) append jobs with ``enqueue_job``; workers
+(``bot.worker``) read them through a consumer group, so every job is handed
+to exactly one consumer and stays in the group's pending list until it is
+acknowledged.  Jobs whose consumer died are taken over with XPENDING/XCLAIM
+by ``reclaim_stale_jobs``; jobs that keep failing are moved to a dead-letter
+stream.
+
+Job kinds:
+    create   — ProTalk greeting + Kie task creation for a new postcard
+    complete — Kie callback: download, render, send
+"""
+import json
+import logging
+
+from bot.config import JOB_MAX_DELIVERIES
+from bot.database import kv
+
+logger = logging.getLogger(__name__)
+
+GENERATION_STREAM = "jobs:generation"
+GENERATION_GROUP = "generation-workers"
+DEAD_LETTER_STREAM = "jobs:generation:dead"
+STREAM_MAXLEN = 100_000
+
+
+def _parse_entries(entries) -> list[dict]:
+    """Convert raw ``[[id, [field, value, ...]], ...]`` replies into job dicts."""
+    jobs = []
+    for entry_id, fields in entries or []:
+        if not fields:  # entry was trimmed/deleted while pending
+            jobs.append({"id": entry_id, "kind": None, "data": {}})
+            continue
+        values = dict(zip(fields[::2], fields[1::2]))
+        try:
+            data = json.loads(values.get("data") or "{}")
+        except json.JSONDecodeError:
+            data = {}
+        jobs.append({"id": entry_id, "kind": values.get("kind"), "data": data})
+    return jobs
+
+
+def ensure_group() -> None:
+    """Create the stream and consumer group if they don't exist yet."""
+    try:
+        kv.execute(["XGROUP", "CREATE", GENERATION_STREAM, GENERATION_GROUP, "0", "MKSTREAM"])
+    except Exception as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def enqueue_job(kind: str, data: dict) -> str:
+    """Append a job to the generation stream and return its entry ID."""
+    job_id = kv.execute([
+        "XADD", GENERATION_STREAM, "MAXLEN", "~", str(STREAM_MAXLEN), "*",
+        "kind", kind, "data", json.dumps(data),
+    ])
+    logger.info(f"JOBS: enqueued {kind} job {job_id}")
+    return job_id
+
+
+def read_jobs(consumer: str, count: int = 1) -> list[dict]:
+    """Fetch up to ``count`` new jobs for ``consumer`` (non-blocking)."""
+    reply = kv.execute([
+        "XREADGROUP", "GROUP", GENERATION_GROUP, consumer,
+        "COUNT", str(count), "STREAMS", GENERATION_STREAM, ">",
+    ])
+    if not reply:
+        return []
+    _, entries = reply[0]
+    return _parse_entries(entries)
+
+
+def ack_job(job_id: str) -> None:
+    """Acknowledge and drop a finished job, keeping XLEN equal to the backlog."""
+    pipe = kv.pipeline()
+    pipe.execute(["XACK", GENERATION_STREAM, GENERATION_GROUP, job_id])
+    pipe.execute(["XDEL", GENERATION_STREAM, job_id])
+    pipe.exec()
+
+
+def reclaim_stale_jobs(consumer: str, min_idle_ms: int, count: int = 10) -> list[dict]:
+    """Take over jobs that have been pending longer than ``min_idle_ms``.
+
+    Jobs already delivered ``JOB_MAX_DELIVERIES`` times are copied to the
+    dead-letter stream and acknowledged instead of being retried again.
+    """
+    pending = kv.execute([
+        "XPENDING", GENERATION_STREAM, GENERATION_GROUP,
+        "IDLE", str(min_idle_ms), "-", "+", str(count),
+    ]) or []
+
+    retry_ids = []
+    for entry_id, owner, idle_ms, deliveries in pending:
+        if int(deliveries) >= JOB_MAX_DELIVERIES:
+            entries = kv.execute(["XRANGE", GENERATION_STREAM, entry_id, entry_id])
+            for job in _parse_entries(entries):
+                kv.execute([
+                    "XADD", DEAD_LETTER_STREAM, "MAXLEN", "~", "10000", "*",
+                    "kind", job["kind"] or "", "data", json.dumps(job["data"]),
+                    "source_id", entry_id, "deliveries", str(deliveries),
+                ])
+            ack_job(entry_id)
+            logger.error(f"JOBS: job {entry_id} failed {deliveries} times, moved to dead-letter")
+        else:
+            retry_ids.append(entry_id)
+
+    if not retry_ids:
+        return []
+    claimed = kv.execute([
+        "XCLAIM", GENERATION_STREAM, GENERATION_GROUP, consumer, str(min_idle_ms), *retry_ids,
+    ])
+    jobs = [job for job in _parse_entries(claimed) if job["kind"]]
+    if jobs:
+        logger.warning(f"JOBS: {consumer} reclaimed {len(jobs)} stale job(s)")
+    return jobs
+
+
+def queue_depth() -> dict:
+    """Return backlog figures: jobs waiting, jobs in progress, dead-lettered."""
+    pipe = kv.pipeline()
+    pipe.execute(["XLEN", GENERATION_STREAM])
+    pipe.execute(["XPENDING", GENERATION_STREAM, GENERATION_GROUP])
+    pipe.execute(["XLEN", DEAD_LETTER_STREAM])
+    try:
+        length, pending_summary, dead = pipe.exec()
+    except Exception as e:  # group not created yet
+        logger.info(f"JOBS: queue depth unavailable: {e}")
+        return {"waiting": 0, "in_progress": 0, "dead": 0}
+    in_progress = int(pending_summary[0]) if pending_summary else 0
+    return {
+        "waiting": max(int(length or 0) - in_progress, 0),
+        "in_progress": in_progress,
+        "dead": int(dead or 0),
+    }
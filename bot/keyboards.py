@@ -50,6 +50,25 @@ def build_packages_keyboard() -> InlineKeyboardMarkup:
         )])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+def build_rerender_keyboard(task_id: str, current_font: str) -> InlineKeyboardMarkup:
+    """Buttons under a delivered postcard: other fonts and a new text, redrawn locally."""
+    fonts = [
+        InlineKeyboardButton(text=f"🔤 {name}", callback_data=f"rr:{task_id}:f:{i}")
+        for i, name in enumerate(FONTS_LIST) if name != current_font
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=[
+        fonts,
+        [InlineKeyboardButton(text="✏️ Другой текст", callback_data=f"rr:{task_id}:t")],
+        [InlineKeyboardButton(text="⏰ Прислать к празднику", callback_data=f"sc:{task_id}")],
+    ])
+
+def build_variant_keyboard(set_id: str, count: int) -> InlineKeyboardMarkup:
+    """One button per delivered background variant."""
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=f"Вариант {i + 1}", callback_data=f"vp:{set_id}:{i}")
+        for i in range(count)
+    ]])
+
 def build_text_mode_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[
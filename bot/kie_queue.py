@@ -0,0 +1,86 @@
+"""Kie submission scheduler: a global cap on in-flight Kie tasks.
+
+Every Kie task takes a slot from KIE_MAX_INFLIGHT, shared by all instances
+through Redis, from its creation until its callback (or KIE_SLOT_TTL, for
+callbacks that never come).  Submissions beyond the cap wait in a sorted
+set: users who bought a package go first, and within a tier each user's
+second waiting submission goes after everybody's first, so one user's
+burst can't starve the rest.  Waiters poll with backoff, report their
+position to the caller and give up after KIE_QUEUE_TIMEOUT, or earlier
+when the invocation's time budget (``bot.deadline``) runs low.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from typing import Awaitable, Callable
+
+from bot import deadline, metrics
+from bot.config import KIE_MAX_INFLIGHT, KIE_QUEUE_TIMEOUT, KIE_SLOT_TTL
+from bot.database import admit_kie_ticket, enqueue_kie_ticket, leave_kie_queue, release_kie_slot
+
+logger = logging.getLogger(__name__)
+
+_POLL_INITIAL = 0.25
+_POLL_MAX = 2.0
+_STALE_MS = 30_000  # a waiter silent this long is considered gone
+_CREATE_RESERVE = 3.0  # seconds of the invocation budget kept for creating the task
+
+
+class KieQueueTimeout(Exception):
+    """No Kie slot became free within KIE_QUEUE_TIMEOUT."""
+
+
+async def acquire_slot(
+    user_id: int, on_position: Callable[[int], Awaitable[None]] | None = None
+) -> str | None:
+    """Wait for a Kie slot; returns the ticket to pass to ``release_slot``.
+
+    ``on_position`` is awaited whenever the user's queue position changes.
+    Returns None if the queue is disabled.
+    """
+    if KIE_MAX_INFLIGHT <= 0:
+        return None
+    ticket = f"{user_id}:{uuid.uuid4().hex[:12]}"
+    started = time.perf_counter()
+    paid = await asyncio.to_thread(enqueue_kie_ticket, user_id, ticket)
+    tier = "paid" if paid else "free"
+    delay, last_position = _POLL_INITIAL, None
+    try:
+        while True:
+            position = await asyncio.to_thread(
+                admit_kie_ticket, user_id, ticket, KIE_MAX_INFLIGHT, KIE_SLOT_TTL * 1000, _STALE_MS
+            )
+            if position == 0:
+                break
+            if position < 0:  # dropped as abandoned after a long stall: queue again
+                await asyncio.to_thread(enqueue_kie_ticket, user_id, ticket)
+                continue
+            if time.perf_counter() - started >= KIE_QUEUE_TIMEOUT:
+                metrics.incr("kie_queue_total", tier=tier, outcome="timeout")
+                raise KieQueueTimeout(f"Kie queue timeout at position {position}")
+            deadline.ensure("kie_queue", _CREATE_RESERVE + delay)
+            if on_position and position != last_position:
+                last_position = position
+                try:
+                    await on_position(position)
+                except Exception as e:
+                    logger.warning(f"KIE QUEUE: position update failed: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, _POLL_MAX)
+    except BaseException:
+        await asyncio.to_thread(leave_kie_queue, user_id, ticket)
+        raise
+
+    waited = time.perf_counter() - started
+    metrics.observe("postcard_stage_seconds", waited, stage="kie_queue")
+    metrics.observe("kie_queue_wait_seconds", waited, tier=tier)
+    metrics.incr("kie_queue_total", tier=tier, outcome="admitted")
+    if last_position:
+        logger.info(f"KIE QUEUE: {ticket} ({tier}) admitted after {waited:.1f}s, was #{last_position}")
+    return ticket
+
+
+def release_slot(ticket: str | None) -> None:
+    if ticket:
+        release_kie_slot(ticket)
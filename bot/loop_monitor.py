@@ -0,0 +1,128 @@
+"""Opt-in event-loop stall detector (LOOP_MONITOR_ENABLED=1).
+
+The database client is synchronous and rendering runs inline, so a slow
+Redis call or a large image can freeze the whole loop.  Two parts find out
+who did it:
+
+* a heartbeat task sleeps for a short interval and measures how late it
+  wakes up — lateness above LOOP_STALL_THRESHOLD is a stall;
+* a watchdog thread notices a missing heartbeat while the loop is still
+  blocked and samples the loop thread's stack.
+
+The sample is attributed to the innermost frame from our own packages
+(e.g. ``apply_text_to_image`` or ``get_user_state``) and to the outermost
+``bot.handlers`` frame (e.g. ``choose_style``).  Each stall increments
+``loop_stalls_total{source,handler}`` and ``loop_stall_seconds``; with
+LOOP_STALL_CAPTURE_STACKS=1 the sampled stack is logged as well.
+
+asyncio's own slow-callback logging is switched on too when
+LOOP_MONITOR_ASYNCIO_DEBUG=1 (debug mode has a noticeable overhead).
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+from bot import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PACKAGES = ("bot.", "api.")
+
+
+def attribute_frame(frame, packages: tuple[str, ...] = DEFAULT_PACKAGES) -> tuple[str, str]:
+    """Return ``(source, handler)`` for a sampled stack.
+
+    ``source`` is the innermost function from ``packages``; ``handler`` is
+    the outermost ``bot.handlers`` function.  Either is "unknown" if absent.
+    """
+    source = handler = None
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module.startswith(packages) or module in packages:
+            if source is None:
+                source = frame.f_code.co_name
+            if module == "bot.handlers":
+                handler = frame.f_code.co_name
+        frame = frame.f_back
+    return source or "unknown", handler or "unknown"
+
+
+class LoopMonitor:
+    def __init__(
+        self,
+        threshold: float = 0.1,
+        capture_stacks: bool = False,
+        packages: tuple[str, ...] = DEFAULT_PACKAGES,
+    ):
+        self.threshold = threshold
+        self.interval = max(threshold / 2, 0.01)
+        self.capture_stacks = capture_stacks
+        self.packages = packages
+        self.stalls: Counter = Counter()  # (source, handler) -> stalls
+        self._beat = time.monotonic()
+        self._sample: tuple[str, str, str | None] | None = None
+        self._loop_thread_id: int | None = None
+        self._task: asyncio.Task | None = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self, asyncio_debug: bool = False) -> None:
+        """Start monitoring the running loop (call from inside it)."""
+        loop = asyncio.get_running_loop()
+        loop.slow_callback_duration = self.threshold
+        if asyncio_debug:
+            loop.set_debug(True)
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = loop.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-monitor", daemon=True)
+        self._thread.start()
+        logger.info(f"LOOP MONITOR: started, threshold={self.threshold * 1000:.0f}ms")
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._thread:
+            self._thread.join(timeout=1)
+
+    async def _heartbeat(self) -> None:
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - self._beat - self.interval
+            if lag >= self.threshold:
+                self._record(lag)
+            else:
+                self._sample = None
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.interval / 2):
+            blocked_for = time.monotonic() - self._beat - self.interval
+            if blocked_for < self.threshold or self._sample is not None:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            source, handler = attribute_frame(frame, self.packages)
+            stack = "".join(traceback.format_stack(frame)) if self.capture_stacks else None
+            self._sample = (source, handler, stack)
+
+    def _record(self, lag: float) -> None:
+        source, handler, stack = self._sample or ("unknown", "unknown", None)
+        self._sample = None
+        self.stalls[(source, handler)] += 1
+        metrics.incr("loop_stalls_total", source=source, handler=handler)
+        metrics.observe("loop_stall_seconds", lag, source=source)
+        logger.warning(f"LOOP MONITOR: loop blocked {lag * 1000:.0f}ms in {source} (handler {handler})")
+        if stack:
+            logger.warning(f"LOOP MONITOR: sampled stack:\n{stack}")
@@ -0,0 +1,76 @@
+"""Registry of bundled images uploaded to Telegram once and reused by file_id.
+
+The first send of an asset uploads its bytes; the ``file_id`` Telegram
+returns is stored in Redis under the SHA-256 of the file contents.  Every
+later send — from any instance — is just a file_id reference.  Editing the
+file changes its hash, so the new version is uploaded automatically.
+"""
+import hashlib
+import logging
+import os
+
+from aiogram import Bot, types
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile
+
+from bot.database import get_media_file_id, set_media_file_id, delete_media_file_id
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+# path -> ((mtime, size), digest); digest -> file_id
+_digests: dict[str, tuple[tuple[float, int], str]] = {}
+_file_ids: dict[str, str] = {}
+
+
+def asset_path(rel_path: str) -> str:
+    return os.path.join(PROJECT_ROOT, rel_path)
+
+
+def asset_digest(rel_path: str) -> str:
+    """Content hash of a bundled asset, recomputed only when the file changes."""
+    path = asset_path(rel_path)
+    st = os.stat(path)
+    stamp = (st.st_mtime, st.st_size)
+    cached = _digests.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:32]
+    _digests[path] = (stamp, digest)
+    return digest
+
+
+async def send_static_photo(bot: Bot, chat_id: int, rel_path: str, **kwargs) -> types.Message:
+    """Send a bundled image, uploading it only if Telegram doesn't have it yet.
+
+    ``rel_path`` is relative to the project root (e.g. "fonts/fonts_preview.jpg");
+    extra keyword arguments go to ``send_photo`` (caption, reply_markup, ...).
+    """
+    digest = asset_digest(rel_path)
+    file_id = _file_ids.get(digest) or get_media_file_id(digest)
+    if file_id:
+        try:
+            msg = await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+            _file_ids[digest] = file_id
+            return msg
+        except TelegramBadRequest as e:
+            # e.g. the bot token changed and the old file_id is no longer valid
+            logger.warning(f"MEDIA: cached file_id for {rel_path} rejected ({e}), re-uploading")
+            _file_ids.pop(digest, None)
+            delete_media_file_id(digest)
+
+    with open(asset_path(rel_path), "rb") as f:
+        data = f.read()
+    msg = await bot.send_photo(
+        chat_id=chat_id,
+        photo=BufferedInputFile(data, filename=os.path.basename(rel_path)),
+        **kwargs,
+    )
+    if msg and msg.photo:
+        file_id = msg.photo[-1].file_id
+        set_media_file_id(digest, file_id)
+        _file_ids[digest] = file_id
+        logger.info(f"MEDIA: uploaded {rel_path} ({len(data)} bytes), file_id cached")
+    return msg
@@ -0,0 +1,349 @@
+"""Metrics: counters and latency histograms, per process and across instances.
+
+Values are recorded in module-level dicts for the lifetime of the process
+(one serverless instance).  Histograms use fixed buckets, so instances can
+be merged by adding bucket counts: ``flush_to_redis`` pushes the deltas
+recorded since the previous flush into Redis hashes with one pipeline, and
+``render_prometheus`` renders either the local or the aggregated view in
+the Prometheus text exposition format.
+
+The same flush also adds the deltas to time-bucketed rollup hashes (1 min,
+5 min and 1 h buckets with TTLs), so recent windows can be read back with
+``load_windows`` in a single pipeline.
+
+Metric series are identified by a name plus optional labels, e.g.
+``observe("postcard_stage_seconds", 0.42, stage="render")``.
+"""
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "pozdravish_"
+
+# Upper bounds in seconds; the last bucket catches everything else.
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, math.inf,
+)
+
+REDIS_INDEX_KEY = "metrics:index"
+REDIS_COUNTERS_KEY = "metrics:counters"
+FLUSH_INTERVAL = 10.0  # seconds between automatic flushes to Redis
+
+# Rollup tiers: bucket size in seconds -> how long a bucket is kept
+ROLLUP_TIERS = {
+    60: 15 * 60,
+    300: 2 * 3600,
+    3600: 26 * 3600,
+}
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def merge(self, counts: list[int], total: float) -> None:
+        for i, c in enumerate(counts):
+            self.counts[i] += c
+        self.count += sum(counts)
+        self.sum += total
+
+    def quantile(self, q: float) -> float | None:
+        """Estimate the ``q`` quantile by linear interpolation inside its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, c in zip(self.buckets, self.counts):
+            if c and seen + c >= rank:
+                if math.isinf(bound):
+                    return lower  # open-ended bucket: report its lower edge
+                return lower + (bound - lower) * (rank - seen) / c
+            seen += c
+            lower = bound
+        return lower
+
+
+SeriesKey = tuple[str, tuple[tuple[str, str], ...]]
+
+_lock = threading.Lock()
+_counters: dict[SeriesKey, float] = {}
+_histograms: dict[SeriesKey, Histogram] = {}
+# Deltas not yet pushed to Redis
+_pending_counters: dict[SeriesKey, float] = {}
+_pending_histograms: dict[SeriesKey, Histogram] = {}
+_last_flush = time.monotonic()
+
+
+def _key(name: str, labels: dict) -> SeriesKey:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def incr(name: str, amount: float = 1, **labels) -> None:
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+        _pending_counters[key] = _pending_counters.get(key, 0) + amount
+
+
+def observe(name: str, seconds: float, **labels) -> None:
+    key = _key(name, labels)
+    with _lock:
+        for store in (_histograms, _pending_histograms):
+            hist = store.get(key)
+            if hist is None:
+                hist = store[key] = Histogram()
+            hist.observe(seconds)
+
+
+@contextmanager
+def timed(name: str, **labels):
+    """Observe the wall-clock duration of the ``with`` block under ``name``."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def snapshot() -> dict:
+    """Return a JSON-friendly copy of all local counters and histogram summaries."""
+    with _lock:
+        return {
+            "counters": {_series_name(k): v for k, v in _counters.items()},
+            "histograms": {
+                _series_name(k): {"count": h.count, "sum": h.sum, "counts": list(h.counts)}
+                for k, h in _histograms.items()
+            },
+        }
+
+
+def reset() -> None:
+    with _lock:
+        for store in (_counters, _histograms, _pending_counters, _pending_histograms):
+            store.clear()
+
+
+# ---------------------------------------------------------------------------
+# Cross-instance aggregation in Redis
+#
+#   metrics:index              set of series ids that have histogram data
+#   metrics:hist:{series}      hash: b0..bN bucket counts, "sum"
+#   metrics:counters           hash: series id -> value
+#   metrics:roll:{size}:{n}    hash for bucket n of the given size (seconds):
+#                              "c|{series}" counters, "h|{series}|b{i}" and
+#                              "h|{series}|sum" histograms; expires per tier
+# ---------------------------------------------------------------------------
+
+def _series_name(key: SeriesKey) -> str:
+    name, labels = key
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def _parse_series(series: str) -> SeriesKey:
+    if "{" not in series:
+        return series, ()
+    name, rest = series.split("{", 1)
+    labels = []
+    for part in rest.rstrip("}").split(","):
+        k, v = part.split("=", 1)
+        labels.append((k, v.strip('"')))
+    return name, tuple(labels)
+
+
+def flush_to_redis(force: bool = False) -> bool:
+    """Push pending deltas to Redis in one pipeline.
+
+    Without ``force`` this is a no-op until FLUSH_INTERVAL has passed since
+    the previous flush.  Returns True if anything was written.
+    """
+    global _last_flush
+    now = time.monotonic()
+    with _lock:
+        if not force and now - _last_flush < FLUSH_INTERVAL:
+            return False
+        if not _pending_counters and not _pending_histograms:
+            _last_flush = now
+            return False
+        counters = dict(_pending_counters)
+        histograms = dict(_pending_histograms)
+        _pending_counters.clear()
+        _pending_histograms.clear()
+        _last_flush = now
+
+    from bot.database import kv
+
+    pipe = kv.client.pipeline()  # bypass the proxy so flushes aren't counted as app traffic
+    for key, value in counters.items():
+        pipe.hincrbyfloat(REDIS_COUNTERS_KEY, _series_name(key), value)
+    for key, hist in histograms.items():
+        series = _series_name(key)
+        pipe.sadd(REDIS_INDEX_KEY, series)
+        for i, c in enumerate(hist.counts):
+            if c:
+                pipe.hincrby(f"metrics:hist:{series}", f"b{i}", c)
+        pipe.hincrbyfloat(f"metrics:hist:{series}", "sum", hist.sum)
+
+    wall = time.time()
+    for size, ttl in ROLLUP_TIERS.items():
+        bucket_key = rollup_key(size, int(wall // size))
+        for key, value in counters.items():
+            pipe.hincrbyfloat(bucket_key, f"c|{_series_name(key)}", value)
+        for key, hist in histograms.items():
+            series = _series_name(key)
+            for i, c in enumerate(hist.counts):
+                if c:
+                    pipe.hincrby(bucket_key, f"h|{series}|b{i}", c)
+            pipe.hincrbyfloat(bucket_key, f"h|{series}|sum", hist.sum)
+        pipe.expire(bucket_key, ttl)
+    try:
+        pipe.exec()
+    except Exception as e:
+        logger.warning(f"METRICS: flush to Redis failed, deltas dropped: {e}")
+        return False
+    return True
+
+
+def load_from_redis() -> tuple[dict[SeriesKey, float], dict[SeriesKey, Histogram]]:
+    """Read the aggregated counters and histograms of all instances."""
+    from bot.database import kv
+
+    series_ids = list(kv.client.smembers(REDIS_INDEX_KEY) or [])
+    pipe = kv.client.pipeline()
+    pipe.hgetall(REDIS_COUNTERS_KEY)
+    for series in series_ids:
+        pipe.hgetall(f"metrics:hist:{series}")
+    results = pipe.exec()
+
+    counters = {_parse_series(k): float(v) for k, v in (results[0] or {}).items()}
+    histograms = {}
+    for series, fields in zip(series_ids, results[1:]):
+        fields = fields or {}
+        hist = Histogram()
+        hist.merge(
+            [int(fields.get(f"b{i}", 0)) for i in range(len(hist.buckets))],
+            float(fields.get("sum", 0)),
+        )
+        histograms[_parse_series(series)] = hist
+    return counters, histograms
+
+
+def rollup_key(size: int, n: int) -> str:
+    return f"metrics:roll:{size}:{n}"
+
+
+def _window_tier(seconds: int) -> int:
+    """Pick the coarsest tier that still gives at least 5 buckets per window."""
+    fitting = [size for size in ROLLUP_TIERS if seconds // size >= 5]
+    return max(fitting) if fitting else min(ROLLUP_TIERS)
+
+
+def load_windows(
+    windows: list[int], now: float | None = None,
+) -> dict[int, tuple[dict[SeriesKey, float], dict[SeriesKey, Histogram]]]:
+    """Aggregate the rollup buckets covering each window (in seconds).
+
+    All buckets of all windows are read in one pipeline.  A window covers
+    whole buckets, so it may include up to one bucket more than asked.
+    """
+    from bot.database import kv
+
+    now = now or time.time()
+    plan = {}
+    pipe = kv.client.pipeline()
+    for window in windows:
+        size = _window_tier(window)
+        last = int(now // size)
+        first = int((now - window) // size)
+        plan[window] = last - first + 1
+        for n in range(first, last + 1):
+            pipe.hgetall(rollup_key(size, n))
+    results = iter(pipe.exec())
+
+    loaded = {}
+    for window in windows:
+        counters: dict[SeriesKey, float] = {}
+        hist_fields: dict[str, dict[str, float]] = {}
+        for _ in range(plan[window]):
+            for field, value in (next(results) or {}).items():
+                kind, _, rest = field.partition("|")
+                if kind == "c":
+                    key = _parse_series(rest)
+                    counters[key] = counters.get(key, 0) + float(value)
+                elif kind == "h":
+                    series, _, part = rest.rpartition("|")
+                    fields = hist_fields.setdefault(series, {})
+                    fields[part] = fields.get(part, 0) + float(value)
+        histograms = {}
+        for series, fields in hist_fields.items():
+            hist = Histogram()
+            hist.merge(
+                [int(fields.get(f"b{i}", 0)) for i in range(len(hist.buckets))],
+                fields.get("sum", 0.0),
+            )
+            histograms[_parse_series(series)] = hist
+        loaded[window] = (counters, histograms)
+    return loaded
+
+
+# ---------------------------------------------------------------------------
+# Prometheus text exposition
+# ---------------------------------------------------------------------------
+
+def _labels_text(labels: tuple, extra: tuple = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def render_prometheus(
+    counters: dict[SeriesKey, float] | None = None,
+    histograms: dict[SeriesKey, Histogram] | None = None,
+) -> str:
+    """Render metrics in Prometheus text format (local values by default)."""
+    if counters is None or histograms is None:
+        with _lock:
+            counters = dict(_counters)
+            histograms = {k: h for k, h in _histograms.items()}
+
+    lines = []
+    for name in sorted({k[0] for k in counters}):
+        metric = PREFIX + name
+        lines.append(f"# TYPE {metric} counter")
+        for (n, labels), value in sorted(counters.items()):
+            if n == name:
+                lines.append(f"{metric}{_labels_text(labels)} {value:g}")
+
+    for name in sorted({k[0] for k in histograms}):
+        metric = PREFIX + name
+        lines.append(f"# TYPE {metric} histogram")
+        for (n, labels), hist in sorted(histograms.items(), key=lambda kv: kv[0]):
+            if n != name:
+                continue
+            cumulative = 0
+            for bound, c in zip(hist.buckets, hist.counts):
+                cumulative += c
+                le = "+Inf" if math.isinf(bound) else f"{bound:g}"
+                lines.append(f"{metric}_bucket{_labels_text(labels, (('le', le),))} {cumulative}")
+            lines.append(f"{metric}_sum{_labels_text(labels)} {hist.sum:.6f}")
+            lines.append(f"{metric}_count{_labels_text(labels)} {hist.count}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,156 @@
+"""Dispatcher middlewares."""
+import asyncio
+import logging
+import time
+import uuid
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from bot.config import CHAT_LOCK_TTL_MS, CHAT_LOCK_MAX_WAIT
+from bot.database import acquire_lock, release_lock, chat_lock_key
+from bot import metrics, redis_usage
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _ChatLease:
+    key: str
+    token: str
+    released: bool = False
+
+
+_current_lease: ContextVar[_ChatLease | None] = ContextVar("chat_lease", default=None)
+
+
+def release_chat_lock() -> None:
+    """Release the current update's chat lock before the handler returns.
+
+    Handlers call this once the chat's state is written and only slow
+    outbound work is left (ProTalk, the Kie queue and task creation), so
+    the user's next update doesn't wait behind it.  No-op outside a lock.
+    """
+    lease = _current_lease.get()
+    if lease is not None:
+        _release(lease)
+
+
+def _release(lease: _ChatLease) -> None:
+    if lease.released:
+        return
+    lease.released = True
+    try:
+        release_lock(lease.key, lease.token)
+    except Exception as e:
+        logger.warning(f"CHAT LOCK: release failed for {lease.key}: {e}")
+
+
+class ChatSerializationMiddleware(BaseMiddleware):
+    """Handle updates from the same chat one at a time, across all instances.
+
+    Each update takes a Redis lease on ``lock:chat:{chat_id}`` before the
+    handlers run, so two quick messages from one user can no longer both
+    read the wizard state and overwrite each other.  Different chats never
+    wait on each other.  Inline queries are read-only and skip the lock.
+
+    The guarantee is mutual exclusion of the state read-modify-write, not
+    arrival order: waiters poll, so of two updates queued behind a holder
+    either may go first.  The lease covers the handler until it returns or
+    calls ``release_chat_lock`` ahead of slow outbound work, which keeps it
+    well within CHAT_LOCK_TTL_MS.  The wait is bounded by at least the TTL,
+    so a lease left by a dead holder is always taken over; an update that
+    still can't get the lock (the chat is flooding) is not processed
+    unlocked — the user is asked to resend it.  Only if the lock store is
+    unavailable does the update run unlocked.
+    """
+
+    def __init__(self, ttl_ms: int = CHAT_LOCK_TTL_MS, max_wait: float = CHAT_LOCK_MAX_WAIT):
+        self.ttl_ms = ttl_ms
+        self.max_wait = max_wait
+
+    async def _acquire(self, key: str, token: str) -> bool:
+        deadline = time.monotonic() + self.max_wait
+        delay = 0.025
+        while True:
+            if acquire_lock(key, token, self.ttl_ms):
+                return True
+            if time.monotonic() + delay > deadline:
+                return False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+
+    @staticmethod
+    async def _ask_to_resend(event: Update, data: dict[str, Any], chat_id: int) -> None:
+        text = "⏳ Ещё обрабатываю предыдущее сообщение — отправьте это, пожалуйста, ещё раз."
+        try:
+            if event.callback_query is not None:
+                await event.callback_query.answer(text, show_alert=True)
+            elif data.get("bot") is not None:
+                await data["bot"].send_message(chat_id, text)
+        except Exception as e:
+            logger.warning(f"CHAT LOCK: could not notify chat {chat_id}: {e}")
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: dict[str, Any],
+    ) -> Any:
+        chat = data.get("event_chat")
+        user = data.get("event_from_user")
+        chat_id = chat.id if chat else (user.id if user else None)
+        if chat_id is None or event.inline_query is not None:
+            return await handler(event, data)
+
+        key = chat_lock_key(chat_id)
+        token = uuid.uuid4().hex
+        started = time.perf_counter()
+        try:
+            acquired = await self._acquire(key, token)
+        except Exception as e:
+            logger.warning(f"CHAT LOCK: unavailable for chat {chat_id}, processing unlocked: {e}")
+            return await handler(event, data)
+        waited = time.perf_counter() - started
+        metrics.observe("chat_lock_wait_seconds", waited)
+        if not acquired:
+            metrics.incr("chat_lock_timeouts_total")
+            logger.warning(f"CHAT LOCK: gave up after {waited:.2f}s for chat {chat_id}, update skipped")
+            await self._ask_to_resend(event, data, chat_id)
+            return None
+        if waited > 0.05:
+            logger.info(f"CHAT LOCK: chat {chat_id} waited {waited:.2f}s")
+
+        lease = _ChatLease(key, token)
+        lease_token = _current_lease.set(lease)
+        try:
+            return await handler(event, data)
+        finally:
+            _current_lease.reset(lease_token)
+            _release(lease)
+
+
+class HandlerTagMiddleware(BaseMiddleware):
+    """Attribute the update's storage round trips to the handler that runs it."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        if handler_object is not None:
+            redis_usage.set_handler(getattr(handler_object.callback, "__name__", "unknown"))
+        return await handler(event, data)
+
+
+def install_handler_tags(dp) -> None:
+    """Register ``HandlerTagMiddleware`` on every event observer of the dispatcher."""
+    tagger = HandlerTagMiddleware()
+    for name, observer in dp.observers.items():
+        if name not in ("update", "error"):
+            observer.middleware(tagger)
@@ -0,0 +1,90 @@
+"""Admin ``/perf`` report: latency percentiles and error rates over recent windows.
+
+Everything comes from the metrics rollup buckets (see ``bot.metrics``), so
+building the report costs one Redis pipeline, plus one for the generation
+queue depth when the queue is enabled.
+"""
+from bot import metrics
+from bot.config import GENERATION_QUEUE
+
+PERF_WINDOWS = (
+    (300, "5 мин"),
+    (3600, "1 час"),
+    (86400, "24 часа"),
+)
+
+STAGES = (
+    "protalk", "kie_queue", "kie_create", "kie_wait", "download", "render", "group_card", "send_photo", "end_to_end",
+    "rerender", "preview", "first_pixel", "schedule_lag",
+)
+
+
+def _fmt_seconds(value: float | None) -> str:
+    if value is None:
+        return "—"
+    return f"{value * 1000:.0f}мс" if value < 1 else f"{value:.1f}с"
+
+
+def _rate(part: float, total: float) -> str:
+    return f"{part / total:.1%}" if total else "—"
+
+
+def _sum_counter(counters: dict, name: str, **labels) -> float:
+    """Sum a counter across series, optionally restricted to matching labels."""
+    wanted = {(k, str(v)) for k, v in labels.items()}
+    return sum(v for (n, lbls), v in counters.items() if n == name and wanted <= set(lbls))
+
+
+def _round_trips_by_handler(counters: dict, top: int = 3) -> str:
+    """The handlers with the most Redis round trips per invocation."""
+    averages = []
+    for (name, labels), tracked in counters.items():
+        if name == "redis_tracked_total" and tracked:
+            handler = dict(labels).get("handler", "unknown")
+            trips = _sum_counter(counters, "redis_round_trips_total", handler=handler)
+            averages.append((trips / tracked, handler))
+    averages.sort(reverse=True)
+    return " · ".join(f"{handler} {avg:.1f}" for avg, handler in averages[:top])
+
+
+def format_window(title: str, counters: dict, histograms: dict) -> str:
+    lines = [f"⏱ <b>{title}</b>"]
+    for stage in STAGES:
+        hist = histograms.get(("postcard_stage_seconds", (("stage", stage),)))
+        if not hist or not hist.count:
+            continue
+        lines.append(
+            f"<code>{stage:<10}</code> p50 {_fmt_seconds(hist.quantile(0.5))} · "
+            f"p95 {_fmt_seconds(hist.quantile(0.95))} · "
+            f"p99 {_fmt_seconds(hist.quantile(0.99))} (n={hist.count})"
+        )
+    if len(lines) == 1:
+        lines.append("нет генераций")
+
+    protalk = _sum_counter(counters, "protalk_requests_total")
+    fallback = _sum_counter(counters, "protalk_requests_total", result="fallback")
+    kie = _sum_counter(counters, "kie_tasks_total")
+    kie_failed = kie - _sum_counter(counters, "kie_tasks_total", outcome="success")
+    updates = _sum_counter(counters, "webhook_updates_total")
+    redis_calls = _sum_counter(counters, "redis_calls_total")
+    per_update = f"{redis_calls / updates:.1f}" if updates else "—"
+    lines.append(f"ProTalk fallback: {_rate(fallback, protalk)} · Kie ошибки: {_rate(kie_failed, kie)}")
+    lines.append(f"Апдейтов: {updates:g} · Redis-вызовов на апдейт: {per_update}")
+    by_handler = _round_trips_by_handler(counters)
+    if by_handler:
+        lines.append(f"Redis на вызов: {by_handler}")
+    lines.append(f"Сбросов счётчиков: {_sum_counter(counters, 'counter_flushes_total'):g}")
+    return "\n".join(lines)
+
+
+def build_perf_report() -> str:
+    windows = metrics.load_windows([seconds for seconds, _ in PERF_WINDOWS])
+    blocks = [format_window(title, *windows[seconds]) for seconds, title in PERF_WINDOWS]
+    if GENERATION_QUEUE:
+        from bot.jobs import queue_depth
+        depth = queue_depth()
+        blocks.append(
+            f"📥 Очередь: {depth['waiting']} ждут, {depth['in_progress']} в работе, "
+            f"{depth['dead']} с ошибкой"
+        )
+    return "📈 <b>Производительность</b>\n\n" + "\n\n".join(blocks)
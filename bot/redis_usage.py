@@ -0,0 +1,64 @@
+"""Storage round trips per Telegram update and per Kie callback.
+
+Handler latency is dominated by the number of sequential Redis calls (each
+one an HTTPS request on Upstash).  Every invocation runs inside ``track()``;
+commands sent through ``bot.database.kv`` then add one round trip and one
+operation each, and a pipeline adds one round trip for all the operations
+it queued.  When the invocation ends the totals are recorded per handler:
+
+    redis_round_trips_total{handler}   round trips
+    redis_ops_total{handler}           operations (pipelined ones included)
+    redis_tracked_total{handler}       invocations
+
+The handler starts as the name given to ``track()`` and is replaced by the
+aiogram handler that ran (see ``HandlerTagMiddleware``).  The budgets per
+wizard step are enforced by tests/test_redis_budget.py.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+from bot import metrics
+
+
+@dataclass
+class RedisUsage:
+    handler: str
+    round_trips: int = 0
+    ops: int = 0
+
+
+_current: ContextVar[RedisUsage | None] = ContextVar("redis_usage", default=None)
+
+
+def record(ops: int = 1) -> None:
+    """Count one round trip carrying ``ops`` operations."""
+    metrics.incr("redis_calls_total")
+    usage = _current.get()
+    if usage is not None:
+        usage.round_trips += 1
+        usage.ops += ops
+
+
+def set_handler(name: str) -> None:
+    usage = _current.get()
+    if usage is not None:
+        usage.handler = name
+
+
+def current() -> RedisUsage | None:
+    return _current.get()
+
+
+@contextmanager
+def track(handler: str = "unknown"):
+    """Account the storage calls made inside the block (tasks it spawns included)."""
+    usage = RedisUsage(handler)
+    token = _current.set(usage)
+    try:
+        yield usage
+    finally:
+        _current.reset(token)
+        metrics.incr("redis_round_trips_total", usage.round_trips, handler=usage.handler)
+        metrics.incr("redis_ops_total", usage.ops, handler=usage.handler)
+        metrics.incr("redis_tracked_total", handler=usage.handler)
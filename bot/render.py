@@ -0,0 +1,266 @@
+"""Postcard rendering: text layout and drawing on top of the Kie background.
+
+Kept separate from ``bot.services`` so that Pillow is only imported by the
+code paths that actually render (Kie callbacks, workers), not on every
+webhook cold start.
+"""
+import os
+import functools
+import logging
+import re
+import threading
+from dataclasses import dataclass
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFont
+
+from bot.config import FONTS_FILES
+
+logger = logging.getLogger(__name__)
+
+_FONT_SIZE_MULTIPLIER: dict[str, float] = {
+    "Caveat": 1.22,
+}
+
+# Fonts are shared through the caches below; FreeType faces must not be used
+# from two threads at once, so text layout and drawing are serialized.
+_text_lock = threading.Lock()
+
+
+def _pick_text_colors(image: Image.Image) -> tuple[tuple, tuple]:
+    """Analyse centre 40% of image; return (text_color, stroke_color)."""
+    w, h = image.size
+    margin = 0.3
+    crop = image.crop((
+        int(w * margin), int(h * margin),
+        int(w * (1 - margin)), int(h * (1 - margin)),
+    ))
+    r, g, b = crop.resize((1, 1), Image.LANCZOS).convert("RGB").getpixel((0, 0))
+    luminance = 0.299 * r + 0.587 * g + 0.114 * b
+    logger.info(f"IMAGE LUMINANCE: {luminance:.1f} (r={r} g={g} b={b})")
+    if luminance > 140:
+        return (30, 30, 30), (255, 255, 255)
+    else:
+        return (255, 255, 255), (30, 30, 30)
+
+
+def wrap_text(
+    text: str, font: ImageFont.FreeTypeFont, max_width: int, draw: ImageDraw.Draw
+) -> str:
+    lines = []
+    for block in text.split("\n"):
+        # Split only by regular spaces so non-breaking spaces stay in one token.
+        words = [word for word in block.split(" ") if word]
+        if not words:
+            lines.append("")
+            continue
+        current_line = words[0]
+        for word in words[1:]:
+            test_line = current_line + " " + word
+            bbox = draw.textbbox((0, 0), test_line, font=font)
+            if bbox[2] - bbox[0] <= max_width:
+                current_line = test_line
+            else:
+                lines.append(current_line)
+                current_line = word
+        lines.append(current_line)
+    return "\n".join(lines)
+
+
+def _mojibake_score(text: str) -> int:
+    # Typical mojibake chunks for UTF-8 decoded as cp1251.
+    return len(re.findall(r"[РС][\u0400-\u04FF]", text)) + text.count("�")
+
+
+def _normalize_cyrillic_text(text: str) -> str:
+    cleaned = (text or "").replace("\r\n", "\n").strip()
+    if not cleaned:
+        return ""
+
+    # Fast path: already readable enough, skip risky recoding.
+    if _mojibake_score(cleaned) == 0:
+        return cleaned
+
+    for codec in ("cp1251", "koi8_r"):
+        try:
+            fixed = cleaned.encode(codec).decode("utf-8")
+        except UnicodeError:
+            continue
+        if fixed and _mojibake_score(fixed) < _mojibake_score(cleaned):
+            return fixed
+    return cleaned
+
+
+@functools.lru_cache(maxsize=None)
+def _font_data(font_path: str) -> bytes:
+    """Raw font file contents, read from disk once per process."""
+    with open(font_path, "rb") as f:
+        return f.read()
+
+
+@functools.lru_cache(maxsize=256)
+def _load_font(font_path: str, fallback_path: str, size: int) -> ImageFont.FreeTypeFont:
+    try:
+        return ImageFont.truetype(BytesIO(_font_data(font_path)), size)
+    except Exception:
+        logger.warning(f"Font not found or broken: {font_path}, fallback to {fallback_path}")
+        try:
+            return ImageFont.truetype(BytesIO(_font_data(fallback_path)), size)
+        except Exception:
+            logger.warning("Fallback font not found, using Pillow default bitmap font")
+            return ImageFont.load_default()
+
+
+def font_path(font_name: str) -> str:
+    """Absolute path of a font from FONTS_FILES (unknown names map to Comfortaa)."""
+    return os.path.join(
+        os.path.dirname(__file__),
+        "..",
+        FONTS_FILES.get(font_name, FONTS_FILES["Comfortaa"]),
+    )
+
+
+def preload_fonts() -> int:
+    """Read every font in FONTS_FILES into the cache; returns the number loaded."""
+    loaded = 0
+    for name in FONTS_FILES:
+        try:
+            _font_data(font_path(name))
+            loaded += 1
+        except OSError as e:
+            logger.warning(f"Font preload failed for {name}: {e}")
+    return loaded
+
+
+def _fit_font_and_wrap(
+    draw: ImageDraw.Draw,
+    text: str,
+    primary_font_path: str,
+    fallback_font_path: str,
+    font_name: str,
+    width: int,
+    height: int,
+) -> tuple[ImageFont.FreeTypeFont, str]:
+    multiplier = _FONT_SIZE_MULTIPLIER.get(font_name, 1.0)
+    start_size = max(36, int(height * 0.16 * multiplier))
+    min_size = 28
+    max_width = int(width * 0.84)
+    max_height = int(height * 0.48)
+
+    for size in range(start_size, min_size - 1, -2):
+        font = _load_font(primary_font_path, fallback_font_path, size)
+        wrapped = wrap_text(text, font, max_width, draw)
+        bbox = draw.textbbox((0, 0), wrapped, font=font, align="center")
+        text_w = bbox[2] - bbox[0]
+        text_h = bbox[3] - bbox[1]
+        if text_w <= max_width and text_h <= max_height:
+            return font, wrapped
+
+    font = _load_font(primary_font_path, fallback_font_path, min_size)
+    return font, wrap_text(text, font, max_width, draw)
+
+
+@functools.lru_cache(maxsize=1)
+def _measure_draw() -> ImageDraw.ImageDraw:
+    """A scratch canvas for text measurements (they don't depend on the image)."""
+    return ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+
+
+@functools.lru_cache(maxsize=512)
+def _layout(text: str, font_name: str, width: int, height: int):
+    """Font, wrapped text and its size for a canvas; cached for repeated renders."""
+    draw = _measure_draw()
+    font, wrapped = _fit_font_and_wrap(
+        draw=draw,
+        text=text,
+        primary_font_path=font_path(font_name),
+        fallback_font_path=font_path("Comfortaa"),
+        font_name=font_name,
+        width=width,
+        height=height,
+    )
+    bbox = draw.textbbox((0, 0), wrapped, font=font, align="center")
+    return font, wrapped, bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+
+@dataclass(frozen=True)
+class Background:
+    """A decoded Kie background, ready to receive any number of texts."""
+    image: Image.Image  # RGBA, never modified
+    text_color: tuple
+    stroke_color: tuple
+
+
+def decode_background(img_bytes: bytes) -> Background:
+    image = Image.open(BytesIO(img_bytes)).convert("RGBA")
+    text_color, stroke_color = _pick_text_colors(image)
+    return Background(image, text_color, stroke_color)
+
+
+def render_on_background(background: Background, text: str, font_name: str) -> bytes:
+    """Draw ``text`` on a decoded background; safe to call from several threads."""
+    image = background.image
+    width, height = image.size
+    overlay = Image.new("RGBA", image.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+
+    with _text_lock:
+        font, wrapped, text_w, text_h = _layout(_normalize_cyrillic_text(text), font_name, width, height)
+        x = (width - text_w) / 2
+        y = (height - text_h) / 2
+        draw.multiline_text(
+            (x, y),
+            wrapped,
+            font=font,
+            fill=background.text_color,
+            align="center",
+            stroke_width=2,
+            stroke_fill=background.stroke_color,
+        )
+
+    # Compositing and JPEG encoding release the GIL and run in parallel
+    result_image = Image.alpha_composite(image, overlay).convert("RGB")
+    output = BytesIO()
+    result_image.save(output, format="JPEG", quality=92)
+    return output.getvalue()
+
+
+def render_preview(img_bytes: bytes, text: str, font_name: str, max_side: int = 320) -> bytes:
+    """A small, low-quality version of the card for progressive delivery.
+
+    JPEG backgrounds are decoded straight at reduced scale.  The text keeps
+    the full-size layout — same font size ratio and line breaks — so the
+    preview looks like the final card, only blurrier.
+    """
+    image = Image.open(BytesIO(img_bytes))
+    full_width, full_height = image.size
+    image.draft("RGB", (max_side, max_side))
+    image = image.convert("RGBA")
+    image.thumbnail((max_side, max_side))
+    width, height = image.size
+    text_color, stroke_color = _pick_text_colors(image)
+    overlay = Image.new("RGBA", image.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+
+    with _text_lock:
+        font, wrapped, _, _ = _layout(_normalize_cyrillic_text(text), font_name, full_width, full_height)
+        size = max(8, round(getattr(font, "size", 28) * width / full_width))
+        font = _load_font(font_path(font_name), font_path("Comfortaa"), size)
+        bbox = draw.textbbox((0, 0), wrapped, font=font, align="center")
+        draw.multiline_text(
+            ((width - (bbox[2] - bbox[0])) / 2, (height - (bbox[3] - bbox[1])) / 2),
+            wrapped,
+            font=font,
+            fill=text_color,
+            align="center",
+            stroke_width=1,
+            stroke_fill=stroke_color,
+        )
+
+    output = BytesIO()
+    Image.alpha_composite(image, overlay).convert("RGB").save(output, format="JPEG", quality=70)
+    return output.getvalue()
+
+
+def apply_text_to_image(img_bytes: bytes, text: str, font_name: str) -> bytes:
+    return render_on_background(decode_background(img_bytes), text, font_name)
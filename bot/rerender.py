@@ -0,0 +1,81 @@
+"""Instant re-render: redraw a delivered postcard with another font or text.
+
+After a postcard is sent, its Kie background is kept for RERENDER_TTL (see
+``bot.blobs``) together with what was drawn on it.  The inline buttons
+under the photo then re-run the text overlay locally — milliseconds, no
+new Kie generation and no credit.
+"""
+import asyncio
+import logging
+import time
+
+from bot import metrics
+from bot.blobs import LocalBlobCache, pack, unpack
+from bot.config import RERENDER_CACHE_BYTES, RERENDER_MAX_BLOB_BYTES, RERENDER_TTL
+from bot.database import (
+    get_rerender_context,
+    get_rerender_source,
+    save_rerender_source,
+    update_rerender_context,
+)
+
+logger = logging.getLogger(__name__)
+
+backgrounds = LocalBlobCache(RERENDER_CACHE_BYTES)
+
+
+class RerenderUnavailable(Exception):
+    """The postcard's background or context has expired."""
+
+
+def remember_background(task_id: str, image_bytes: bytes, context: dict) -> bool:
+    """Keep a delivered postcard's background and drawing context.
+
+    ``context`` holds ``chat_id``, ``text``, ``font`` and ``caption``.
+    Returns False if the background was too large to store (the local copy
+    still serves re-renders on this instance).
+    """
+    backgrounds.put(task_id, image_bytes)
+    blob = pack(image_bytes, RERENDER_MAX_BLOB_BYTES)
+    if blob is None:
+        logger.info(f"RERENDER: background of {task_id} exceeds {RERENDER_MAX_BLOB_BYTES} bytes, kept locally only")
+        metrics.incr("rerender_blobs_total", result="too_large")
+    else:
+        metrics.incr("rerender_blobs_total", result="stored")
+    save_rerender_source(task_id, context, blob, RERENDER_TTL)
+    return blob is not None
+
+
+def load_source(task_id: str) -> tuple[dict, bytes]:
+    """The drawing context and background bytes; raises RerenderUnavailable."""
+    image_bytes = backgrounds.get(task_id)
+    if image_bytes is not None:
+        context = get_rerender_context(task_id)
+    else:
+        context, blob = get_rerender_source(task_id)
+        if blob:
+            image_bytes = unpack(blob)
+            backgrounds.put(task_id, image_bytes)
+    if not context or image_bytes is None:
+        raise RerenderUnavailable(task_id)
+    return context, image_bytes
+
+
+async def rerender(task_id: str, chat_id: int, font: str | None = None, text: str | None = None) -> tuple[bytes, dict]:
+    """Redraw the postcard with a new ``font`` and/or ``text``; returns ``(jpeg, context)``.
+
+    The stored context is updated, so the next change starts from this one.
+    """
+    context, image_bytes = await asyncio.to_thread(load_source, task_id)
+    if context.get("chat_id") != chat_id:
+        raise RerenderUnavailable(task_id)
+    context = {**context, "font": font or context["font"], "text": text or context["text"]}
+
+    from bot.render import apply_text_to_image
+
+    started = time.perf_counter()
+    card = await asyncio.to_thread(apply_text_to_image, image_bytes, context["text"], context["font"])
+    metrics.observe("postcard_stage_seconds", time.perf_counter() - started, stage="rerender")
+    metrics.incr("rerenders_total", kind="text" if text else "font")
+    await asyncio.to_thread(update_rerender_context, task_id, context, RERENDER_TTL)
+    return card, context
@@ -0,0 +1,173 @@
+"""Scheduled postcards: a ready card delivered again at a chosen moment.
+
+The button under a delivered postcard lets the user pick a date and time
+(e.g. midnight of a birthday).  The card is already rendered and uploaded,
+so a job only keeps its Telegram ``file_id`` and delivery is a single
+``send_photo``.  Jobs wait in a sorted set by due time; ``deliver_due``
+(the cron route) claims them in batches atomically and sends them at the
+broadcast rate, earliest first, so a New Year's midnight with thousands of
+jobs is spread over the following minutes instead of tripping Telegram's
+limits.  A lease keeps concurrent cron invocations from doubling the rate.
+"""
+import asyncio
+import logging
+import re
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+from bot import metrics
+from bot.broadcast import TokenBucket
+from bot.config import (
+    BROADCAST_CONCURRENCY,
+    BROADCAST_RATE_PER_SEC,
+    SCHEDULE_MAX_DAYS,
+    SCHEDULE_UTC_OFFSET,
+    SCHEDULED_BATCH_SIZE,
+    SCHEDULED_TIME_BUDGET,
+)
+from bot.database import (
+    SCHEDULED_LEASE_KEY,
+    acquire_lock,
+    claim_due_postcards,
+    finish_scheduled_postcards,
+    release_lock,
+    remove_user,
+    save_scheduled_postcard,
+)
+
+logger = logging.getLogger(__name__)
+
+SCHEDULE_TZ = timezone(timedelta(hours=SCHEDULE_UTC_OFFSET))
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 60  # seconds before a failed send is tried again
+
+_TIME_RE = re.compile(r"^(\d{1,2})\.(\d{1,2})(?:\.(\d{4}))?(?:\s+(\d{1,2})[:.](\d{2}))?$")
+
+
+def parse_schedule_time(text: str, now: datetime | None = None) -> datetime | None:
+    """Parse ``ДД.ММ[.ГГГГ] [ЧЧ:ММ]`` in SCHEDULE_TZ; None if invalid or not ahead.
+
+    Without a year the next such date is meant; without a time, midnight.
+    """
+    now = now or datetime.now(SCHEDULE_TZ)
+    match = _TIME_RE.match(text.strip())
+    if not match:
+        return None
+    day, month, year, hour, minute = match.groups()
+    try:
+        due = datetime(
+            int(year or now.year), int(month), int(day), int(hour or 0), int(minute or 0),
+            tzinfo=SCHEDULE_TZ,
+        )
+        if year is None and due <= now:
+            due = due.replace(year=now.year + 1)
+    except ValueError:
+        return None
+    if not now < due <= now + timedelta(days=SCHEDULE_MAX_DAYS):
+        return None
+    return due
+
+
+def schedule_postcard(chat_id: int, file_id: str, caption: str, due: datetime) -> dict:
+    job = {
+        "id": uuid.uuid4().hex[:12],
+        "chat_id": chat_id,
+        "file_id": file_id,
+        "caption": caption,
+        "due": due.timestamp(),
+        "attempts": 0,
+    }
+    save_scheduled_postcard(job)
+    metrics.incr("scheduled_postcards_total", outcome="scheduled")
+    return job
+
+
+async def _deliver_one(bot: Bot, job: dict, bucket: TokenBucket, stop_at: float) -> str:
+    """Send one job; returns "sent", "blocked", "failed" or "unsent" (out of time)."""
+    for _ in range(MAX_ATTEMPTS):
+        await bucket.acquire()
+        if time.monotonic() >= stop_at:
+            return "unsent"
+        try:
+            await bot.send_photo(job["chat_id"], job["file_id"], caption=job["caption"], parse_mode="HTML")
+            return "sent"
+        except TelegramRetryAfter as e:
+            logger.warning(f"SCHEDULED: RetryAfter {e.retry_after}s on job {job['id']}")
+            bucket.pause(e.retry_after)
+        except TelegramForbiddenError:
+            remove_user(job["chat_id"])
+            return "blocked"
+        except Exception as e:
+            logger.warning(f"SCHEDULED: job {job['id']} failed: {e}")
+            return "failed"
+    return "failed"
+
+
+def _settle(job: dict, outcome: str) -> str:
+    """Finish, retry later or give back one claimed job; returns the final outcome."""
+    if outcome == "unsent":  # back on the due set at its own time, first in line
+        save_scheduled_postcard(job)
+    elif outcome == "failed" and job["attempts"] + 1 < MAX_ATTEMPTS:
+        job["attempts"] += 1
+        job["due"] = time.time() + RETRY_DELAY
+        save_scheduled_postcard(job)
+        outcome = "retried"
+    else:
+        finish_scheduled_postcards([job["id"]])
+    return outcome
+
+
+async def deliver_due(bot: Bot, time_budget: float = SCHEDULED_TIME_BUDGET) -> dict | None:
+    """Send due postcards for at most ``time_budget`` seconds.
+
+    The budget is checked before every send; jobs claimed but not sent in
+    time are given back, and each job is settled as soon as its send ends,
+    so a kill mid-batch re-sends nothing already delivered.  Batches are
+    no larger than what the rate allows in the time left.
+
+    Returns per-outcome counts, or None if another invocation is sending.
+    """
+    token = uuid.uuid4().hex
+    lease_secs = time_budget + 30
+    if not acquire_lock(SCHEDULED_LEASE_KEY, token, int(lease_secs * 1000)):
+        logger.info("SCHEDULED: another invocation is delivering")
+        return None
+
+    bucket = TokenBucket(BROADCAST_RATE_PER_SEC)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    counts = {"sent": 0, "blocked": 0, "failed": 0, "retried": 0, "unsent": 0}
+    started = time.monotonic()
+    stop_at = started + time_budget
+
+    async def send(job: dict) -> None:
+        async with semaphore:
+            if time.monotonic() >= stop_at:
+                outcome = "unsent"
+            else:
+                outcome = await _deliver_one(bot, job, bucket, stop_at)
+        outcome = await asyncio.to_thread(_settle, job, outcome)
+        if outcome == "sent":
+            metrics.observe("postcard_stage_seconds", time.time() - job["due"], stage="schedule_lag")
+        counts[outcome] += 1
+        metrics.incr("scheduled_postcards_total", outcome=outcome)
+
+    try:
+        while (left := stop_at - time.monotonic()) > 0:
+            batch = max(1, min(SCHEDULED_BATCH_SIZE, int(BROADCAST_RATE_PER_SEC * left)))
+            jobs = await asyncio.to_thread(claim_due_postcards, batch, lease_secs)
+            if not jobs:
+                break
+            await asyncio.gather(*(send(job) for job in jobs))
+    finally:
+        release_lock(SCHEDULED_LEASE_KEY, token)
+
+    if any(counts.values()):
+        logger.info(
+            f"SCHEDULED: sent={counts['sent']} blocked={counts['blocked']} failed={counts['failed']} "
+            f"retried={counts['retried']} unsent={counts['unsent']} in {time.monotonic() - started:.1f}s"
+        )
+    return counts
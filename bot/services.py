@@ -1,16 +1,14 @@
-import os
 import asyncio
 import json
 import urllib.parse
 import logging
-import re
+import time
 import traceback
-from io import BytesIO
+import uuid
 
 import aiohttp
-from PIL import Image, ImageDraw, ImageFont
 from aiogram import Bot, types
-from aiogram.types import BufferedInputFile
+from aiogram.types import BufferedInputFile, InputMediaPhoto
 
 from bot.config import (
     KIE_API_KEY,
@@ -18,22 +16,36 @@ from bot.config import (
     PROTALK_BOT_ID,
     PROTALK_TOKEN,
     STYLE_PROMPT_MAP,
-    FONTS_FILES,
     OCCASION_TEXT_MAP,
+    GENERATION_QUEUE,
+    FREE_CREDITS,
+    KIE_API_BASE,
+    PROTALK_API_BASE,
+    TELEGRAM_API_BASE,
+    PROGRESSIVE_DELIVERY,
+    PREVIEW_MAX_SIDE,
 )
+from bot import deadline, kie_queue, metrics
+from bot.deadline import DeadlineExceeded
+from bot.keyboards import build_rerender_keyboard
+from bot.middlewares import release_chat_lock
 from bot.database import (
-    increment_generations,
-    get_credits,
-    add_credits,
-    set_user_state,
-    save_postcard,
     save_pending_image_task,
+    get_delivery_context,
+    finalize_postcard,
+    claim_pending_image_task,
+    complete_pending_image_task,
+    release_pending_image_task,
 )
 
 logger = logging.getLogger(__name__)
 
 CUSTOM_OCCASION_PREFIX = "✏️ "
 
+# Seconds of the invocation budget (bot.deadline) kept for the steps that follow
+_KIE_CREATE_RESERVE = 5.0  # after the greeting: creating the Kie task
+_DELIVERY_RESERVE = 5.0    # after the download: render and send
+
 _OCCASION_DISPLAY_MAP: dict[str, str] = {
     "день рождения": "с Днём Рождения",
     "свадьбу": "с Днём Свадьбы",
@@ -50,9 +62,35 @@ _OCCASION_CAPTION_FALLBACK: dict[str, str] = {
     "завершение учёбы": "желаю яркого будущего и больших успехов!",
 }
 
-_FONT_SIZE_MULTIPLIER: dict[str, float] = {
-    "Caveat": 1.22,
-}
+_connector: aiohttp.TCPConnector | None = None
+
+
+def http_connector() -> aiohttp.TCPConnector:
+    """Process-wide connection pool shared by all outbound HTTP sessions.
+
+    Sessions are still created per call (``connector_owner=False``), but TLS
+    connections to Kie/ProTalk survive between requests of a warm instance.
+    """
+    global _connector
+    loop = asyncio.get_running_loop()
+    if _connector is None or _connector.closed or _connector._loop is not loop:
+        _connector = aiohttp.TCPConnector(limit=100, keepalive_timeout=60)
+    return _connector
+
+
+def telegram_session():
+    """aiogram session for TELEGRAM_API_BASE, or None for the official Bot API."""
+    if not TELEGRAM_API_BASE:
+        return None
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    return AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_BASE))
+
+
+def _session(timeout: aiohttp.ClientTimeout) -> aiohttp.ClientSession:
+    return aiohttp.ClientSession(
+        timeout=timeout, connector=http_connector(), connector_owner=False,
+    )
 
 
 async def fetch_with_retry(
@@ -60,17 +98,23 @@ async def fetch_with_retry(
     session: aiohttp.ClientSession,
     retries: int = 3,
     delay: int = 2,
+    reserve: float = 0.0,
 ) -> aiohttp.ClientResponse:
+    """GET with retries; each attempt and pause fits the budget, keeping ``reserve`` seconds."""
     for attempt in range(retries):
         try:
-            resp = await session.get(url)
+            attempt_timeout = deadline.timeout("fetch", session.timeout.total or 30, reserve=reserve)
+            resp = await session.get(url, timeout=aiohttp.ClientTimeout(total=attempt_timeout))
             if resp.status == 200:
                 return resp
             logger.warning(f"Attempt {attempt + 1}: status {resp.status}")
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             logger.warning(f"Attempt {attempt + 1}: {type(e).__name__}: {e}")
             logger.warning(traceback.format_exc())
         if attempt < retries - 1:
+            deadline.ensure("fetch_retry", delay + reserve + 0.5)
             await asyncio.sleep(delay)
     raise Exception(f"Failed to fetch after {retries} attempts")
 
@@ -80,6 +124,7 @@ async def get_greeting_text_from_protalk(
     occasion: str,
     context: str | None = None,
     fallback: str = "Поздравляю!",
+    timeout_secs: float = 5.0,
 ) -> str:
     base_prompt = (
         "Напиши короткое красивое поздравление на русском языке. "
@@ -101,10 +146,10 @@ async def get_greeting_text_from_protalk(
 
     logger.info(f"PROTALK TEXT: calling for '{addressee}' / '{occasion}'")
     try:
-        timeout = aiohttp.ClientTimeout(total=5)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
+        timeout = aiohttp.ClientTimeout(total=timeout_secs)
+        async with _session(timeout) as session:
             async with session.post(
-                f"https://api.pro-talk.ru/api/v1.0/ask/{PROTALK_TOKEN}",
+                f"{PROTALK_API_BASE}/api/v1.0/ask/{PROTALK_TOKEN}",
                 json=payload,
             ) as resp:
                 if resp.status != 200:
@@ -139,6 +184,12 @@ async def safe_greeting(
         occasion_text.lower(),
         "поздравляю с праздником!",
     )
+    try:
+        timeout_secs = deadline.timeout("protalk", timeout_secs, reserve=_KIE_CREATE_RESERVE, minimum=1.0)
+    except DeadlineExceeded:
+        logger.info("PROTALK TEXT: time budget is low — using local fallback")
+        metrics.incr("protalk_requests_total", result="skipped")
+        return local_fallback
     try:
         result = await asyncio.wait_for(
             get_greeting_text_from_protalk(
@@ -146,12 +197,15 @@ async def safe_greeting(
                 occasion=occasion_text,
                 context=context,
                 fallback=local_fallback,
+                timeout_secs=timeout_secs,
             ),
             timeout=timeout_secs,
         )
+        metrics.incr("protalk_requests_total", result="fallback" if result == local_fallback else "ok")
         return result
     except asyncio.TimeoutError:
         logger.info(f"PROTALK TEXT: timeout {timeout_secs}s — using local fallback")
+        metrics.incr("protalk_requests_total", result="fallback")
         return local_fallback
 
 
@@ -161,10 +215,21 @@ async def create_image_task_async(
     message_id: int,
     payload: dict,
     caption: str,
+    timings: dict | None = None,
+    extra: dict | None = None,
+    on_queue_position=None,
 ) -> str:
     """
     Create async image generation task via Kie.ai z-image API.
     Returns task_id, saves context to DB for callback processing.
+
+    ``timings`` (stage name -> unix time) is stored with the task so the
+    callback can compute queue and end-to-end latency; ``extra`` fields are
+    saved along with it (e.g. the variant set the task belongs to).
+
+    The task first waits for a slot in the Kie submission queue
+    (``bot.kie_queue``); ``on_queue_position`` is awaited with the user's
+    position while it waits.  The slot is freed by the callback.
     """
     if not WEBHOOK_URL:
         raise Exception("WEBHOOK_URL not configured")
@@ -185,25 +250,32 @@ async def create_image_task_async(
         },
     }
 
+    ticket = await kie_queue.acquire_slot(chat_id, on_queue_position)
     logger.info(f"KIE IMAGE: creating async task with z-image, callback={callback_url}")
     
-    timeout = aiohttp.ClientTimeout(total=10)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.post(
-            "https://api.kie.ai/api/v1/jobs/createTask",
-            headers=headers,
-            json=request_payload,
-        ) as resp:
-            if resp.status != 200:
-                error_text = await resp.text()
-                logger.error(f"KIE IMAGE: create task failed {resp.status}: {error_text}")
-                raise Exception(f"Kie.ai API returned {resp.status}")
-            result = await resp.json()
-    
-    task_id = result.get("data", {}).get("taskId")
-    if not task_id:
-        logger.error(f"KIE IMAGE: no taskId in response: {result}")
-        raise Exception("No taskId in Kie.ai response")
+    try:
+        timeout = aiohttp.ClientTimeout(total=deadline.timeout("kie_create", 10.0))
+        with metrics.timed("postcard_stage_seconds", stage="kie_create"):
+            async with _session(timeout) as session:
+                async with session.post(
+                    f"{KIE_API_BASE}/api/v1/jobs/createTask",
+                    headers=headers,
+                    json=request_payload,
+                ) as resp:
+                    if resp.status != 200:
+                        error_text = await resp.text()
+                        logger.error(f"KIE IMAGE: create task failed {resp.status}: {error_text}")
+                        metrics.incr("kie_tasks_total", outcome="create_error")
+                        raise Exception(f"Kie.ai API returned {resp.status}")
+                    result = await resp.json()
+
+        task_id = result.get("data", {}).get("taskId")
+        if not task_id:
+            logger.error(f"KIE IMAGE: no taskId in response: {result}")
+            raise Exception("No taskId in Kie.ai response")
+    except BaseException:
+        await asyncio.to_thread(kie_queue.release_slot, ticket)
+        raise
     
     logger.info(f"KIE IMAGE: task created, taskId={task_id}")
     
@@ -215,6 +287,9 @@ async def create_image_task_async(
             "message_id": message_id,
             "payload": payload,
             "caption_for_db": caption,
+            "timings": {**(timings or {}), "task_created": time.time()},
+            "kie_ticket": ticket,
+            **(extra or {}),
         },
         ttl=300,  # 5 minutes
     )
@@ -225,11 +300,35 @@ async def create_image_task_async(
 async def download_image(image_url: str) -> bytes:
     """Download image from URL."""
     timeout = aiohttp.ClientTimeout(total=30)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        resp = await fetch_with_retry(image_url, session, retries=2, delay=1)
+    async with _session(timeout) as session:
+        resp = await fetch_with_retry(image_url, session, retries=2, delay=1, reserve=_DELIVERY_RESERVE)
         return await resp.read()
 
 
+def occasion_text_of(occasion: str) -> tuple[str, bool]:
+    """``(text for the card, is custom)`` for an occasion button or a custom occasion."""
+    if occasion.startswith(CUSTOM_OCCASION_PREFIX):
+        return occasion[len(CUSTOM_OCCASION_PREFIX):].strip(), True
+    return next((v for k, v in OCCASION_TEXT_MAP.items() if k in occasion), "праздник"), False
+
+
+def postcard_text(payload: dict) -> str:
+    """The text drawn on a single postcard for ``payload``."""
+    occasion_text, is_custom = occasion_text_of(payload["occasion"])
+    return format_image_text(payload.get("addressee", payload["text_input"]), occasion_text, is_custom)
+
+
+def postcard_caption(greeting: str, remaining: int) -> str:
+    """The caption of a delivered single postcard; ``remaining`` is the credit balance."""
+    return (
+        f"..., {greeting}\n\n"
+        f"\U0001f4a1 <b>Открытка готова!</b>\n"
+        f"Чтобы отправить её с именем, напишите в любом чате:\n"
+        f"<code>@pozdravish_bot Имя</code>\n\n"
+        f"Осталось бесплатных открыток: <b>{max(remaining, 0)}</b>"
+    )
+
+
 def format_image_text(name: str, occasion: str = "", is_custom: bool = False) -> str:
     if not is_custom:
         display = _OCCASION_DISPLAY_MAP.get(occasion.lower())
@@ -239,160 +338,102 @@ def format_image_text(name: str, occasion: str = "", is_custom: bool = False) ->
     return f"{name}, поздравляю!"
 
 
-def _pick_text_colors(image: Image.Image) -> tuple[tuple, tuple]:
-    """Analyse centre 40% of image; return (text_color, stroke_color)."""
-    w, h = image.size
-    margin = 0.3
-    crop = image.crop((
-        int(w * margin), int(h * margin),
-        int(w * (1 - margin)), int(h * (1 - margin)),
-    ))
-    r, g, b = crop.resize((1, 1), Image.LANCZOS).convert("RGB").getpixel((0, 0))
-    luminance = 0.299 * r + 0.587 * g + 0.114 * b
-    logger.info(f"IMAGE LUMINANCE: {luminance:.1f} (r={r} g={g} b={b})")
-    if luminance > 140:
-        return (30, 30, 30), (255, 255, 255)
-    else:
-        return (255, 255, 255), (30, 30, 30)
+GROUP_ALBUM_SIZE = 10  # Telegram's limit of photos per media group
 
 
-def wrap_text(
-    text: str, font: ImageFont.FreeTypeFont, max_width: int, draw: ImageDraw.Draw
-) -> str:
-    lines = []
-    for block in text.split("\n"):
-        # Split only by regular spaces so non-breaking spaces stay in one token.
-        words = [word for word in block.split(" ") if word]
-        if not words:
-            lines.append("")
-            continue
-        current_line = words[0]
-        for word in words[1:]:
-            test_line = current_line + " " + word
-            bbox = draw.textbbox((0, 0), test_line, font=font)
-            if bbox[2] - bbox[0] <= max_width:
-                current_line = test_line
-            else:
-                lines.append(current_line)
-                current_line = word
-        lines.append(current_line)
-    return "\n".join(lines)
-
-
-def _mojibake_score(text: str) -> int:
-    # Typical mojibake chunks for UTF-8 decoded as cp1251.
-    return len(re.findall(r"[РС][\u0400-\u04FF]", text)) + text.count("�")
-
-
-def _normalize_cyrillic_text(text: str) -> str:
-    cleaned = (text or "").replace("\r\n", "\n").strip()
-    if not cleaned:
-        return ""
-
-    # Fast path: already readable enough, skip risky recoding.
-    if _mojibake_score(cleaned) == 0:
-        return cleaned
-
-    for codec in ("cp1251", "koi8_r"):
-        try:
-            fixed = cleaned.encode(codec).decode("utf-8")
-        except UnicodeError:
-            continue
-        if fixed and _mojibake_score(fixed) < _mojibake_score(cleaned):
-            return fixed
-    return cleaned
+async def render_group(image_bytes: bytes, texts: list[str], font_name: str) -> list[bytes]:
+    """Render every text on one background: decoded once, cards drawn in parallel threads.
 
+    Records the marginal cost of one more card (batch time after the decode
+    divided by the number of cards) as the ``group_card`` stage.
+    """
+    from bot.render import decode_background, render_on_background
 
-def _load_font(font_path: str, fallback_path: str, size: int) -> ImageFont.FreeTypeFont:
-    try:
-        return ImageFont.truetype(font_path, size)
-    except Exception:
-        logger.warning(f"Font not found or broken: {font_path}, fallback to {fallback_path}")
-        try:
-            return ImageFont.truetype(fallback_path, size)
-        except Exception:
-            logger.warning("Fallback font not found, using Pillow default bitmap font")
-            return ImageFont.load_default()
+    started = time.perf_counter()
+    background = await asyncio.to_thread(decode_background, image_bytes)
+    decoded = time.perf_counter()
+    cards = await asyncio.gather(*(
+        asyncio.to_thread(render_on_background, background, text, font_name) for text in texts
+    ))
+    per_card = (time.perf_counter() - decoded) / len(texts)
+    metrics.observe("postcard_stage_seconds", per_card, stage="group_card")
+    logger.info(
+        f"GROUP RENDER: {len(texts)} cards, decode {decoded - started:.3f}s, "
+        f"{per_card * 1000:.0f}ms per card"
+    )
+    return cards
+
+
+async def send_group_postcards(
+    bot: Bot, chat_id: int, cards: list[bytes], caption: str
+) -> types.Message:
+    """Send the cards as media groups (the caption goes under the first); returns the first message."""
+    first = None
+    for start in range(0, len(cards), GROUP_ALBUM_SIZE):
+        chunk = cards[start:start + GROUP_ALBUM_SIZE]
+        files = [
+            BufferedInputFile(data, filename=f"postcard_{start + i + 1}.jpg")
+            for i, data in enumerate(chunk)
+        ]
+        text = caption if start == 0 else None
+        if len(files) == 1:  # a media group needs at least two items
+            sent = [await bot.send_photo(chat_id=chat_id, photo=files[0], caption=text, parse_mode="HTML")]
+        else:
+            media = [InputMediaPhoto(media=files[0], caption=text, parse_mode="HTML")]
+            media += [InputMediaPhoto(media=f) for f in files[1:]]
+            sent = await bot.send_media_group(chat_id=chat_id, media=media)
+        first = first or sent[0]
+    return first
 
 
-def _fit_font_and_wrap(
-    draw: ImageDraw.Draw,
+async def send_progressive(
+    bot: Bot,
+    chat_id: int,
+    image_bytes: bytes,
     text: str,
-    primary_font_path: str,
-    fallback_font_path: str,
     font_name: str,
-    width: int,
-    height: int,
-) -> tuple[ImageFont.FreeTypeFont, str]:
-    multiplier = _FONT_SIZE_MULTIPLIER.get(font_name, 1.0)
-    start_size = max(36, int(height * 0.16 * multiplier))
-    min_size = 28
-    max_width = int(width * 0.84)
-    max_height = int(height * 0.48)
-
-    for size in range(start_size, min_size - 1, -2):
-        font = _load_font(primary_font_path, fallback_font_path, size)
-        wrapped = wrap_text(text, font, max_width, draw)
-        bbox = draw.textbbox((0, 0), wrapped, font=font, align="center")
-        text_w = bbox[2] - bbox[0]
-        text_h = bbox[3] - bbox[1]
-        if text_w <= max_width and text_h <= max_height:
-            return font, wrapped
-
-    font = _load_font(primary_font_path, fallback_font_path, min_size)
-    return font, wrap_text(text, font, max_width, draw)
-
-
-def apply_text_to_image(img_bytes: bytes, text: str, font_name: str) -> bytes:
-    image = Image.open(BytesIO(img_bytes)).convert("RGBA")
-    width, height = image.size
-
-    text_color, stroke_color = _pick_text_colors(image)
-
-    overlay = Image.new("RGBA", image.size, (0, 0, 0, 0))
-    draw = ImageDraw.Draw(overlay)
-
-    requested_font_path = os.path.join(
-        os.path.dirname(__file__),
-        "..",
-        FONTS_FILES.get(font_name, FONTS_FILES["Comfortaa"]),
-    )
-    fallback_font_path = os.path.join(
-        os.path.dirname(__file__),
-        "..",
-        FONTS_FILES["Comfortaa"],
-    )
-    safe_text = _normalize_cyrillic_text(text)
-    font, wrapped = _fit_font_and_wrap(
-        draw=draw,
-        text=safe_text,
-        primary_font_path=requested_font_path,
-        fallback_font_path=fallback_font_path,
-        font_name=font_name,
-        width=width,
-        height=height,
-    )
+    caption: str,
+    reply_markup=None,
+    timings: dict | None = None,
+) -> types.Message:
+    """Send a low-res preview of the card at once, then replace it with the full card.
+
+    The full render runs while the preview uploads.  ``first_pixel`` (from
+    the user's request to the preview) is observed separately from
+    ``end_to_end``, which the caller records once the final card is in.
+    """
+    from bot.render import apply_text_to_image, render_preview
 
-    bbox = draw.textbbox((0, 0), wrapped, font=font, align="center")
-    text_w = bbox[2] - bbox[0]
-    text_h = bbox[3] - bbox[1]
-    x = (width - text_w) / 2
-    y = (height - text_h) / 2
-
-    draw.multiline_text(
-        (x, y),
-        wrapped,
-        font=font,
-        fill=text_color,
-        align="center",
-        stroke_width=2,
-        stroke_fill=stroke_color,
+    timings = timings or {}
+    started = time.perf_counter()
+    preview = await asyncio.to_thread(render_preview, image_bytes, text, font_name, PREVIEW_MAX_SIDE)
+    metrics.observe("postcard_stage_seconds", time.perf_counter() - started, stage="preview")
+    full_render = asyncio.create_task(asyncio.to_thread(apply_text_to_image, image_bytes, text, font_name))
+    try:
+        preview_msg = await bot.send_photo(
+            chat_id=chat_id,
+            photo=BufferedInputFile(preview, filename="preview.jpg"),
+            caption="⏳ Дорисовываю открытку...",
+        )
+    except Exception:
+        full_render.cancel()
+        raise
+    if "requested" in timings:
+        metrics.observe("postcard_stage_seconds", time.time() - timings["requested"], stage="first_pixel")
+
+    card = await full_render
+    metrics.observe("postcard_stage_seconds", time.perf_counter() - started, stage="render")
+    msg = await bot.edit_message_media(
+        media=InputMediaPhoto(
+            media=BufferedInputFile(card, filename="postcard.jpg"),
+            caption=caption,
+            parse_mode="HTML",
+        ),
+        chat_id=chat_id,
+        message_id=preview_msg.message_id,
+        reply_markup=reply_markup,
     )
-
-    result_image = Image.alpha_composite(image, overlay).convert("RGB")
-    output = BytesIO()
-    result_image.save(output, format="JPEG", quality=92)
-    return output.getvalue()
+    return msg if isinstance(msg, types.Message) else preview_msg
 
 
 async def _keep_uploading(bot: Bot, chat_id: int, stop_event: asyncio.Event) -> None:
@@ -427,29 +468,56 @@ def _friendly_error(e: Exception) -> str:
 async def generate_postcard(
     chat_id: int, message: types.Message, payload: dict, bot: Bot
 ):
-    """Generate postcard asynchronously using callback workflow."""
+    """Generate postcard asynchronously using callback workflow.
+
+    Sends the waiting message and then either creates the Kie task right
+    away or, with GENERATION_QUEUE enabled, leaves that to a worker.  The
+    chat's state is settled by now, so the chat lock is released first and
+    the user's next update doesn't wait for ProTalk and Kie.
+    """
+    release_chat_lock()
+    # When the user asked (message time) and when we accepted the request
+    timings = {"requested": message.date.timestamp(), "accepted": time.time()}
+    wait_msg = await message.answer(
+        "⏳ Генерирую открытку... Пожалуйста, подождите."
+    )
+
+    if GENERATION_QUEUE:
+        from bot.jobs import enqueue_job
+        try:
+            enqueue_job("create", {
+                "chat_id": chat_id,
+                "message_id": wait_msg.message_id,
+                "payload": payload,
+                "timings": timings,
+            })
+            return
+        except Exception as e:
+            logger.warning(f"generate_postcard: enqueue failed, generating inline: {e}")
+
+    await start_generation(chat_id, wait_msg.message_id, payload, bot, timings)
+
+
+async def start_generation(
+    chat_id: int, message_id: int, payload: dict, bot: Bot, timings: dict | None = None
+):
+    """Write the greeting and create the Kie task for an accepted request.
+
+    On failure the waiting message ``message_id`` is replaced with an error
+    and the failure is final (nothing is raised, a worker acks the job).
+    The wizard state isn't touched: the caller reset it before the request
+    was accepted, and by now the user may be filling in the next card.
+    """
     occasion = payload["occasion"]
     style = payload["style"]
-    font_name = payload.get("font", "Comfortaa")
     text_mode = payload.get("text_mode", "ai")
     text_input = payload["text_input"]
     addressee = payload.get("addressee", text_input)
 
     caption_for_db = text_input.strip()
 
-    wait_msg = await message.answer(
-        "⏳ Генерирую открытку... Пожалуйста, подождите."
-    )
-
     try:
-        is_custom = occasion.startswith(CUSTOM_OCCASION_PREFIX)
-        occasion_text = (
-            occasion[len(CUSTOM_OCCASION_PREFIX):].strip()
-            if is_custom
-            else next(
-                (v for k, v in OCCASION_TEXT_MAP.items() if k in occasion), "праздник"
-            )
-        )
+        occasion_text, is_custom = occasion_text_of(occasion)
 
         logger.info(f"POSTCARD: mode={text_mode} occasion='{occasion_text}' addressee='{addressee}'")
 
@@ -458,23 +526,45 @@ async def generate_postcard(
 
         # Generate caption if needed
         if text_mode == "ai":
-            caption_for_db = await safe_greeting(
-                addressee=addressee,
-                occasion_text=occasion_text,
-                context=text_input,
-                timeout_secs=5.0,
-            )
+            with metrics.timed("postcard_stage_seconds", stage="protalk"):
+                caption_for_db = await safe_greeting(
+                    addressee=addressee,
+                    occasion_text=occasion_text,
+                    context=text_input,
+                    timeout_secs=5.0,
+                )
             logger.info(f"POSTCARD: caption='{caption_for_db[:80]}'")
         else:
             caption_for_db = text_input.strip()
 
+        async def show_queue_position(position: int):
+            await bot.edit_message_text(
+                f"⏳ Много желающих — вы в очереди: <b>{position}</b>.\n"
+                f"Открытка начнёт рисоваться, как только подойдёт очередь.",
+                chat_id=chat_id,
+                message_id=message_id,
+                parse_mode="HTML",
+            )
+
+        variants = payload.get("variants", 1)
+        if variants > 1:
+            from bot.variants import start_variants
+            task_ids = await start_variants(
+                variants, image_prompt, chat_id, message_id, payload, caption_for_db, timings,
+                on_queue_position=show_queue_position,
+            )
+            logger.info(f"POSTCARD: {len(task_ids)} variant tasks created, waiting for callbacks")
+            return
+
         # Create async image generation task
         task_id = await create_image_task_async(
             image_prompt=image_prompt,
             chat_id=chat_id,
-            message_id=wait_msg.message_id,
+            message_id=message_id,
             payload=payload,
             caption=caption_for_db,
+            timings=timings,
+            on_queue_position=show_queue_position,
         )
         
         logger.info(f"POSTCARD: async task created, taskId={task_id}, waiting for callback")
@@ -482,17 +572,14 @@ async def generate_postcard(
     except Exception as e:
         logger.error(f"generate_postcard error: {e}", exc_info=True)
         friendly = _friendly_error(e)
-        await wait_msg.edit_text(
+        await bot.edit_message_text(
             f"\U0001f614 Не удалось создать задачу генерации.\n"
             f"<b>Причина:</b> {friendly}\n"
             f"Ваш кредит <b>не списан</b>. Попробуйте ещё раз.",
+            chat_id=chat_id,
+            message_id=message_id,
             parse_mode="HTML",
         )
-        set_user_state(
-            chat_id,
-            {"occasion": None, "style": None, "font": None, "text_mode": None,
-             "ai_context": None, "addressee": None},
-        )
 
 
 async def process_kie_callback(
@@ -501,16 +588,24 @@ async def process_kie_callback(
     result_json: dict,
     fail_msg: str | None,
     bot: Bot,
+    received_at: float | None = None,
 ) -> bool:
     """Process Kie.ai callback and send postcard to user.
+
+    ``received_at`` is when the callback reached us (defaults to now); it
+    ends the Kie queue + generation stage.
     
     Returns:
         True if processed successfully, False otherwise
     """
-    from bot.database import get_pending_image_task
-    
-    # Get saved context
-    task_data = get_pending_image_task(task_id)
+    received_at = received_at or time.time()
+
+    # Claim the task: duplicate or concurrent deliveries stop here after one Redis call
+    lease_token = uuid.uuid4().hex
+    claim_status, task_data = claim_pending_image_task(task_id, lease_token)
+    if claim_status in ("done", "busy"):
+        logger.info(f"KIE CALLBACK: taskId={task_id} already {claim_status}, ignoring duplicate")
+        return True
     if not task_data:
         logger.warning(f"KIE CALLBACK: no data found for taskId={task_id}")
         return False
@@ -519,14 +614,46 @@ async def process_kie_callback(
     message_id = task_data["message_id"]
     payload = task_data["payload"]
     caption_for_db = task_data["caption_for_db"]
+    timings = task_data.get("timings") or {}
+    if "task_created" in timings:
+        metrics.observe("postcard_stage_seconds", received_at - timings["task_created"], stage="kie_wait")
+    if task_data.get("kie_ticket"):
+        try:
+            kie_queue.release_slot(task_data["kie_ticket"])
+        except Exception as e:
+            logger.warning(f"KIE CALLBACK: could not free the Kie slot of {task_id}: {e}")
     
     logger.info(f"KIE CALLBACK: processing taskId={task_id}, state={state}, chat_id={chat_id}")
+
+    if task_data.get("variant_set"):
+        from bot.variants import collect_variant
+        try:
+            return await collect_variant(task_id, task_data, state, result_json, bot, lease_token)
+        except Exception as e:
+            logger.error(f"KIE CALLBACK: error delivering variants: {e}", exc_info=True)
+            metrics.incr("variant_sets_total", outcome="error")
+            # Another callback may still take the set over and deliver (and charge)
+            # it, so nothing is promised about the credit here
+            try:
+                await bot.edit_message_text(
+                    f"\U0001f614 Ошибка при сборке вариантов.\n"
+                    f"Если они всё же будут готовы, я пришлю их сюда. "
+                    f"Кредит списывается только за доставленную открытку.",
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    parse_mode="HTML",
+                )
+            except Exception:
+                pass
+            return False
     
     try:
         if state == "success":
             result_urls = result_json.get("resultUrls", [])
             if not result_urls:
                 logger.error(f"KIE CALLBACK: no resultUrls in response")
+                metrics.incr("kie_tasks_total", outcome="fail")
+                complete_pending_image_task(task_id)
                 await bot.edit_message_text(
                     "❌ Ошибка: нет URL изображения",
                     chat_id=chat_id,
@@ -537,66 +664,111 @@ async def process_kie_callback(
             image_url = result_urls[0]
             logger.info(f"KIE CALLBACK: downloading image from {image_url}")
             
-            # Download image
-            image_bytes = await download_image(image_url)
+            # Download image; read credits and gallery meanwhile
+            with metrics.timed("postcard_stage_seconds", stage="download"):
+                image_bytes, (credits, gallery) = await asyncio.gather(
+                    download_image(image_url),
+                    asyncio.to_thread(get_delivery_context, chat_id),
+                )
             
             # Apply text overlay
             addressee = payload.get("addressee", payload["text_input"])
             occasion = payload["occasion"]
             font_name = payload.get("font", "Comfortaa")
             
-            is_custom = occasion.startswith(CUSTOM_OCCASION_PREFIX)
-            occasion_text = (
-                occasion[len(CUSTOM_OCCASION_PREFIX):].strip()
-                if is_custom
-                else next(
-                    (v for k, v in OCCASION_TEXT_MAP.items() if k in occasion), "праздник"
-                )
-            )
+            occasion_text, is_custom = occasion_text_of(occasion)
             
-            text_to_draw = format_image_text(addressee, occasion_text, is_custom)
-            logger.info(f"KIE CALLBACK: applying text '{text_to_draw}'")
-            final_img_bytes = apply_text_to_image(image_bytes, text_to_draw, font_name)
-            
-            # Delete waiting message
+            remaining = (FREE_CREDITS if credits is None else credits) - 1
+            addressees = payload.get("addressees")
+
+            if addressees:
+                texts = [format_image_text(name, occasion_text, is_custom) for name in addressees]
+                logger.info(f"KIE CALLBACK: group postcard for {len(texts)} names")
+                cards = await render_group(image_bytes, texts, font_name)
+                pm_caption = (
+                    f"{caption_for_db}\n\n"
+                    f"\U0001f4a1 <b>Готово: {len(cards)} открыток</b> — по одной для каждого имени.\n\n"
+                    f"Осталось бесплатных открыток: <b>{max(remaining, 0)}</b>"
+                )
+
+                async def send_postcard():
+                    with metrics.timed("postcard_stage_seconds", stage="send_photo"):
+                        return await send_group_postcards(bot, chat_id, cards, pm_caption)
+            else:
+                text_to_draw = format_image_text(addressee, occasion_text, is_custom)
+                logger.info(f"KIE CALLBACK: applying text '{text_to_draw}'")
+                # The preview is an extra upload: skip it when the budget is tight
+                progressive = PROGRESSIVE_DELIVERY and deadline.allows("preview", 2 * _DELIVERY_RESERVE)
+                if not progressive:
+                    from bot.render import apply_text_to_image  # Pillow is loaded only when rendering
+
+                    with metrics.timed("postcard_stage_seconds", stage="render"):
+                        final_img_bytes = await asyncio.to_thread(apply_text_to_image, image_bytes, text_to_draw, font_name)
+
+                pm_caption = postcard_caption(caption_for_db, remaining)
+
+                async def send_postcard():
+                    if progressive:
+                        return await send_progressive(
+                            bot, chat_id, image_bytes, text_to_draw, font_name, pm_caption,
+                            build_rerender_keyboard(task_id, font_name), timings,
+                        )
+                    with metrics.timed("postcard_stage_seconds", stage="send_photo"):
+                        return await bot.send_photo(
+                            chat_id=chat_id,
+                            photo=BufferedInputFile(final_img_bytes, filename="postcard.jpg"),
+                            caption=pm_caption,
+                            parse_mode="HTML",
+                            reply_markup=build_rerender_keyboard(task_id, font_name),
+                        )
+
+            async def delete_wait_message():
+                try:
+                    await bot.delete_message(chat_id=chat_id, message_id=message_id)
+                except Exception:
+                    pass
+
+            # Remove the waiting message and send the postcard at the same time
+            _, msg = await asyncio.gather(delete_wait_message(), send_postcard())
+            if "requested" in timings:
+                metrics.observe("postcard_stage_seconds", time.time() - timings["requested"], stage="end_to_end")
+
+            # The card is out: a failure below must not hand the task back for a
+            # second delivery (and charge), nor tell the user nothing was spent
             try:
-                await bot.delete_message(chat_id=chat_id, message_id=message_id)
-            except Exception:
-                pass
-            
-            # Send postcard
-            pm_caption = (
-                f"..., {caption_for_db}\n\n"
-                f"\U0001f4a1 <b>Открытка готова!</b>\n"
-                f"Чтобы отправить её с именем, напишите в любом чате:\n"
-                f"<code>@pozdravish_bot Имя</code>"
-            )
-            
-            msg = await bot.send_photo(
-                chat_id=chat_id,
-                photo=BufferedInputFile(final_img_bytes, filename="postcard.jpg"),
-                caption=pm_caption,
-                parse_mode="HTML",
-            )
-            
-            if msg and msg.photo:
-                save_postcard(chat_id, msg.photo[-1].file_id, caption_for_db)
-            
-            increment_generations()
-            add_credits(chat_id, -1)
-            
-            credits = get_credits(chat_id)
-            await bot.send_message(
-                chat_id=chat_id,
-                text=f"Осталось бесплатных открыток: <b>{credits}</b>",
-                parse_mode="HTML",
-            )
+                # Group cards carry their names, so they don't go to the inline gallery
+                file_id = msg.photo[-1].file_id if msg and msg.photo and not addressees else None
+                remaining = finalize_postcard(chat_id, task_id, file_id, caption_for_db, gallery, credits, payload)
+            except Exception as e:
+                logger.error(f"KIE CALLBACK: postcard sent but not recorded for taskId={task_id}: {e}", exc_info=True)
+                try:
+                    complete_pending_image_task(task_id)
+                except Exception as e:
+                    logger.error(f"KIE CALLBACK: could not mark taskId={task_id} done: {e}")
+            metrics.incr("kie_tasks_total", outcome="success")
             
             logger.info(f"KIE CALLBACK: postcard sent successfully to chat_id={chat_id}")
+
+            if not addressees and deadline.allows("remember_background", 2.0):
+                # Keep the background so the buttons can redraw the text without Kie
+                from bot.rerender import remember_background
+                try:
+                    await asyncio.to_thread(remember_background, task_id, image_bytes, {
+                        "chat_id": chat_id,
+                        "text": text_to_draw,
+                        "font": font_name,
+                        # The balance after this card's debit, not the one read before it
+                        "caption": postcard_caption(caption_for_db, remaining),
+                        "greeting": caption_for_db,
+                    })
+                except Exception as e:
+                    logger.warning(f"KIE CALLBACK: could not keep background of {task_id}: {e}")
             return True
             
         elif state == "fail":
             logger.error(f"KIE CALLBACK: generation failed: {fail_msg}")
+            metrics.incr("kie_tasks_total", outcome="fail")
+            complete_pending_image_task(task_id)
             await bot.edit_message_text(
                 f"\U0001f614 Нейросеть не смогла сгенерировать открытку.\n"
                 f"Ваш кредит <b>не списан</b>. Попробуйте ещё раз.",
@@ -608,10 +780,17 @@ async def process_kie_callback(
         
         else:
             logger.warning(f"KIE CALLBACK: unexpected state={state}")
+            release_pending_image_task(task_id, lease_token)
             return False
             
     except Exception as e:
         logger.error(f"KIE CALLBACK: error processing callback: {e}", exc_info=True)
+        metrics.incr("kie_tasks_total", outcome="error")
+        # Hand the task back so a redelivered callback can finish it
+        try:
+            release_pending_image_task(task_id, lease_token)
+        except Exception:
+            pass
         try:
             await bot.edit_message_text(
                 f"\U0001f614 Ошибка при обработке результата.\n"
@@ -623,3 +802,15 @@ async def process_kie_callback(
         except Exception:
             pass
         return False
+
+
+# Rendering helpers live in bot.render (Pillow); resolve them lazily on access
+# so `from bot.services import apply_text_to_image` keeps working.
+_RENDER_EXPORTS = {"apply_text_to_image", "wrap_text"}
+
+
+def __getattr__(name: str):
+    if name in _RENDER_EXPORTS:
+        from bot import render
+        return getattr(render, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,41 @@
+"""Storage backends for ``bot.database.kv``.
+
+Selected with STORAGE_BACKEND:
+
+    upstash  Upstash Redis over HTTPS REST (default; UPSTASH_REDIS_REST_URL/TOKEN)
+    redis    any Redis over pooled TCP connections (REDIS_URL, REDIS_POOL_SIZE)
+    sqlite   single file database for single-node installs (SQLITE_PATH)
+    memory   in-process dicts for tests and benchmarks
+
+All of them expose the upstash_redis client API used by the bot.  The
+embedded backends (sqlite, memory) run Lua scripts through Python
+fallbacks registered with ``register_script`` and don't support streams,
+so GENERATION_QUEUE needs upstash or redis.
+"""
+from bot.storage.base import StorageBackend, StorageError, register_script
+
+BACKENDS = ("upstash", "redis", "sqlite", "memory")
+
+
+def create_backend(name: str | None = None):
+    """Instantiate the configured backend (imports only what it needs)."""
+    from bot import config
+
+    name = (name or config.STORAGE_BACKEND).lower()
+    if name == "upstash":
+        from upstash_redis import Redis
+        # UPSTASH_REDIS_REST_URL and UPSTASH_REDIS_REST_TOKEN come from the environment
+        return Redis.from_env()
+    if name == "redis":
+        from bot.storage.resp import RespBackend
+        return RespBackend(config.REDIS_URL, pool_size=config.REDIS_POOL_SIZE)
+    if name == "sqlite":
+        from bot.storage.sqlite import SQLiteBackend
+        return SQLiteBackend(config.SQLITE_PATH)
+    if name == "memory":
+        from bot.storage.memory import MemoryBackend
+        return MemoryBackend()
+    raise ValueError(f"Unknown STORAGE_BACKEND {name!r}, expected one of {', '.join(BACKENDS)}")
+
+
+__all__ = ["BACKENDS", "StorageBackend", "StorageError", "create_backend", "register_script"]
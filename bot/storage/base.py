@@ -0,0 +1,281 @@
+"""Command layer shared by the storage backends.
+
+Every backend exposes the subset of the upstash_redis client API the bot
+uses (``get``, ``set``, ``hincrby``, ``pipeline().exec()``, ``eval`` ...).
+Methods build a raw Redis command, hand it to the backend's ``_run`` /
+``_run_many`` and cast the raw reply the same way upstash_redis does, so
+callers see identical return values whichever backend is configured.
+"""
+import hashlib
+from typing import Callable
+
+
+class StorageError(Exception):
+    """A command failed (wrong type, unsupported command, server error)."""
+
+
+# ---------------------------------------------------------------------------
+# Python fallbacks for Lua scripts
+#
+# Backends without a Lua interpreter (memory, SQLite) run the registered
+# Python equivalent of a script instead.  The function gets ``call`` — the
+# counterpart of ``redis.call`` — plus KEYS and ARGV, and runs atomically.
+# ---------------------------------------------------------------------------
+
+_SCRIPT_FALLBACKS: dict[str, Callable] = {}
+
+
+def script_digest(source: str) -> str:
+    return hashlib.sha1(source.encode()).hexdigest()
+
+
+def register_script(source: str):
+    """Decorator registering the Python fallback for the Lua script ``source``."""
+    def decorator(func: Callable) -> Callable:
+        _SCRIPT_FALLBACKS[script_digest(source)] = func
+        return func
+    return decorator
+
+
+def script_fallback(source: str) -> Callable:
+    try:
+        return _SCRIPT_FALLBACKS[script_digest(source)]
+    except KeyError:
+        raise StorageError("script has no Python fallback; register one with register_script") from None
+
+
+# ---------------------------------------------------------------------------
+# Reply casting (mirrors upstash_redis.format for the commands we use)
+# ---------------------------------------------------------------------------
+
+def _pairs(raw: list) -> dict:
+    return {raw[i]: raw[i + 1] for i in range(0, len(raw), 2)}
+
+
+def _scored(raw: list) -> list[tuple[str, float]]:
+    it = iter(raw)
+    return list(zip(it, map(float, it)))
+
+
+def _with_scores(res, command):
+    return _scored(res) if "WITHSCORES" in command else res
+
+
+_FORMATTERS: dict[str, Callable] = {
+    "SET": lambda res, command: res if "GET" in command[3:] else res == "OK",
+    "SETEX": lambda res, command: res == "OK",
+    "EXPIRE": lambda res, command: bool(res),
+    "PEXPIRE": lambda res, command: bool(res),
+    "SISMEMBER": lambda res, command: bool(res),
+    "PFADD": lambda res, command: bool(res),
+    "HGETALL": lambda res, command: _pairs(res),
+    "HINCRBYFLOAT": lambda res, command: float(res),
+    "INCRBYFLOAT": lambda res, command: float(res),
+    "SSCAN": lambda res, command: [int(res[0]), res[1]],
+    "ZSCORE": lambda res, command: float(res) if res is not None else None,
+    "ZRANGEBYSCORE": _with_scores,
+    "ZRANGE": _with_scores,
+}
+
+
+def cast_reply(command: list, reply):
+    formatter = _FORMATTERS.get(command[0])
+    return formatter(reply, command) if formatter else reply
+
+
+# ---------------------------------------------------------------------------
+# Commands
+# ---------------------------------------------------------------------------
+
+class Commands:
+    """Redis command methods; subclasses decide how ``_call`` executes them."""
+
+    def _call(self, command: list):
+        raise NotImplementedError
+
+    # Generic
+    def execute(self, command: list):
+        return self._call([str(command[0]).upper(), *command[1:]])
+
+    def ping(self):
+        return self._call(["PING"])
+
+    def delete(self, *keys: str):
+        return self._call(["DEL", *keys])
+
+    def exists(self, *keys: str):
+        return self._call(["EXISTS", *keys])
+
+    def expire(self, key: str, seconds: int):
+        return self._call(["EXPIRE", key, seconds])
+
+    def pexpire(self, key: str, milliseconds: int):
+        return self._call(["PEXPIRE", key, milliseconds])
+
+    def ttl(self, key: str):
+        return self._call(["TTL", key])
+
+    def eval(self, script: str, keys: list | None = None, args: list | None = None):
+        keys, args = keys or [], args or []
+        return self._call(["EVAL", script, len(keys), *keys, *args])
+
+    # Strings
+    def get(self, key: str):
+        return self._call(["GET", key])
+
+    def set(self, key: str, value, nx: bool | None = None, xx: bool | None = None,
+            get: bool | None = None, ex: int | None = None, px: int | None = None):
+        command = ["SET", key, value]
+        if nx:
+            command.append("NX")
+        if xx:
+            command.append("XX")
+        if get:
+            command.append("GET")
+        if ex is not None:
+            command += ["EX", ex]
+        if px is not None:
+            command += ["PX", px]
+        return self._call(command)
+
+    def setex(self, key: str, seconds: int, value):
+        return self._call(["SETEX", key, seconds, value])
+
+    def getdel(self, key: str):
+        return self._call(["GETDEL", key])
+
+    def mget(self, *keys: str):
+        return self._call(["MGET", *keys])
+
+    def incr(self, key: str):
+        return self._call(["INCR", key])
+
+    def incrby(self, key: str, increment: int):
+        return self._call(["INCRBY", key, increment])
+
+    def decrby(self, key: str, decrement: int):
+        return self._call(["DECRBY", key, decrement])
+
+    # Sets
+    def sadd(self, key: str, *members):
+        return self._call(["SADD", key, *members])
+
+    def srem(self, key: str, *members):
+        return self._call(["SREM", key, *members])
+
+    def sismember(self, key: str, member):
+        return self._call(["SISMEMBER", key, member])
+
+    def scard(self, key: str):
+        return self._call(["SCARD", key])
+
+    def smembers(self, key: str):
+        return self._call(["SMEMBERS", key])
+
+    def sscan(self, key: str, cursor: int = 0, match: str | None = None, count: int | None = None):
+        command = ["SSCAN", key, cursor]
+        if match is not None:
+            command += ["MATCH", match]
+        if count is not None:
+            command += ["COUNT", count]
+        return self._call(command)
+
+    # Hashes
+    def hget(self, key: str, field: str):
+        return self._call(["HGET", key, field])
+
+    def hset(self, key: str, field: str | None = None, value=None, values: dict | None = None):
+        command = ["HSET", key]
+        if field is not None:
+            command += [field, value]
+        for f, v in (values or {}).items():
+            command += [f, v]
+        return self._call(command)
+
+    def hdel(self, key: str, *fields: str):
+        return self._call(["HDEL", key, *fields])
+
+    def hincrby(self, key: str, field: str, increment: int):
+        return self._call(["HINCRBY", key, field, increment])
+
+    def hincrbyfloat(self, key: str, field: str, increment: float):
+        return self._call(["HINCRBYFLOAT", key, field, increment])
+
+    def hgetall(self, key: str):
+        return self._call(["HGETALL", key])
+
+    # HyperLogLog
+    def pfadd(self, key: str, *elements):
+        return self._call(["PFADD", key, *elements])
+
+    def pfcount(self, *keys: str):
+        return self._call(["PFCOUNT", *keys])
+
+    # Sorted sets
+    def zadd(self, key: str, scores: dict, nx: bool = False):
+        command = ["ZADD", key]
+        if nx:
+            command.append("NX")
+        for member, score in scores.items():
+            command += [score, member]
+        return self._call(command)
+
+    def zrem(self, key: str, *members):
+        return self._call(["ZREM", key, *members])
+
+    def zcard(self, key: str):
+        return self._call(["ZCARD", key])
+
+    def zscore(self, key: str, member):
+        return self._call(["ZSCORE", key, member])
+
+    def zrangebyscore(self, key: str, min_score, max_score, withscores: bool = False,
+                      offset: int | None = None, count: int | None = None):
+        command = ["ZRANGEBYSCORE", key, min_score, max_score]
+        if withscores:
+            command.append("WITHSCORES")
+        if offset is not None and count is not None:
+            command += ["LIMIT", offset, count]
+        return self._call(command)
+
+
+class StorageBackend(Commands):
+    """Base class for backends that execute raw commands themselves."""
+
+    name = "base"
+
+    def _run(self, command: list):
+        """Execute one raw command and return the raw (uncast) reply."""
+        raise NotImplementedError
+
+    def _run_many(self, commands: list[list]) -> list:
+        """Execute several commands, ideally in one round trip."""
+        return [self._run(command) for command in commands]
+
+    def _call(self, command: list):
+        return cast_reply(command, self._run(command))
+
+    def pipeline(self) -> "Pipeline":
+        return Pipeline(self)
+
+
+class Pipeline(Commands):
+    """Queues commands and sends them together on ``exec()``."""
+
+    def __init__(self, backend: StorageBackend):
+        self._backend = backend
+        self._commands: list[list] = []
+
+    def _call(self, command: list):
+        self._commands.append(command)
+        return self
+
+    def exec(self) -> list:
+        commands, self._commands = self._commands, []
+        if not commands:
+            return []
+        replies = self._backend._run_many(commands)
+        for reply in replies:
+            if isinstance(reply, StorageError):
+                raise reply
+        return [cast_reply(command, reply) for command, reply in zip(commands, replies)]
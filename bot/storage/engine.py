@@ -0,0 +1,378 @@
+"""Redis command semantics on top of a simple keyspace, for embedded backends.
+
+The memory and SQLite backends only provide the storage primitives of
+``Keyspace``; this module implements the commands on them, including TTLs,
+type checks and Lua scripts (through their registered Python fallbacks).
+Replies are raw Redis replies (strings, ints, lists, None) and get cast by
+``bot.storage.base`` like any other backend's.
+"""
+import time
+from contextlib import AbstractContextManager
+
+from bot.storage.base import StorageBackend, StorageError, script_fallback
+
+WRONGTYPE = "WRONGTYPE Operation against a key holding the wrong kind of value"
+
+
+def _str(value) -> str:
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, float):
+        return _fmt_float(value)
+    return str(value)
+
+
+def _fmt_float(value: float) -> str:
+    return f"{value:.17g}"
+
+
+def _int(value) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise StorageError("ERR value is not an integer or out of range") from None
+
+
+def _float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise StorageError("ERR value is not a valid float") from None
+
+
+def _score_bound(value) -> tuple[float, bool]:
+    """Parse a ZRANGEBYSCORE bound into ``(score, exclusive)``."""
+    text = _str(value)
+    exclusive = text.startswith("(")
+    text = text[1:] if exclusive else text
+    if text in ("-inf", "+inf", "inf"):
+        return float(text if text != "inf" else "+inf"), exclusive
+    return _float(text), exclusive
+
+
+class Keyspace:
+    """Storage primitives a backend must provide.
+
+    Collections (set, hash, zset, hll) are stored as ``field -> value``
+    rows; sets and HyperLogLogs use an empty value, sorted sets the score.
+    Lookups must treat expired keys as missing.
+    """
+
+    def atomic(self) -> AbstractContextManager:
+        raise NotImplementedError
+
+    def kind(self, key: str) -> str | None:
+        raise NotImplementedError
+
+    def get_value(self, key: str) -> str | None:
+        raise NotImplementedError
+
+    def put_value(self, key: str, value: str) -> None:
+        raise NotImplementedError
+
+    def remove(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def expiry(self, key: str) -> float | None:
+        raise NotImplementedError
+
+    def set_expiry(self, key: str, at: float | None) -> None:
+        raise NotImplementedError
+
+    def field_get(self, key: str, field: str) -> str | None:
+        raise NotImplementedError
+
+    def field_put(self, key: str, kind: str, field: str, value: str) -> bool:
+        """Store a field, creating the key; returns True if the field is new."""
+        raise NotImplementedError
+
+    def field_remove(self, key: str, field: str) -> bool:
+        """Remove a field, dropping the key with its last field."""
+        raise NotImplementedError
+
+    def fields(self, key: str) -> list[tuple[str, str]]:
+        raise NotImplementedError
+
+    def field_count(self, key: str) -> int:
+        raise NotImplementedError
+
+
+class EngineBackend(StorageBackend):
+    """A backend that executes commands locally against a ``Keyspace``."""
+
+    def __init__(self, keyspace: Keyspace):
+        self.keyspace = keyspace
+
+    def _run(self, command: list):
+        with self.keyspace.atomic():
+            return self._dispatch(command)
+
+    def _run_many(self, commands: list[list]) -> list:
+        replies = []
+        with self.keyspace.atomic():
+            for command in commands:
+                try:
+                    replies.append(self._dispatch(command))
+                except StorageError as e:
+                    replies.append(e)
+        return replies
+
+    def _dispatch(self, command: list):
+        name = _str(command[0]).upper()
+        handler = getattr(self, f"_cmd_{name.lower()}", None)
+        if handler is None:
+            raise StorageError(f"ERR {name} is not supported by the {self.name} backend")
+        return handler(*command[1:])
+
+    def _expect(self, key: str, kind: str) -> bool:
+        """True if ``key`` exists with ``kind``; raises on a type mismatch."""
+        found = self.keyspace.kind(key)
+        if found is None:
+            return False
+        if found != kind:
+            raise StorageError(WRONGTYPE)
+        return True
+
+    # -- generic ------------------------------------------------------------
+
+    def _cmd_ping(self, message=None):
+        return "PONG" if message is None else _str(message)
+
+    def _cmd_del(self, *keys):
+        return sum(self.keyspace.remove(_str(k)) for k in keys)
+
+    def _cmd_exists(self, *keys):
+        return sum(self.keyspace.kind(_str(k)) is not None for k in keys)
+
+    def _cmd_expire(self, key, seconds):
+        return self._cmd_pexpire(key, _int(seconds) * 1000)
+
+    def _cmd_pexpire(self, key, milliseconds):
+        key = _str(key)
+        if self.keyspace.kind(key) is None:
+            return 0
+        self.keyspace.set_expiry(key, time.time() + _int(milliseconds) / 1000)
+        return 1
+
+    def _cmd_pttl(self, key):
+        key = _str(key)
+        if self.keyspace.kind(key) is None:
+            return -2
+        at = self.keyspace.expiry(key)
+        return -1 if at is None else max(int((at - time.time()) * 1000), 0)
+
+    def _cmd_ttl(self, key):
+        ms = self._cmd_pttl(key)
+        return ms if ms < 0 else (ms + 999) // 1000
+
+    def _cmd_eval(self, script, numkeys, *rest):
+        numkeys = _int(numkeys)
+        keys = [_str(k) for k in rest[:numkeys]]
+        args = [_str(a) for a in rest[numkeys:]]
+        fallback = script_fallback(_str(script))
+        return fallback(lambda *command: self._dispatch(list(command)), keys, args)
+
+    # -- strings ------------------------------------------------------------
+
+    def _cmd_get(self, key):
+        key = _str(key)
+        if not self._expect(key, "string"):
+            return None
+        return self.keyspace.get_value(key)
+
+    def _cmd_set(self, key, value, *options):
+        key = _str(key)
+        opts = [_str(o).upper() for o in options]
+        exists = self.keyspace.kind(key) is not None
+        old = self._cmd_get(key) if "GET" in opts else None
+        if ("NX" in opts and exists) or ("XX" in opts and not exists):
+            return old if "GET" in opts else None
+        expires_at = None
+        for unit, scale in (("EX", 1.0), ("PX", 0.001)):
+            if unit in opts:
+                expires_at = time.time() + _int(options[opts.index(unit) + 1]) * scale
+        keep_ttl = "KEEPTTL" in opts and exists
+        previous = self.keyspace.expiry(key) if keep_ttl else None
+        if exists and self.keyspace.kind(key) != "string":
+            self.keyspace.remove(key)
+        self.keyspace.put_value(key, _str(value))
+        self.keyspace.set_expiry(key, previous if keep_ttl else expires_at)
+        return old if "GET" in opts else "OK"
+
+    def _cmd_setex(self, key, seconds, value):
+        return self._cmd_set(key, value, "EX", seconds)
+
+    def _cmd_getdel(self, key):
+        value = self._cmd_get(key)
+        if value is not None:
+            self.keyspace.remove(_str(key))
+        return value
+
+    def _cmd_mget(self, *keys):
+        return [
+            self.keyspace.get_value(_str(k)) if self.keyspace.kind(_str(k)) == "string" else None
+            for k in keys
+        ]
+
+    def _cmd_incrby(self, key, increment):
+        key = _str(key)
+        current = _int(self._cmd_get(key) or 0)
+        value = current + _int(increment)
+        self.keyspace.put_value(key, str(value))
+        return value
+
+    def _cmd_incr(self, key):
+        return self._cmd_incrby(key, 1)
+
+    def _cmd_decrby(self, key, decrement):
+        return self._cmd_incrby(key, -_int(decrement))
+
+    def _cmd_decr(self, key):
+        return self._cmd_incrby(key, -1)
+
+    def _cmd_incrbyfloat(self, key, increment):
+        key = _str(key)
+        value = _fmt_float(_float(self._cmd_get(key) or 0) + _float(increment))
+        self.keyspace.put_value(key, value)
+        return value
+
+    # -- collections ----------------------------------------------------------
+
+    def _add_fields(self, key, kind, pairs) -> int:
+        key = _str(key)
+        self._expect(key, kind)
+        return sum(self.keyspace.field_put(key, kind, _str(f), v) for f, v in pairs)
+
+    def _members(self, key, kind) -> list[tuple[str, str]]:
+        key = _str(key)
+        return self.keyspace.fields(key) if self._expect(key, kind) else []
+
+    # -- sets -----------------------------------------------------------------
+
+    def _cmd_sadd(self, key, *members):
+        return self._add_fields(key, "set", [(m, "") for m in members])
+
+    def _cmd_srem(self, key, *members):
+        key = _str(key)
+        if not self._expect(key, "set"):
+            return 0
+        return sum(self.keyspace.field_remove(key, _str(m)) for m in members)
+
+    def _cmd_sismember(self, key, member):
+        key = _str(key)
+        if not self._expect(key, "set"):
+            return 0
+        return int(self.keyspace.field_get(key, _str(member)) is not None)
+
+    def _cmd_scard(self, key):
+        key = _str(key)
+        return self.keyspace.field_count(key) if self._expect(key, "set") else 0
+
+    def _cmd_smembers(self, key):
+        return [m for m, _ in self._members(key, "set")]
+
+    def _cmd_sscan(self, key, cursor, *options):
+        opts = [_str(o).upper() for o in options]
+        count = _int(options[opts.index("COUNT") + 1]) if "COUNT" in opts else 10
+        members = sorted(m for m, _ in self._members(key, "set"))
+        start = _int(cursor)
+        page = members[start:start + count]
+        next_cursor = start + count if start + count < len(members) else 0
+        return [str(next_cursor), page]
+
+    # -- hashes ---------------------------------------------------------------
+
+    def _cmd_hget(self, key, field):
+        key = _str(key)
+        return self.keyspace.field_get(key, _str(field)) if self._expect(key, "hash") else None
+
+    def _cmd_hset(self, key, *pairs):
+        return self._add_fields(key, "hash", [(pairs[i], _str(pairs[i + 1])) for i in range(0, len(pairs), 2)])
+
+    def _cmd_hdel(self, key, *fields):
+        key = _str(key)
+        if not self._expect(key, "hash"):
+            return 0
+        return sum(self.keyspace.field_remove(key, _str(f)) for f in fields)
+
+    def _cmd_hincrby(self, key, field, increment):
+        value = _int(self._cmd_hget(key, field) or 0) + _int(increment)
+        self._add_fields(key, "hash", [(field, str(value))])
+        return value
+
+    def _cmd_hincrbyfloat(self, key, field, increment):
+        value = _fmt_float(_float(self._cmd_hget(key, field) or 0) + _float(increment))
+        self._add_fields(key, "hash", [(field, value)])
+        return value
+
+    def _cmd_hgetall(self, key):
+        flat = []
+        for field, value in self._members(key, "hash"):
+            flat += [field, value]
+        return flat
+
+    # -- HyperLogLog (exact: members are kept as a set) -----------------------
+
+    def _cmd_pfadd(self, key, *elements):
+        key = _str(key)
+        created = not self._expect(key, "hll")
+        added = self._add_fields(key, "hll", [(e, "") for e in elements])
+        return int(bool(added) or created)
+
+    def _cmd_pfcount(self, *keys):
+        union = set()
+        for key in keys:
+            union.update(m for m, _ in self._members(key, "hll"))
+        return len(union)
+
+    # -- sorted sets ----------------------------------------------------------
+
+    def _cmd_zadd(self, key, *args):
+        opts = []
+        args = list(args)
+        while args and _str(args[0]).upper() in ("NX", "XX"):
+            opts.append(_str(args.pop(0)).upper())
+        key = _str(key)
+        self._expect(key, "zset")
+        added = 0
+        for i in range(0, len(args), 2):
+            member = _str(args[i + 1])
+            exists = self.keyspace.field_get(key, member) is not None
+            if ("NX" in opts and exists) or ("XX" in opts and not exists):
+                continue
+            added += self.keyspace.field_put(key, "zset", member, _fmt_float(_float(args[i])))
+        return added
+
+    def _cmd_zrem(self, key, *members):
+        key = _str(key)
+        if not self._expect(key, "zset"):
+            return 0
+        return sum(self.keyspace.field_remove(key, _str(m)) for m in members)
+
+    def _cmd_zcard(self, key):
+        key = _str(key)
+        return self.keyspace.field_count(key) if self._expect(key, "zset") else 0
+
+    def _cmd_zscore(self, key, member):
+        key = _str(key)
+        return self.keyspace.field_get(key, _str(member)) if self._expect(key, "zset") else None
+
+    def _cmd_zrangebyscore(self, key, min_score, max_score, *options):
+        low, low_excl = _score_bound(min_score)
+        high, high_excl = _score_bound(max_score)
+        opts = [_str(o).upper() for o in options]
+        entries = sorted(((float(s), m) for m, s in self._members(key, "zset")))
+        entries = [
+            (s, m) for s, m in entries
+            if (s > low if low_excl else s >= low) and (s < high if high_excl else s <= high)
+        ]
+        if "LIMIT" in opts:
+            i = opts.index("LIMIT")
+            offset, count = _int(options[i + 1]), _int(options[i + 2])
+            entries = entries[offset:] if count < 0 else entries[offset:offset + count]
+        if "WITHSCORES" in opts:
+            flat = []
+            for s, m in entries:
+                flat += [m, _fmt_float(s)]
+            return flat
+        return [m for _, m in entries]
@@ -0,0 +1,93 @@
+"""In-process storage backend (STORAGE_BACKEND=memory).
+
+Data lives in dicts and disappears with the process: meant for tests,
+benchmarks and local experiments, not for serverless deployments where
+every instance would see its own data.
+"""
+import threading
+import time
+
+from bot.storage.engine import EngineBackend, Keyspace
+
+
+class MemoryKeyspace(Keyspace):
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._kinds: dict[str, str] = {}
+        self._values: dict[str, str] = {}
+        self._fields: dict[str, dict[str, str]] = {}
+        self._expiry: dict[str, float] = {}
+
+    def atomic(self):
+        return self._lock
+
+    def kind(self, key: str) -> str | None:
+        at = self._expiry.get(key)
+        if at is not None and at <= time.time():
+            self.remove(key)
+        return self._kinds.get(key)
+
+    def get_value(self, key: str) -> str | None:
+        return self._values.get(key) if self.kind(key) == "string" else None
+
+    def put_value(self, key: str, value: str) -> None:
+        self.kind(key)  # drop an expired predecessor first
+        self._kinds[key] = "string"
+        self._values[key] = value
+
+    def remove(self, key: str) -> bool:
+        existed = self._kinds.pop(key, None) is not None
+        self._values.pop(key, None)
+        self._fields.pop(key, None)
+        self._expiry.pop(key, None)
+        return existed
+
+    def expiry(self, key: str) -> float | None:
+        return self._expiry.get(key)
+
+    def set_expiry(self, key: str, at: float | None) -> None:
+        if at is None:
+            self._expiry.pop(key, None)
+        else:
+            self._expiry[key] = at
+
+    def field_get(self, key: str, field: str) -> str | None:
+        return self._fields.get(key, {}).get(field) if self.kind(key) else None
+
+    def field_put(self, key: str, kind: str, field: str, value: str) -> bool:
+        if self.kind(key) is None:
+            self._kinds[key] = kind
+            self._fields[key] = {}
+        fields = self._fields[key]
+        is_new = field not in fields
+        fields[field] = value
+        return is_new
+
+    def field_remove(self, key: str, field: str) -> bool:
+        fields = self._fields.get(key) if self.kind(key) else None
+        if not fields or field not in fields:
+            return False
+        del fields[field]
+        if not fields:
+            self.remove(key)
+        return True
+
+    def fields(self, key: str) -> list[tuple[str, str]]:
+        return list(self._fields.get(key, {}).items()) if self.kind(key) else []
+
+    def field_count(self, key: str) -> int:
+        return len(self._fields.get(key, {})) if self.kind(key) else 0
+
+
+class MemoryBackend(EngineBackend):
+    name = "memory"
+
+    def __init__(self):
+        super().__init__(MemoryKeyspace())
+
+    def flushall(self) -> None:
+        """Drop all data (test helper)."""
+        ks = self.keyspace
+        with ks.atomic():
+            for store in (ks._kinds, ks._values, ks._fields, ks._expiry):
+                store.clear()
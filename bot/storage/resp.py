@@ -0,0 +1,137 @@
+"""Redis over TCP with the RESP protocol (STORAGE_BACKEND=redis, REDIS_URL=...).
+
+For self-hosted deployments with a reachable Redis: commands go over
+persistent, pooled TCP (optionally TLS) connections instead of one HTTPS
+request per call, and a pipeline is written in one batch and read back in
+one pass.  No client library is needed; the protocol subset is small.
+"""
+import queue
+import socket
+import ssl
+import urllib.parse
+
+from bot.storage.base import StorageBackend, StorageError
+
+
+def encode_command(command: list) -> bytes:
+    parts = [f"*{len(command)}\r\n".encode()]
+    for arg in command:
+        if isinstance(arg, bytes):
+            data = arg
+        elif isinstance(arg, float):
+            data = repr(arg).encode()
+        else:
+            data = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+
+class _Connection:
+    def __init__(self, host: str, port: int, timeout: float, use_tls: bool):
+        sock = socket.create_connection((host, port), timeout=timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if use_tls:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+
+    def send(self, payload: bytes) -> None:
+        self.sock.sendall(payload)
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Redis closed the connection")
+        prefix, body = line[:1], line[1:-2]
+        if prefix == b"+":
+            return body.decode()
+        if prefix == b"-":
+            return StorageError(body.decode())
+        if prefix == b":":
+            return int(body)
+        if prefix == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)[:-2]
+            return data.decode()
+        if prefix == b"*":
+            length = int(body)
+            if length < 0:
+                return None
+            return [self.read_reply() for _ in range(length)]
+        raise ConnectionError(f"Unexpected RESP reply: {line!r}")
+
+    def close(self) -> None:
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RespBackend(StorageBackend):
+    name = "redis"
+
+    def __init__(self, url: str, pool_size: int = 10, timeout: float = 5.0):
+        parsed = urllib.parse.urlparse(url)
+        self._host = parsed.hostname or "localhost"
+        self._port = parsed.port or 6379
+        self._tls = parsed.scheme == "rediss"
+        self._username = urllib.parse.unquote(parsed.username) if parsed.username else None
+        self._password = urllib.parse.unquote(parsed.password) if parsed.password else None
+        self._db = int(parsed.path.lstrip("/") or 0)
+        self._timeout = timeout
+        self._pool: queue.LifoQueue = queue.LifoQueue(maxsize=pool_size)
+
+    def _connect(self) -> _Connection:
+        conn = _Connection(self._host, self._port, self._timeout, self._tls)
+        setup = []
+        if self._password:
+            setup.append(["AUTH", *([self._username] if self._username else []), self._password])
+        if self._db:
+            setup.append(["SELECT", self._db])
+        if setup:
+            conn.send(b"".join(encode_command(c) for c in setup))
+            for _ in setup:
+                reply = conn.read_reply()
+                if isinstance(reply, StorageError):
+                    conn.close()
+                    raise reply
+        return conn
+
+    def _acquire(self) -> _Connection:
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def _release(self, conn: _Connection) -> None:
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _run_many(self, commands: list[list]) -> list:
+        conn = self._acquire()
+        try:
+            conn.send(b"".join(encode_command(c) for c in commands))
+            replies = [conn.read_reply() for _ in commands]
+        except (OSError, ConnectionError):
+            conn.close()  # state unknown: never return it to the pool
+            raise
+        self._release(conn)
+        return replies
+
+    def _run(self, command: list):
+        reply = self._run_many([command])[0]
+        if isinstance(reply, StorageError):
+            raise reply
+        return reply
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
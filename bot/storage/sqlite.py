@@ -0,0 +1,155 @@
+"""SQLite storage backend (STORAGE_BACKEND=sqlite, SQLITE_PATH=...).
+
+For single-node installs that don't want to run Redis: data is kept in one
+database file with two tables — ``keys`` (type, string value, expiry) and
+``fields`` (members of sets, hashes, sorted sets and HyperLogLogs).  Every
+command or pipeline runs in one transaction; the connection is shared by
+the threads of the process behind a lock.
+"""
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from bot.storage.engine import EngineBackend, Keyspace
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS keys (
+    key        TEXT PRIMARY KEY,
+    kind       TEXT NOT NULL,
+    value      TEXT,
+    expires_at REAL
+);
+CREATE TABLE IF NOT EXISTS fields (
+    key   TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (key, field)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS keys_expires_at ON keys (expires_at) WHERE expires_at IS NOT NULL;
+"""
+
+
+class SQLiteKeyspace(Keyspace):
+    def __init__(self, path: str):
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+
+    @contextmanager
+    def atomic(self):
+        with self._lock:
+            outermost = self._depth == 0
+            if outermost:
+                self._db.execute("BEGIN IMMEDIATE")
+            self._depth += 1
+            try:
+                yield
+            except BaseException:
+                self._depth -= 1
+                if outermost:
+                    self._db.execute("ROLLBACK")
+                raise
+            self._depth -= 1
+            if outermost:
+                self._db.execute("COMMIT")
+
+    def _row(self, key: str):
+        row = self._db.execute(
+            "SELECT kind, value, expires_at FROM keys WHERE key = ?", (key,)
+        ).fetchone()
+        if row and row[2] is not None and row[2] <= time.time():
+            self.remove(key)
+            return None
+        return row
+
+    def kind(self, key: str) -> str | None:
+        row = self._row(key)
+        return row[0] if row else None
+
+    def get_value(self, key: str) -> str | None:
+        row = self._row(key)
+        return row[1] if row and row[0] == "string" else None
+
+    def put_value(self, key: str, value: str) -> None:
+        self._row(key)  # drop an expired predecessor first
+        self._db.execute(
+            "INSERT INTO keys (key, kind, value) VALUES (?, 'string', ?) "
+            "ON CONFLICT(key) DO UPDATE SET kind = 'string', value = excluded.value",
+            (key, value),
+        )
+
+    def remove(self, key: str) -> bool:
+        deleted = self._db.execute("DELETE FROM keys WHERE key = ?", (key,)).rowcount
+        self._db.execute("DELETE FROM fields WHERE key = ?", (key,))
+        return bool(deleted)
+
+    def expiry(self, key: str) -> float | None:
+        row = self._row(key)
+        return row[2] if row else None
+
+    def set_expiry(self, key: str, at: float | None) -> None:
+        self._db.execute("UPDATE keys SET expires_at = ? WHERE key = ?", (at, key))
+
+    def field_get(self, key: str, field: str) -> str | None:
+        if not self._row(key):
+            return None
+        row = self._db.execute(
+            "SELECT value FROM fields WHERE key = ? AND field = ?", (key, field)
+        ).fetchone()
+        return row[0] if row else None
+
+    def field_put(self, key: str, kind: str, field: str, value: str) -> bool:
+        if not self._row(key):
+            self._db.execute("INSERT INTO keys (key, kind) VALUES (?, ?)", (key, kind))
+        is_new = self._db.execute(
+            "SELECT 1 FROM fields WHERE key = ? AND field = ?", (key, field)
+        ).fetchone() is None
+        self._db.execute(
+            "INSERT INTO fields (key, field, value) VALUES (?, ?, ?) "
+            "ON CONFLICT(key, field) DO UPDATE SET value = excluded.value",
+            (key, field, value),
+        )
+        return is_new
+
+    def field_remove(self, key: str, field: str) -> bool:
+        if not self._row(key):
+            return False
+        removed = self._db.execute(
+            "DELETE FROM fields WHERE key = ? AND field = ?", (key, field)
+        ).rowcount
+        if removed and not self.field_count(key):
+            self.remove(key)
+        return bool(removed)
+
+    def fields(self, key: str) -> list[tuple[str, str]]:
+        if not self._row(key):
+            return []
+        return self._db.execute(
+            "SELECT field, value FROM fields WHERE key = ?", (key,)
+        ).fetchall()
+
+    def field_count(self, key: str) -> int:
+        if not self._row(key):
+            return 0
+        return self._db.execute("SELECT COUNT(*) FROM fields WHERE key = ?", (key,)).fetchone()[0]
+
+    def purge_expired(self) -> int:
+        """Delete all expired keys (lookups skip them anyway; this reclaims space)."""
+        with self.atomic():
+            expired = [k for (k,) in self._db.execute(
+                "SELECT key FROM keys WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),)
+            )]
+            for key in expired:
+                self.remove(key)
+        return len(expired)
+
+
+class SQLiteBackend(EngineBackend):
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        super().__init__(SQLiteKeyspace(path))
@@ -0,0 +1,282 @@
+"""Background variants: several Kie images for one postcard, the user picks one.
+
+With /variants enabled, ``start_generation`` fans out VARIANTS_COUNT Kie
+tasks for the same prompt.  Each callback records its result in a
+per-set hash; the first one to arrive becomes the collector and waits —
+polling with backoff — until every variant has reported or the set's
+deadline has passed.  It then renders whatever arrived in parallel off
+the event loop and sends them as one media group with pick buttons.  A
+set costs one credit, however many variants made it.
+
+The collector role is a lease, and the collector keeps its own Kie task
+unfinished until the set is out: if its invocation dies or fails, a
+redelivery of its callback — or any later variant, once the lease has
+lapsed — collects the set instead.
+"""
+import asyncio
+import logging
+import time
+import uuid
+
+from aiogram import Bot
+from aiogram.types import BufferedInputFile, InputMediaPhoto
+
+from bot import deadline, metrics
+from bot.config import FREE_CREDITS, KIE_QUEUE_TIMEOUT, VARIANTS_DEADLINE
+from bot.database import (
+    complete_pending_image_task,
+    create_variant_set,
+    finalize_postcard,
+    get_delivery_context,
+    get_variant_progress,
+    record_failed_variants,
+    record_variant_result,
+    release_pending_image_task,
+    release_variant_collector,
+    save_variant_cards,
+)
+from bot.keyboards import build_variant_keyboard
+
+logger = logging.getLogger(__name__)
+
+VARIANT_SET_TTL = 86_400  # the pick buttons stay usable for a day
+_POLL_INITIAL = 0.5
+_POLL_MAX = 4.0
+_DELIVERY_RESERVE = 10.0  # seconds of the invocation budget kept for download, render and send
+# Longer than a collector can take, shorter than the 120 s Kie task lease,
+# so a redelivered callback of a dead collector finds the role free
+_COLLECTOR_LEASE = int(VARIANTS_DEADLINE) + 60
+
+
+async def start_variants(
+    count: int,
+    image_prompt: str,
+    chat_id: int,
+    message_id: int,
+    payload: dict,
+    caption: str,
+    timings: dict | None = None,
+    on_queue_position=None,
+) -> list[str]:
+    """Create ``count`` Kie tasks for one postcard concurrently; returns their task ids.
+
+    Each variant takes its own Kie slot; the first one reports the queue
+    position through ``on_queue_position``.
+
+    Tasks that fail to be created are recorded as empty results right away,
+    so the collector doesn't wait for them.  Raises the first error if none
+    could be created.
+
+    The set's VARIANTS_DEADLINE runs from when the creations returned, not
+    from the request: each may first wait in the Kie queue.  Until then the
+    deadline allows for the whole queue wait, and a collector that is
+    already waiting picks up the final one on its next poll.
+    """
+    from bot.services import create_image_task_async
+
+    set_id = uuid.uuid4().hex[:12]
+    meta = {
+        "chat_id": chat_id,
+        "expected": count,
+        "deadline": time.time() + KIE_QUEUE_TIMEOUT + VARIANTS_DEADLINE,
+    }
+    create_variant_set(set_id, meta, VARIANT_SET_TTL)
+
+    results = await asyncio.gather(
+        *(
+            create_image_task_async(
+                image_prompt=image_prompt,
+                chat_id=chat_id,
+                message_id=message_id,
+                payload=payload,
+                caption=caption,
+                timings=timings,
+                extra={"variant_set": set_id},
+                on_queue_position=on_queue_position if i == 0 else None,
+            )
+            for i in range(count)
+        ),
+        return_exceptions=True,
+    )
+    task_ids = [r for r in results if isinstance(r, str)]
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if not task_ids:
+        raise errors[0]
+    if errors:
+        logger.warning(f"VARIANTS: set {set_id} lost {len(errors)} variant(s) at creation: {errors[0]}")
+        await asyncio.to_thread(record_failed_variants, set_id, len(errors), VARIANT_SET_TTL)
+    meta["deadline"] = time.time() + VARIANTS_DEADLINE
+    await asyncio.to_thread(create_variant_set, set_id, meta, VARIANT_SET_TTL)
+    logger.info(f"VARIANTS: set {set_id} started with {len(task_ids)}/{count} tasks")
+    return task_ids
+
+
+async def _wait_for_rest(set_id: str, meta: dict, results: dict) -> dict:
+    """Poll the set's results until all variants reported or the deadline passed.
+
+    The deadline is re-read with the results, as it is moved once the
+    creations return.  The wait also ends early if the invocation's time
+    budget is running out.
+    """
+    delay = _POLL_INITIAL
+    while len(results) < meta["expected"]:
+        left = meta["deadline"] - time.time()
+        budget_left = deadline.remaining()
+        if budget_left is not None:
+            left = min(left, budget_left - _DELIVERY_RESERVE)
+        if left <= 0:
+            break
+        await asyncio.sleep(min(delay, left))
+        delay = min(delay * 2, _POLL_MAX)
+        latest, results = await asyncio.to_thread(get_variant_progress, set_id)
+        meta = latest or meta
+    return results
+
+
+async def collect_variant(
+    task_id: str,
+    task_data: dict,
+    state: str,
+    result_json: dict,
+    bot: Bot,
+    lease_token: str,
+) -> bool:
+    """Handle the Kie callback of one variant (the task is already claimed)."""
+    if state not in ("success", "fail"):
+        logger.warning(f"VARIANTS: unexpected state={state} for taskId={task_id}")
+        release_pending_image_task(task_id, lease_token)
+        return False
+
+    set_id = task_data["variant_set"]
+    url = (result_json.get("resultUrls") or [""])[0] if state == "success" else ""
+    metrics.incr("kie_tasks_total", outcome="success" if url else "fail")
+    meta, results, is_collector = await asyncio.to_thread(
+        record_variant_result, set_id, task_id, url, VARIANT_SET_TTL, _COLLECTOR_LEASE
+    )
+    if meta is None or not is_collector:
+        await asyncio.to_thread(complete_pending_image_task, task_id)
+        if meta is None:
+            logger.warning(f"VARIANTS: set {set_id} of taskId={task_id} has expired")
+            return False
+        logger.info(f"VARIANTS: set {set_id} got {len(results)}/{meta['expected']}")
+        return True
+
+    try:
+        results = await _wait_for_rest(set_id, meta, results)
+        delivered = await deliver(set_id, meta, results, task_data, bot)
+    except BaseException:
+        # Hand the set over: a later or redelivered callback collects it
+        await asyncio.to_thread(release_variant_collector, set_id, task_id)
+        release_pending_image_task(task_id, lease_token)
+        raise
+    await asyncio.to_thread(complete_pending_image_task, task_id)
+    return delivered
+
+
+async def deliver(set_id: str, meta: dict, results: dict, task_data: dict, bot: Bot) -> bool:
+    """Render the arrived variants in parallel and send them for the user to pick."""
+    from bot.render import apply_text_to_image
+    from bot.rerender import remember_background
+    from bot.services import download_image, postcard_caption, postcard_text
+
+    chat_id = task_data["chat_id"]
+    message_id = task_data["message_id"]
+    payload = task_data["payload"]
+    caption_for_db = task_data["caption_for_db"]
+    font_name = payload.get("font", "Comfortaa")
+    arrived = sorted((tid, url) for tid, url in results.items() if url)
+
+    downloads = await asyncio.gather(
+        *(download_image(url) for _, url in arrived),
+        asyncio.to_thread(get_delivery_context, chat_id),
+        return_exceptions=True,
+    )
+    delivery_context = downloads.pop()
+    if isinstance(delivery_context, BaseException):
+        raise delivery_context
+    credits, gallery = delivery_context
+    backgrounds = [(tid, data) for (tid, _), data in zip(arrived, downloads) if isinstance(data, bytes)]
+
+    if not backgrounds:
+        metrics.incr("variant_sets_total", outcome="empty")
+        save_variant_cards(set_id, {"chat_id": chat_id, "cards": []}, VARIANT_SET_TTL)
+        await bot.edit_message_text(
+            "\U0001f614 Нейросеть не смогла сгенерировать ни одного варианта.\n"
+            "Ваш кредит <b>не списан</b>. Попробуйте ещё раз.",
+            chat_id=chat_id,
+            message_id=message_id,
+            parse_mode="HTML",
+        )
+        return False
+
+    text_to_draw = postcard_text(payload)
+    with metrics.timed("postcard_stage_seconds", stage="render"):
+        cards = await asyncio.gather(*(
+            asyncio.to_thread(apply_text_to_image, data, text_to_draw, font_name)
+            for _, data in backgrounds
+        ))
+
+    files = [
+        BufferedInputFile(card, filename=f"variant_{i + 1}.jpg") for i, card in enumerate(cards)
+    ]
+    with metrics.timed("postcard_stage_seconds", stage="send_photo"):
+        if len(files) == 1:  # a media group needs at least two items
+            sent = [await bot.send_photo(chat_id=chat_id, photo=files[0], caption="Вариант 1")]
+        else:
+            sent = await bot.send_media_group(chat_id=chat_id, media=[
+                InputMediaPhoto(media=f, caption=f"Вариант {i + 1}") for i, f in enumerate(files)
+            ])
+    try:
+        await bot.delete_message(chat_id=chat_id, message_id=message_id)
+    except Exception:
+        pass
+
+    estimated = (FREE_CREDITS if credits is None else credits) - 1
+    pm_caption = postcard_caption(caption_for_db, estimated)
+    record = {
+        "chat_id": chat_id,
+        "font": font_name,
+        "caption": pm_caption,
+        "greeting": caption_for_db,
+        "cards": [
+            {"task_id": tid, "file_id": msg.photo[-1].file_id if msg.photo else None}
+            for (tid, _), msg in zip(backgrounds, sent)
+        ],
+    }
+    # The cards are out: record the set as delivered first, and don't let a
+    # failure below turn into a second delivery (and charge) by a takeover
+    try:
+        save_variant_cards(set_id, record, VARIANT_SET_TTL)
+        # One credit for the set; the picked card goes to the gallery when chosen
+        remaining = finalize_postcard(chat_id, backgrounds[0][0], None, caption_for_db, gallery, credits, payload)
+        if remaining != estimated:  # another delivery or a purchase landed meanwhile
+            record["caption"] = pm_caption = postcard_caption(caption_for_db, remaining)
+            save_variant_cards(set_id, record, VARIANT_SET_TTL)
+        await bot.send_message(
+            chat_id,
+            f"Какой вариант оставить? Готово {len(backgrounds)} из {meta['expected']}.",
+            reply_markup=build_variant_keyboard(set_id, len(backgrounds)),
+        )
+    except Exception as e:
+        logger.error(f"VARIANTS: set {set_id} was sent but not fully recorded: {e}", exc_info=True)
+
+    outcome = "complete" if len(backgrounds) == meta["expected"] else "partial"
+    metrics.incr("variant_sets_total", outcome=outcome)
+    timings = task_data.get("timings") or {}
+    if "requested" in timings:
+        metrics.observe("postcard_stage_seconds", time.time() - timings["requested"], stage="end_to_end")
+    logger.info(f"VARIANTS: set {set_id} delivered {len(backgrounds)}/{meta['expected']} to chat_id={chat_id}")
+
+    # Keep every background so the picked one can be redrawn with the usual buttons
+    for tid, data in backgrounds:
+        try:
+            await asyncio.to_thread(remember_background, tid, data, {
+                "chat_id": chat_id,
+                "text": text_to_draw,
+                "font": font_name,
+                "caption": pm_caption,
+                "greeting": caption_for_db,
+            })
+        except Exception as e:
+            logger.warning(f"VARIANTS: could not keep background of {tid}: {e}")
+    return True
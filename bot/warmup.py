@@ -0,0 +1,87 @@
+"""Warm-up routine for a fresh instance.
+
+Moves one-off costs out of the first user's request: reading fonts into
+the renderer cache, Pillow codec/FreeType initialisation, and the first TLS
+handshakes to Redis, Kie, ProTalk and Telegram.  Every phase is timed so
+keep-warm pings can be scheduled from real numbers.
+"""
+import asyncio
+import io
+import logging
+import time
+
+import aiohttp
+from aiogram import Bot
+
+from bot import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _warm_fonts() -> None:
+    from bot.render import preload_fonts
+    preload_fonts()
+
+
+def _warm_render() -> None:
+    from PIL import Image
+    from bot.render import apply_text_to_image
+
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 64), (200, 200, 200)).save(buf, format="JPEG")
+    apply_text_to_image(buf.getvalue(), "Привет!", "Comfortaa")
+
+
+def _warm_redis() -> None:
+    from bot.database import kv
+    kv.ping()
+
+
+async def _warm_http() -> None:
+    from bot.services import http_connector, KIE_API_BASE, PROTALK_API_BASE
+
+    timeout = aiohttp.ClientTimeout(total=5)
+    async with aiohttp.ClientSession(
+        timeout=timeout, connector=http_connector(), connector_owner=False,
+    ) as session:
+        async def touch(url: str) -> None:
+            # Any response will do: the point is a pooled, already-handshaken connection.
+            async with session.head(url) as resp:
+                await resp.read()
+
+        await asyncio.gather(touch(KIE_API_BASE), touch(PROTALK_API_BASE))
+
+
+async def _timed(name: str, phases: dict, errors: dict, coro) -> None:
+    started = time.perf_counter()
+    try:
+        await coro
+    except Exception as e:
+        errors[name] = f"{type(e).__name__}: {e}"
+        logger.warning(f"WARMUP: {name} failed: {e}")
+    finally:
+        phases[name] = round(time.perf_counter() - started, 4)
+        metrics.observe(f"warmup_{name}_seconds", phases[name])
+
+
+async def warm_up(bot: Bot) -> dict:
+    """Run all warm-up phases and return their durations in seconds.
+
+    CPU-bound and blocking phases run in threads; network phases run
+    concurrently with them.  Failures are reported, never raised.
+    """
+    phases: dict[str, float] = {}
+    errors: dict[str, str] = {}
+    started = time.perf_counter()
+
+    await _timed("fonts", phases, errors, asyncio.to_thread(_warm_fonts))
+    await asyncio.gather(
+        _timed("render", phases, errors, asyncio.to_thread(_warm_render)),
+        _timed("redis", phases, errors, asyncio.to_thread(_warm_redis)),
+        _timed("http", phases, errors, _warm_http()),
+        _timed("telegram", phases, errors, bot.get_me()),
+    )
+
+    total = round(time.perf_counter() - started, 4)
+    logger.info(f"WARMUP: done in {total:.3f}s phases={phases} errors={list(errors)}")
+    return {"total": total, "phases": phases, "errors": errors}
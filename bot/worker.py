@@ -0,0 +1,142 @@
+"""Standalone generation worker.
+
+Runs N concurrent consumers on the generation stream (see ``bot.jobs``):
+
+    python -m bot.worker --concurrency 8
+
+Workers can be scaled independently of the webhook: each process joins the
+same consumer group, and jobs left behind by a crashed process are reclaimed
+after JOB_RECLAIM_IDLE_MS.  Requires GENERATION_QUEUE=1 on the webhook side.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import socket
+
+from aiogram import Bot
+
+from bot.config import (
+    TELEGRAM_BOT_TOKEN,
+    WORKER_CONCURRENCY,
+    WORKER_POLL_INTERVAL,
+    JOB_RECLAIM_IDLE_MS,
+    REQUEST_BUDGET,
+)
+from bot import deadline, metrics, redis_usage
+from bot.counters import aggregator
+from bot.database import is_image_task_open
+from bot.jobs import ensure_group, read_jobs, ack_job, reclaim_stale_jobs, queue_depth
+from bot.services import start_generation, process_kie_callback, telegram_session
+
+logger = logging.getLogger(__name__)
+
+
+class JobRetry(Exception):
+    """The job failed in a way a later attempt can fix; leave it pending."""
+
+
+async def handle_job(job: dict, bot: Bot) -> None:
+    """Run one job within REQUEST_BUDGET.  Raising leaves it pending so it can be reclaimed.
+
+    A ``create`` job's failure is final: ``start_generation`` has already
+    told the user to try again (no credit spent), so the job is acked.  A
+    ``complete`` job whose Kie task was handed back (still open after a
+    failed attempt) raises ``JobRetry`` — Kie was answered at enqueue time
+    and won't call again, so only the reclaim can finish it.
+    """
+    data = job["data"]
+    if job["kind"] == "create":
+        with deadline.budget(REQUEST_BUDGET, "start_generation"), redis_usage.track("start_generation"):
+            await start_generation(
+                data["chat_id"], data["message_id"], data["payload"], bot, data.get("timings"),
+            )
+    elif job["kind"] == "complete":
+        with deadline.budget(REQUEST_BUDGET, "process_kie_callback"), redis_usage.track("process_kie_callback"):
+            ok = await process_kie_callback(
+                task_id=data["task_id"],
+                state=data["state"],
+                result_json=data.get("result_json") or {},
+                fail_msg=data.get("fail_msg"),
+                bot=bot,
+                received_at=data.get("received_at"),
+            )
+        if not ok and await asyncio.to_thread(is_image_task_open, data["task_id"]):
+            raise JobRetry(f"taskId={data['task_id']} was handed back")
+    else:
+        logger.warning(f"WORKER: unknown job kind {job['kind']!r}, dropping {job['id']}")
+
+
+async def consume(name: str, bot: Bot, stop: asyncio.Event, reclaim: bool = False) -> None:
+    """Consumer loop; the ``reclaim`` consumer also sweeps stale pending jobs."""
+    logger.info(f"WORKER: consumer {name} started")
+    last_reclaim = 0.0
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        jobs = []
+        if reclaim and loop.time() - last_reclaim >= JOB_RECLAIM_IDLE_MS / 1000 / 2:
+            last_reclaim = loop.time()
+            try:
+                jobs = await asyncio.to_thread(reclaim_stale_jobs, name, JOB_RECLAIM_IDLE_MS)
+            except Exception as e:
+                logger.warning(f"WORKER: reclaim failed: {e}")
+        if not jobs:
+            try:
+                jobs = await asyncio.to_thread(read_jobs, name, 1)
+            except Exception as e:
+                logger.warning(f"WORKER: read failed: {e}")
+        if not jobs:
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=WORKER_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        for job in jobs:
+            try:
+                await handle_job(job, bot)
+            except Exception as e:
+                logger.error(f"WORKER: job {job['id']} failed, will be retried: {e}", exc_info=True)
+                continue
+            await asyncio.to_thread(ack_job, job["id"])
+        await asyncio.to_thread(aggregator.maybe_flush)
+        await asyncio.to_thread(metrics.flush_to_redis)
+    logger.info(f"WORKER: consumer {name} stopped")
+
+
+async def run_worker(concurrency: int = WORKER_CONCURRENCY) -> None:
+    ensure_group()
+    bot = Bot(token=TELEGRAM_BOT_TOKEN, session=telegram_session())
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    prefix = f"{socket.gethostname()}-{os.getpid()}"
+    logger.info(f"WORKER: starting {concurrency} consumers, queue depth {queue_depth()}")
+    try:
+        await asyncio.gather(*(
+            consume(f"{prefix}-{i}", bot, stop, reclaim=(i == 0))
+            for i in range(concurrency)
+        ))
+    finally:
+        await bot.session.close()
+        aggregator.flush(reason="shutdown")
+        metrics.flush_to_redis(force=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Postcard generation worker")
+    parser.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY,
+                        help="number of concurrent consumers")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_worker(args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+scripts/fake_services.py
+
+Local stand-ins for every external service the bot talks to, served by one
+aiohttp app so load tests run entirely offline:
+
+    /tg/bot<token>/<method>            Telegram Bot API (records what the bot sends)
+    /kie/api/v1/jobs/createTask        Kie task creation; the callback follows after
+                                       a configurable delay, failing at a given rate
+    /cdn/<name>.jpg                    Kie image CDN (one pre-rendered JPEG)
+    /protalk/api/v1.0/ask/<token>      ProTalk greeting text
+
+Point the bot at it with TELEGRAM_API_BASE=<base>/tg, KIE_API_BASE=<base>/kie
+and PROTALK_API_BASE=<base>/protalk.  Used by scripts/loadtest.py.
+"""
+import asyncio
+import io
+import itertools
+import json
+import random
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+
+import aiohttp
+from aiohttp import web
+
+
+@dataclass
+class FakeConfig:
+    kie_delay: float = 3.0           # mean seconds from createTask to callback
+    kie_jitter: float = 0.5          # +/- uniform jitter around kie_delay
+    kie_failure_rate: float = 0.0    # share of tasks that end with state=fail
+    protalk_delay: float = 0.5
+    protalk_failure_rate: float = 0.0
+    telegram_delay: float = 0.02     # per Bot API call
+    image_size: int = 1024
+
+
+def _render_background(size: int) -> bytes:
+    """A noisy gradient, so JPEG size and decode cost resemble a real generation."""
+    from PIL import Image
+
+    img = Image.linear_gradient("L").resize((size, size)).convert("RGB")
+    noise = Image.effect_noise((size, size), 40).convert("RGB")
+    buf = io.BytesIO()
+    Image.blend(img, noise, 0.35).save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+class ChatLog:
+    """What the bot sent to each chat, with waiters for the next message."""
+
+    def __init__(self):
+        self.messages: dict[int, list[dict]] = defaultdict(list)
+        self._waiters: dict[int, list[tuple[set, asyncio.Future]]] = defaultdict(list)
+
+    def record(self, chat_id: int, method: str, fields: dict) -> None:
+        entry = {"method": method, "at": time.time(), **fields}
+        self.messages[chat_id].append(entry)
+        for waiter in list(self._waiters[chat_id]):
+            methods, future = waiter
+            if method in methods and not future.done():
+                future.set_result(entry)
+                self._waiters[chat_id].remove(waiter)
+
+    def wait_for(self, chat_id: int, methods: set) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id].append((methods, future))
+        return future
+
+
+class FakeServices:
+    def __init__(self, config: FakeConfig):
+        self.config = config
+        self.chats = ChatLog()
+        self.counts: dict[str, int] = defaultdict(int)
+        self._ids = itertools.count(1)
+        self._image = _render_background(config.image_size)
+        self._client: aiohttp.ClientSession | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self.base_url = ""
+
+    # -- Telegram ---------------------------------------------------------
+
+    def _message(self, chat_id: int, **extra) -> dict:
+        return {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            **extra,
+        }
+
+    async def telegram(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.counts[f"telegram:{method}"] += 1
+        form = await request.post() if request.body_exists else {}
+        if self.config.telegram_delay:
+            await asyncio.sleep(self.config.telegram_delay)
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+            return web.json_response({"ok": True, "result": result})
+
+        chat_id = int(form.get("chat_id", 0) or 0)
+        if method in ("sendPhoto", "editMessageMedia"):
+            file_id = f"fake-photo-{next(self._ids)}"
+            photo = [{"file_id": file_id, "file_unique_id": file_id, "width": 1024, "height": 1024}]
+            result = self._message(chat_id, photo=photo, caption=form.get("caption"))
+        elif method == "sendMediaGroup":
+            media = json.loads(form.get("media", "[]"))
+            result = [
+                self._message(chat_id, photo=[{
+                    "file_id": f"fake-photo-{n}", "file_unique_id": f"fake-photo-{n}",
+                    "width": 1024, "height": 1024,
+                }])
+                for n in (next(self._ids) for _ in media)
+            ]
+        elif method in ("sendMessage", "editMessageText", "editMessageCaption"):
+            result = self._message(chat_id, text=form.get("text") or form.get("caption"))
+        else:  # deleteMessage, sendChatAction, answerCallbackQuery, answerInlineQuery, ...
+            result = True
+
+        if chat_id:
+            self.chats.record(chat_id, method, {"text": form.get("text") or form.get("caption")})
+        return web.json_response({"ok": True, "result": result})
+
+    # -- Kie ----------------------------------------------------------------
+
+    async def kie_create_task(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        task_id = f"task-{next(self._ids)}"
+        self.counts["kie:createTask"] += 1
+        task = asyncio.create_task(self._kie_callback(body["callBackUrl"], task_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.json_response({"code": 200, "msg": "success", "data": {"taskId": task_id}})
+
+    async def _kie_callback(self, url: str, task_id: str) -> None:
+        cfg = self.config
+        await asyncio.sleep(max(cfg.kie_delay + random.uniform(-cfg.kie_jitter, cfg.kie_jitter), 0))
+        if random.random() < cfg.kie_failure_rate:
+            self.counts["kie:fail"] += 1
+            data = {"taskId": task_id, "state": "fail", "failMsg": "injected failure"}
+        else:
+            self.counts["kie:success"] += 1
+            result = {"resultUrls": [f"{self.base_url}/cdn/{task_id}.jpg"]}
+            data = {"taskId": task_id, "state": "success", "resultJson": json.dumps(result)}
+        try:
+            async with self._client.post(url, json={"code": 200, "data": data, "msg": "ok"}) as resp:
+                await resp.read()
+        except Exception:
+            self.counts["kie:callback_error"] += 1
+
+    async def cdn(self, request: web.Request) -> web.Response:
+        self.counts["cdn:get"] += 1
+        return web.Response(body=self._image, content_type="image/jpeg")
+
+    # -- ProTalk --------------------------------------------------------------
+
+    async def protalk(self, request: web.Request) -> web.Response:
+        await request.read()
+        self.counts["protalk:ask"] += 1
+        await asyncio.sleep(self.config.protalk_delay)
+        if random.random() < self.config.protalk_failure_rate:
+            return web.Response(status=500, text="injected failure")
+        return web.json_response({"done": "желаю счастья, здоровья и всего самого лучшего!"})
+
+    async def any_other(self, request: web.Request) -> web.Response:
+        return web.Response(text="ok")  # warm-up HEAD requests to the API bases
+
+    # -- lifecycle --------------------------------------------------------------
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_post("/tg/bot{token}/{method}", self.telegram)
+        app.router.add_post("/kie/api/v1/jobs/createTask", self.kie_create_task)
+        app.router.add_get("/cdn/{name}", self.cdn)
+        app.router.add_post("/protalk/api/v1.0/ask/{token}", self.protalk)
+        app.router.add_route("*", "/{tail:.*}", self.any_other)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> web.AppRunner:
+        self._client = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        port = runner.addresses[0][1]
+        self.base_url = f"http://{host}:{port}"
+        return runner
+
+    async def stop(self, runner: web.AppRunner) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await runner.cleanup()
+        await self._client.close()
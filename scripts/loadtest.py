@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+scripts/loadtest.py
+
+Offline end-to-end load test. Starts the fake Telegram/Kie/CDN/ProTalk
+services from scripts/fake_services.py, runs the real webhook app
+(api/index.py) under uvicorn against them with the in-memory storage
+backend, and drives N synthetic users through the whole wizard:
+
+    /start → occasion → style → font → "✨ Сгенерировать ИИ" → wishes → name
+    → waiting message → Kie callback → postcard (sendPhoto)
+
+Every step posts a Telegram update to /api/webhook and waits for the bot's
+reply in that chat, so the numbers include the app's real handlers, storage
+calls, image download and rendering — only the network peers are fake.
+
+Reports postcards per minute, per-step latency percentiles as seen by the
+user, the app's own postcard_stage_seconds percentiles (from /api/metrics)
+and error / timeout / Kie failure counts.
+
+Usage:
+    python scripts/loadtest.py --users 200 --concurrency 50
+    python scripts/loadtest.py --users 50 --kie-delay 1 --kie-failure-rate 0.1 --json report.json
+
+Extra environment for the app can be passed through, e.g.
+    WEBHOOK_ACK_FIRST=1 CHAT_LOCK_ENABLED=1 python scripts/loadtest.py
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import aiohttp
+
+from bot.config import FONTS_LIST, OCCASIONS, STYLES
+from bot.metrics import LATENCY_BUCKETS, PREFIX, Histogram
+from fake_services import FakeConfig, FakeServices
+
+TOKEN = "123456:LOADTEST"
+WEBHOOK_SECRET = "loadtest-secret"
+CRON_SECRET = "loadtest-cron"
+
+# Wizard steps: (name, text). The occasion excludes "✏️ Свой повод", which asks for input.
+STEPS = [
+    ("start", lambda: "/start"),
+    ("occasion", lambda: random.choice(OCCASIONS[:-1])),
+    ("style", lambda: random.choice(STYLES)),
+    ("font", lambda: random.choice(FONTS_LIST)),
+    ("text_mode", lambda: "✨ Сгенерировать ИИ"),
+    ("context", lambda: "Для коллеги, пожелать успехов и хорошего отпуска"),
+    ("addressee", lambda: random.choice(NAMES)),
+]
+NAMES = ["Анна", "Игорь", "Мария Петровна", "Дмитрий"]
+REPLY_METHODS = {"sendMessage", "sendPhoto"}
+DELIVERY_METHODS = {"sendPhoto", "sendMediaGroup"}  # a group postcard arrives as an album
+FAILURE_METHODS = {"editMessageText"}  # the waiting message is replaced with an error
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentiles(values: list[float]) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda q: values[min(int(q * len(values)), len(values) - 1)]
+    return {"n": len(values), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": values[-1]}
+
+
+def parse_stage_histograms(text: str, name: str = "postcard_stage_seconds") -> dict[str, Histogram]:
+    """Rebuild per-stage histograms from the Prometheus text of /api/metrics."""
+    metric = f"{PREFIX}{name}_bucket"
+    cumulative: dict[str, list[int]] = defaultdict(list)
+    for line in text.splitlines():
+        if not line.startswith(metric + "{"):
+            continue
+        labels_text, value = line[len(metric) + 1:].rsplit("} ", 1)
+        labels = dict(part.split("=", 1) for part in labels_text.split(","))
+        cumulative[labels["stage"].strip('"')].append(int(float(value)))
+    histograms = {}
+    for stage, counts in cumulative.items():
+        hist = Histogram(LATENCY_BUCKETS)
+        hist.merge([c - p for c, p in zip(counts, [0] + counts[:-1])], 0.0)
+        histograms[stage] = hist
+    return histograms
+
+
+class Driver:
+    def __init__(
+        self, app_url: str, fakes: FakeServices, step_timeout: float, final_timeout: float,
+        group_size: int = 1,
+    ):
+        self.app_url = app_url
+        self.group_size = group_size
+        self.fakes = fakes
+        self.step_timeout = step_timeout
+        self.final_timeout = final_timeout
+        self.session: aiohttp.ClientSession | None = None
+        self.step_latency: dict[str, list[float]] = defaultdict(list)
+        self.outcomes: dict[str, int] = defaultdict(int)
+        self.completed_at: list[float] = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _update(self, chat_id: int, text: str) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private", "first_name": f"User{chat_id}"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"},
+                "text": text,
+            },
+        }
+
+    async def _post(self, chat_id: int, text: str) -> None:
+        async with self.session.post(
+            f"{self.app_url}/api/webhook",
+            json=self._update(chat_id, text),
+            headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET},
+        ) as resp:
+            resp.raise_for_status()
+            await resp.read()
+
+    async def run_user(self, chat_id: int) -> None:
+        chats = self.fakes.chats
+        try:
+            for name, text in STEPS:
+                reply = chats.wait_for(chat_id, REPLY_METHODS)
+                started = time.perf_counter()
+                if name == "addressee" and self.group_size > 1:
+                    await self._post(chat_id, "\n".join(f"{n} {i}" for i, n in zip(
+                        range(self.group_size), itertools.cycle(NAMES))))
+                else:
+                    await self._post(chat_id, text())
+                await asyncio.wait_for(reply, self.step_timeout)
+                self.step_latency[name].append(time.perf_counter() - started)
+
+            # The last reply is the waiting message; now the postcard or an error follows
+            started = time.perf_counter()
+            final = await asyncio.wait_for(
+                chats.wait_for(chat_id, DELIVERY_METHODS | FAILURE_METHODS), self.final_timeout,
+            )
+            if final["method"] in DELIVERY_METHODS:
+                self.step_latency["postcard"].append(time.perf_counter() - started)
+                self.completed_at.append(time.time())
+                self.outcomes["delivered"] += 1
+            else:
+                self.outcomes["failed"] += 1
+        except asyncio.TimeoutError:
+            self.outcomes["timeout"] += 1
+        except Exception as e:
+            self.outcomes[f"error:{type(e).__name__}"] += 1
+
+    async def run(self, users: int, concurrency: int, first_chat_id: int = 10_000) -> float:
+        limit = asyncio.Semaphore(concurrency)
+
+        async def one(chat_id: int):
+            async with limit:
+                await self.run_user(chat_id)
+
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(one(first_chat_id + i) for i in range(users)))
+        finally:
+            elapsed = time.perf_counter() - started
+            await self.session.close()
+        return elapsed
+
+
+async def _wait_until_up(url: str, proc: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"app exited with code {proc.returncode}")
+            try:
+                async with session.get(f"{url}/") as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("app did not start in time")
+
+
+async def _fetch_metrics(url: str) -> str:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+            f"{url}/api/metrics", params={"scope": "local"},
+            headers={"Authorization": f"Bearer {CRON_SECRET}"},
+        ) as resp:
+            return await resp.text()
+
+
+def _print_report(report: dict) -> None:
+    fmt = lambda s: f"{s:.3f}s"
+    print(f"\nUsers: {report['users']}  concurrency: {report['concurrency']}  "
+          f"elapsed: {report['elapsed']:.1f}s")
+    print(f"Postcards delivered: {report['outcomes'].get('delivered', 0)}  "
+          f"→ {report['postcards_per_minute']:.1f}/min")
+    print("Outcomes: " + ", ".join(f"{k}={v}" for k, v in sorted(report["outcomes"].items())))
+    print("Fake services: " + ", ".join(f"{k}={v}" for k, v in sorted(report["fake_calls"].items())))
+    print("\nUser-visible latency per step:")
+    for name, p in report["steps"].items():
+        print(f"  {name:<10} n={p['n']:<5} p50={fmt(p['p50'])}  p95={fmt(p['p95'])}  "
+              f"p99={fmt(p['p99'])}  max={fmt(p['max'])}")
+    print("\nApp stages (postcard_stage_seconds):")
+    for stage, p in report["stages"].items():
+        print(f"  {stage:<12} n={p['n']:<5} p50={fmt(p['p50'])}  p95={fmt(p['p95'])}  p99={fmt(p['p99'])}")
+
+
+async def main(args) -> dict:
+    fakes = FakeServices(FakeConfig(
+        kie_delay=args.kie_delay,
+        kie_jitter=args.kie_jitter,
+        kie_failure_rate=args.kie_failure_rate,
+        protalk_delay=args.protalk_delay,
+        protalk_failure_rate=args.protalk_failure_rate,
+        telegram_delay=args.telegram_delay,
+    ))
+    runner = await fakes.start()
+    port = args.app_port or _free_port()
+    app_url = f"http://127.0.0.1:{port}"
+    env = {
+        **os.environ,
+        "STORAGE_BACKEND": "memory",
+        "TELEGRAM_BOT_TOKEN": TOKEN,
+        "TELEGRAM_API_BASE": f"{fakes.base_url}/tg",
+        "KIE_API_BASE": f"{fakes.base_url}/kie",
+        "PROTALK_API_BASE": f"{fakes.base_url}/protalk",
+        "KIE_API_KEY": "loadtest",
+        "PROTALK_TOKEN": "loadtest",
+        "WEBHOOK_URL": app_url,
+        "WEBHOOK_SECRET": WEBHOOK_SECRET,
+        "CRON_SECRET": CRON_SECRET,
+        "WARMUP_ON_STARTUP": "0",
+    }
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api.index:app", "--host", "127.0.0.1",
+         "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, env=env,
+        stdout=None if args.app_logs else subprocess.DEVNULL,
+        stderr=None if args.app_logs else subprocess.DEVNULL,
+    )
+    try:
+        await _wait_until_up(app_url, proc)
+        driver = Driver(app_url, fakes, args.step_timeout, args.final_timeout, args.group_size)
+        elapsed = await driver.run(args.users, args.concurrency)
+        stages = parse_stage_histograms(await _fetch_metrics(app_url))
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        await fakes.stop(runner)
+
+    delivered = driver.outcomes.get("delivered", 0)
+    return {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "elapsed": elapsed,
+        "postcards_per_minute": delivered / elapsed * 60 if elapsed else 0.0,
+        "outcomes": dict(driver.outcomes),
+        "fake_calls": dict(fakes.counts),
+        "steps": {name: _percentiles(v) for name, v in driver.step_latency.items()},
+        "stages": {
+            stage: {"n": h.count, "p50": h.quantile(0.5), "p95": h.quantile(0.95), "p99": h.quantile(0.99)}
+            for stage, h in sorted(stages.items())
+        },
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline end-to-end load test of the postcard bot")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=25)
+    parser.add_argument("--kie-delay", type=float, default=3.0, help="seconds until the Kie callback")
+    parser.add_argument("--kie-jitter", type=float, default=0.5)
+    parser.add_argument("--kie-failure-rate", type=float, default=0.0)
+    parser.add_argument("--protalk-delay", type=float, default=0.5)
+    parser.add_argument("--protalk-failure-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-delay", type=float, default=0.02)
+    parser.add_argument("--group-size", type=int, default=1, help="names per postcard (group mode)")
+    parser.add_argument("--step-timeout", type=float, default=30.0)
+    parser.add_argument("--final-timeout", type=float, default=120.0)
+    parser.add_argument("--app-port", type=int, default=0)
+    parser.add_argument("--app-logs", action="store_true", help="show the app's output")
+    parser.add_argument("--json", metavar="PATH", help="also write the report as JSON")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(main(args))
+    _print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
@@ -1,24 +1,32 @@
 """
 Pytest configuration and shared fixtures.
 
-IMPORTANT: upstash_redis is mocked at the TOP of this file, before any
-bot.* import occurs. bot.database runs `kv = Redis.from_env()` at module
-level, which would crash in CI without real UPSTASH_REDIS_REST_URL/TOKEN.
+IMPORTANT: the storage backend is switched to the in-memory one at the TOP
+of this file, before any bot.* import occurs, so tests never need Upstash
+credentials (UPSTASH_REDIS_REST_URL/TOKEN) or network access.
 """
-import sys
+import os
 import io
 from unittest.mock import AsyncMock, MagicMock
 import pytest
 from PIL import Image
 
-# ── Patch upstash_redis BEFORE any bot.* module is imported ──────────────────────
-_redis_instance = MagicMock()
-_redis_mock_module = MagicMock()
-_redis_mock_module.Redis.from_env.return_value = _redis_instance
-sys.modules.setdefault("upstash_redis", _redis_mock_module)
+# ── Configure the environment BEFORE any bot.* module is imported ────────────────
+os.environ["STORAGE_BACKEND"] = "memory"
+# api.index builds an aiogram Bot at import time, which validates the token format.
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:TEST-TOKEN")
 # ───────────────────────────────────────────────────────────────────────────────
 
 
+@pytest.fixture
+def memory_kv():
+    """The shared in-memory store behind ``bot.database.kv``, emptied for the test."""
+    from bot.database import kv
+    kv.client.flushall()
+    yield kv.client
+    kv.client.flushall()
+
+
 @pytest.fixture
 def mock_bot() -> MagicMock:
     """Minimal aiogram Bot mock."""
@@ -94,6 +94,23 @@ def test_apply_text_to_image_multiline(sample_image_bytes):
     assert isinstance(result, bytes) and len(result) > 0
 
 
+def test_shared_background_renders_like_apply_text_to_image(sample_image_bytes):
+    """Decoding once and rendering many texts gives the same cards as one-by-one renders."""
+    from bot.render import decode_background, render_on_background
+
+    background = decode_background(sample_image_bytes)
+    for name in ("Анна", "Игорь"):
+        assert render_on_background(background, name, "Lobster") == \
+            apply_text_to_image(sample_image_bytes, name, "Lobster")
+
+
+def test_parse_addressees_one_name_per_line():
+    from bot.handlers import parse_addressees
+
+    assert parse_addressees("Анна") == ["Анна"]
+    assert parse_addressees("Анна\n\n Игорь \nАнна\nМария Петровна") == ["Анна", "Игорь", "Мария Петровна"]
+
+
 # ── wrap_text ─────────────────────────────────────────────────────────────────────
 def test_wrap_text_short_line_no_wrap():
     """A short line that fits in max_width is returned unchanged."""
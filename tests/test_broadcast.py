@@ -0,0 +1,128 @@
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+from bot.broadcast import TokenBucket, run_broadcast
+
+
+def _job(**overrides) -> dict:
+    job = {
+        "id": "job1", "text": "Привет!", "status": "running", "cursor": 0, "total": 4,
+        "sent": 0, "failed": 0, "blocked": 0, "active_secs": 0.0,
+        "created_at": 0.0, "updated_at": 0.0, "last_rate": 0.0,
+    }
+    job.update(overrides)
+    return job
+
+
+def _patch_storage(job: dict, pages: dict[int, tuple[int, list]]):
+    """Patch the broadcast module's storage helpers with in-memory fakes."""
+    saved = []
+
+    def iter_batches(batch_size, cursor=0):
+        while True:
+            cursor, users = pages[cursor]
+            yield cursor, users
+            if cursor == 0:
+                return
+
+    removed = MagicMock()
+    patches = [
+        patch("bot.broadcast.get_broadcast_job", return_value=job),
+        patch("bot.broadcast.save_broadcast_job", side_effect=lambda j: saved.append(dict(j))),
+        patch("bot.broadcast.acquire_lock", return_value=True),
+        patch("bot.broadcast.release_lock", return_value=True),
+        patch("bot.broadcast.iter_user_batches", side_effect=iter_batches),
+        patch("bot.broadcast.remove_user", removed),
+    ]
+    return patches, saved, removed
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_limits_rate():
+    """After the initial burst, acquisitions are spaced at 1/rate."""
+    bucket = TokenBucket(rate=100, capacity=5)
+    started = time.monotonic()
+    for _ in range(15):
+        await bucket.acquire()
+    assert time.monotonic() - started >= 0.09
+
+
+@pytest.mark.asyncio
+async def test_run_broadcast_retries_and_prunes_blocked():
+    """RetryAfter is retried, blocked users are removed, the job completes."""
+    job = _job()
+    patches, saved, removed = _patch_storage(job, {0: (5, [1, 2]), 5: (0, [3, 4])})
+    bot = MagicMock()
+    calls = {"n": 0}
+
+    async def send_message(uid, text):
+        if uid == 2 and calls["n"] == 0:
+            calls["n"] += 1
+            raise TelegramRetryAfter(method=MagicMock(), message="flood", retry_after=0)
+        if uid == 3:
+            raise TelegramForbiddenError(method=MagicMock(), message="blocked")
+
+    bot.send_message = AsyncMock(side_effect=send_message)
+    for p in patches:
+        p.start()
+    try:
+        result = await run_broadcast(bot, "job1", time_budget=10)
+    finally:
+        for p in patches:
+            p.stop()
+
+    assert result["status"] == "done"
+    assert (result["sent"], result["failed"], result["blocked"]) == (3, 0, 1)
+    removed.assert_called_once_with(3)
+    assert [s["cursor"] for s in saved] == [5, 0]
+
+
+@pytest.mark.asyncio
+async def test_run_broadcast_stops_at_budget_and_resumes():
+    """A zero budget sends nothing and carries the batch over; a later run continues from there."""
+    job = _job()
+    patches, saved, _ = _patch_storage(job, {0: (5, [1, 2]), 5: (0, [3, 4])})
+    bot = MagicMock()
+    bot.send_message = AsyncMock()
+    for p in patches:
+        p.start()
+    try:
+        first = await run_broadcast(bot, "job1", time_budget=0)
+        assert first["status"] == "running" and first["cursor"] == 5 and first["carry"] == [1, 2]
+        assert first["sent"] == 0
+        second = await run_broadcast(bot, "job1", time_budget=10)
+    finally:
+        for p in patches:
+            p.stop()
+
+    assert second["status"] == "done" and second["sent"] == 4
+    assert [c.args[0] for c in bot.send_message.call_args_list] == [1, 2, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_run_broadcast_ends_when_retry_after_outlasts_the_budget():
+    """A long RetryAfter stops the run instead of sleeping past the lease; unsent users carry over."""
+    job = _job()
+    patches, saved, _ = _patch_storage(job, {0: (0, [1, 2, 3])})
+    bot = MagicMock()
+
+    async def send_message(uid, text):
+        if uid == 2:
+            raise TelegramRetryAfter(method=MagicMock(), message="flood", retry_after=3600)
+
+    bot.send_message = AsyncMock(side_effect=send_message)
+    for p in patches:
+        p.start()
+    try:
+        started = time.monotonic()
+        result = await run_broadcast(bot, "job1", time_budget=5)
+    finally:
+        for p in patches:
+            p.stop()
+
+    assert time.monotonic() - started < 1
+    assert result["status"] == "running"
+    assert result["sent"] == 2 and result["carry"] == [2]
@@ -0,0 +1,143 @@
+import io
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from aiogram import types
+from PIL import Image
+
+from bot.services import process_kie_callback
+
+TASK = {
+    "chat_id": 42,
+    "message_id": 7,
+    "payload": {"occasion": "🎂 День рождения", "style": "Акварель", "font": "Lobster",
+                "text_mode": "ai", "text_input": "коллеге", "addressee": "Маша"},
+    "caption_for_db": "желаю счастья!",
+}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("status", ["done", "busy"])
+async def test_duplicate_callback_skips_pipeline(status):
+    """A completed or in-flight task is acknowledged without downloading anything."""
+    bot = MagicMock()
+    with patch("bot.services.claim_pending_image_task", return_value=(status, None)), \
+         patch("bot.services.download_image", AsyncMock()) as download:
+        assert await process_kie_callback("t1", "success", {"resultUrls": ["u"]}, None, bot) is True
+    download.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_failed_processing_releases_lease(sample_image_bytes):
+    """If delivery fails, the lease is released so a redelivery can retry."""
+    bot = MagicMock()
+    bot.delete_message = AsyncMock()
+    bot.send_photo = AsyncMock(side_effect=RuntimeError("telegram down"))
+    bot.edit_message_text = AsyncMock()
+    with patch("bot.services.claim_pending_image_task", return_value=("claimed", TASK)), \
+         patch("bot.services.download_image", AsyncMock(return_value=sample_image_bytes)), \
+         patch("bot.services.complete_pending_image_task") as complete, \
+         patch("bot.services.release_pending_image_task") as release:
+        assert await process_kie_callback("t1", "success", {"resultUrls": ["u"]}, None, bot) is False
+    complete.assert_not_called()
+    release.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_failure_after_send_marks_the_task_done(sample_image_bytes):
+    """Once the card is sent, a bookkeeping error neither frees the task for a redelivery nor reports one."""
+    bot = MagicMock()
+    bot.delete_message = AsyncMock()
+    sent = MagicMock()
+    sent.photo = [MagicMock(file_id="AgAC-card")]
+    bot.send_photo = AsyncMock(return_value=sent)
+    bot.edit_message_text = AsyncMock()
+    with patch("bot.services.claim_pending_image_task", return_value=("claimed", TASK)), \
+         patch("bot.services.download_image", AsyncMock(return_value=sample_image_bytes)), \
+         patch("bot.services.get_delivery_context", return_value=(3, [])), \
+         patch("bot.services.finalize_postcard", side_effect=RuntimeError("redis timeout")), \
+         patch("bot.services.complete_pending_image_task") as complete, \
+         patch("bot.services.release_pending_image_task") as release, \
+         patch("bot.rerender.remember_background"):
+        assert await process_kie_callback("t1", "success", {"resultUrls": ["u"]}, None, bot) is True
+    complete.assert_called_once_with("t1")
+    release.assert_not_called()
+    bot.edit_message_text.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_success_sends_one_photo_and_records_in_one_call(sample_image_bytes):
+    """The credits notice is in the caption and all Redis updates go through finalize_postcard."""
+    bot = MagicMock()
+    bot.delete_message = AsyncMock()
+    sent = MagicMock()
+    sent.photo = [MagicMock(file_id="AgAC-card")]
+    bot.send_photo = AsyncMock(return_value=sent)
+    bot.send_message = AsyncMock()
+    with patch("bot.services.claim_pending_image_task", return_value=("claimed", TASK)), \
+         patch("bot.services.download_image", AsyncMock(return_value=sample_image_bytes)), \
+         patch("bot.services.get_delivery_context", return_value=(3, [])), \
+         patch("bot.services.finalize_postcard", return_value=1) as finalize, \
+         patch("bot.rerender.remember_background") as remember:
+        assert await process_kie_callback("t1", "success", {"resultUrls": ["u"]}, None, bot) is True
+
+    assert "Осталось бесплатных открыток: <b>2</b>" in bot.send_photo.await_args.kwargs["caption"]
+    # Re-renders show the balance finalize_postcard left (another card was debited meanwhile)
+    assert "Осталось бесплатных открыток: <b>1</b>" in remember.call_args.args[2]["caption"]
+    buttons = bot.send_photo.await_args.kwargs["reply_markup"].inline_keyboard
+    assert buttons[0][0].callback_data == "rr:t1:f:1"  # Lobster is current, the rest are offered
+    bot.delete_message.assert_awaited_once()
+    bot.send_message.assert_not_called()
+    finalize.assert_called_once_with(42, "t1", "AgAC-card", "желаю счастья!", [], 3, TASK["payload"])
+
+
+@pytest.mark.asyncio
+async def test_group_postcard_renders_every_name_and_sends_albums(sample_image_bytes):
+    """One background, one card per name in albums of 10, one credit, nothing added to the gallery."""
+    names = [f"Коллега {i}" for i in range(12)]
+    task = {**TASK, "payload": {**TASK["payload"], "addressees": names}}
+    bot = MagicMock()
+    bot.delete_message = AsyncMock()
+    first = MagicMock()
+    first.photo = [MagicMock(file_id="AgAC-group")]
+    bot.send_media_group = AsyncMock(side_effect=lambda chat_id, media: [first] * len(media))
+    with patch("bot.services.claim_pending_image_task", return_value=("claimed", task)), \
+         patch("bot.services.download_image", AsyncMock(return_value=sample_image_bytes)) as download, \
+         patch("bot.services.get_delivery_context", return_value=(3, [])), \
+         patch("bot.services.finalize_postcard") as finalize:
+        assert await process_kie_callback("t1", "success", {"resultUrls": ["u"]}, None, bot) is True
+
+    download.assert_awaited_once()
+    albums = [c.kwargs["media"] for c in bot.send_media_group.await_args_list]
+    assert [len(a) for a in albums] == [10, 2]
+    assert "Готово: 12 открыток" in albums[0][0].caption
+    assert all(m.caption is None for m in albums[0][1:] + albums[1])
+    finalize.assert_called_once_with(42, "t1", None, "желаю счастья!", [], 3, task["payload"])
+
+
+@pytest.mark.asyncio
+async def test_progressive_delivery_sends_preview_then_replaces_it(sample_image_bytes):
+    """A small preview goes out first; the full card replaces it with the caption and buttons."""
+    bot = MagicMock()
+    bot.delete_message = AsyncMock()
+    preview = MagicMock(message_id=99)
+    bot.send_photo = AsyncMock(return_value=preview)
+    final = MagicMock(spec=types.Message)
+    final.photo = [MagicMock(file_id="AgAC-final")]
+    bot.edit_message_media = AsyncMock(return_value=final)
+    with patch("bot.services.PROGRESSIVE_DELIVERY", True), \
+         patch("bot.services.claim_pending_image_task", return_value=("claimed", TASK)), \
+         patch("bot.services.download_image", AsyncMock(return_value=sample_image_bytes)), \
+         patch("bot.services.get_delivery_context", return_value=(3, [])), \
+         patch("bot.services.finalize_postcard", return_value=2) as finalize, \
+         patch("bot.rerender.remember_background"):
+        assert await process_kie_callback("t1", "success", {"resultUrls": ["u"]}, None, bot) is True
+
+    sent = Image.open(io.BytesIO(bot.send_photo.await_args.kwargs["photo"].data))
+    assert max(sent.size) <= 320
+    edit = bot.edit_message_media.await_args.kwargs
+    assert edit["message_id"] == 99
+    assert Image.open(io.BytesIO(edit["media"].media.data)).size == (400, 300)
+    assert "Осталось бесплатных открыток" in edit["media"].caption
+    assert edit["reply_markup"].inline_keyboard[0][0].callback_data == "rr:t1:f:1"
+    assert finalize.call_args.args[2] == "AgAC-final"
@@ -0,0 +1,50 @@
+from unittest.mock import MagicMock, patch
+
+from bot.counters import CounterAggregator
+
+
+def _kv() -> MagicMock:
+    return MagicMock()
+
+
+def test_increments_are_summed_into_one_pipeline():
+    kv = _kv()
+    pipe = kv.pipeline.return_value
+    agg = CounterAggregator(flush_interval=3600, flush_threshold=1000)
+    with patch("bot.database.kv", kv):
+        for _ in range(3):
+            agg.incrby("stats:generations")
+        agg.incrby("stats:revenue", 90)
+        agg.hincrby("stats:d:20260101", "generations", 1, ttl=60)
+        kv.pipeline.assert_not_called()
+        assert agg.flush(reason="invocation") is True
+
+    pipe.incrby.assert_any_call("stats:generations", 3)
+    pipe.incrby.assert_any_call("stats:revenue", 90)
+    pipe.hincrby.assert_called_once_with("stats:d:20260101", "generations", 1)
+    pipe.expire.assert_called_once_with("stats:d:20260101", 60)
+    pipe.exec.assert_called_once()
+    assert agg.flushes == 1
+    assert agg.flush() is False  # nothing left to write
+
+
+def test_threshold_triggers_flush():
+    kv = _kv()
+    agg = CounterAggregator(flush_interval=3600, flush_threshold=2)
+    with patch("bot.database.kv", kv):
+        agg.incrby("stats:generations")
+        assert agg.flushes == 0
+        agg.incrby("stats:generations")
+    assert agg.flushes == 1
+    kv.pipeline.return_value.incrby.assert_called_once_with("stats:generations", 2)
+
+
+def test_failed_flush_keeps_increments():
+    kv = _kv()
+    kv.pipeline.return_value.exec.side_effect = RuntimeError("redis down")
+    agg = CounterAggregator(flush_interval=3600, flush_threshold=1000)
+    with patch("bot.database.kv", kv):
+        agg.incrby("stats:revenue", 150)
+        assert agg.flush() is False
+    assert agg.pending("stats:revenue") == 150
+    assert agg.flushes == 0
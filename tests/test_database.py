@@ -0,0 +1,91 @@
+from unittest.mock import MagicMock, patch
+
+from bot.counters import CounterAggregator
+from bot.database import (
+    iter_user_batches, iter_users, finalize_postcard, generation_stat_fields, get_stat_buckets,
+    get_delivery_context,
+)
+
+
+def _paged_kv(pages: dict[int, tuple[int, list]]) -> MagicMock:
+    """Return a kv mock whose sscan serves the given {cursor: (next, members)} pages."""
+    kv = MagicMock()
+    kv.sscan.side_effect = lambda key, cursor, count=None: list(pages[cursor])
+    return kv
+
+
+def test_iter_users_walks_all_pages():
+    """iter_users follows SSCAN cursors until 0 and converts members to int."""
+    kv = _paged_kv({0: (17, ["1", "2"]), 17: (42, ["3"]), 42: (0, ["4", "5"])})
+    with patch("bot.database.kv", kv):
+        assert list(iter_users(batch_size=2)) == [1, 2, 3, 4, 5]
+    assert kv.sscan.call_count == 3
+    assert kv.sscan.call_args.kwargs["count"] == 2
+
+
+def test_iter_users_is_lazy():
+    """Only the pages actually consumed are requested from Redis."""
+    kv = _paged_kv({0: (17, ["1", "2"]), 17: (0, ["3"])})
+    with patch("bot.database.kv", kv):
+        users = iter_users()
+        assert next(users) == 1
+        assert kv.sscan.call_count == 1
+
+
+def test_iter_user_batches_resumes_from_cursor():
+    """A saved cursor resumes the scan without re-reading earlier pages."""
+    kv = _paged_kv({0: (17, ["1"]), 17: (0, ["2", "3"])})
+    with patch("bot.database.kv", kv):
+        assert list(iter_user_batches(cursor=17)) == [(0, [2, 3])]
+
+
+def test_generation_stat_fields_buckets_custom_occasions():
+    """Free-text occasions collapse into one "custom" value."""
+    fields = generation_stat_fields({"occasion": "✏️ юбилей бабушки", "style": "Неон", "font": "Caveat"})
+    assert fields == {
+        "generations": 1, "occasion:custom": 1, "style:Неон": 1,
+        "font:Caveat": 1, "text_mode:ai": 1,
+    }
+
+
+def test_finalize_postcard_uses_one_pipeline_and_buffers_counters():
+    """Delivery is one round trip; global counters go to the write-behind buffer."""
+    kv = MagicMock()
+    pipe = kv.pipeline.return_value
+    pipe.exec.return_value = [True, 1, 1, 4, 10, True]
+    buffer = CounterAggregator(flush_interval=3600, flush_threshold=1000)
+    payload = {"occasion": "🎂 День рождения", "style": "Акварель", "font": "Lobster", "text_mode": "custom"}
+    with patch("bot.database.kv", kv), patch("bot.database.aggregator", buffer), \
+         patch("bot.database.time.time", return_value=0.0):
+        assert finalize_postcard(42, "t1", "AgAC", "cap", [], 5, payload) == 4
+    kv.pipeline.assert_called_once()
+    pipe.exec.assert_called_once()
+    pipe.incr.assert_not_called()
+    pipe.pfadd.assert_called_once_with("stats:dau:19700101", 42)
+    assert buffer.pending("stats:generations") == 1
+    assert buffer._fields[("stats:h:1970010100", "occasion:день рождения")] == 1
+    assert buffer._fields[("stats:d:19700101", "text_mode:custom")] == 1
+
+
+def test_get_stat_buckets_sums_days_and_unions_dau():
+    kv = MagicMock()
+    kv.pipeline.return_value.exec.return_value = [
+        {"generations": "3", "style:Неон": "2"}, {"generations": "1"},  # daily hashes
+        5, 2,  # per-day DAU
+        6,  # union
+    ]
+    with patch("bot.database.kv", kv):
+        summary = get_stat_buckets(days=2, now=86_400.0)
+    assert summary["totals"] == {"generations": 4, "style:Неон": 2}
+    assert summary["unique_users"] == 6
+    assert summary["days"][0] == ("1970-01-02", {"generations": 3, "style:Неон": 2}, 5)
+
+
+def test_delivery_round_trip_on_memory_store(memory_kv):
+    """finalize_postcard and get_delivery_context agree on a real (in-memory) store."""
+    assert get_delivery_context(7) == (None, [])
+    assert finalize_postcard(7, "t9", "AgAC", "cap", [], None) == 2
+    credits, gallery = get_delivery_context(7)
+    assert credits == 2
+    assert gallery == [{"file_id": "AgAC", "caption": "cap"}]
+    assert memory_kv.get("pending_image:t9:done") == "1"
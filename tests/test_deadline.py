@@ -0,0 +1,63 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from bot import deadline, metrics
+from bot.deadline import DeadlineExceeded
+from bot.services import fetch_with_retry, safe_greeting
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def _exhausted(stage: str) -> float:
+    return metrics.snapshot()["counters"].get(f'deadline_exhausted_total{{stage="{stage}"}}', 0)
+
+
+def test_timeouts_are_cut_to_the_remaining_budget():
+    assert deadline.timeout("kie_create", 10.0) == 10.0  # no budget: the cap
+    with deadline.budget(4.0, "test"):
+        assert 2.5 < deadline.timeout("kie_create", 10.0, reserve=1.0) <= 3.0
+        assert deadline.timeout("kie_create", 1.0) == 1.0
+        with pytest.raises(DeadlineExceeded):
+            deadline.timeout("download", 30.0, reserve=5.0)
+        assert not deadline.allows("preview", 10.0)
+    assert deadline.remaining() is None
+    assert _exhausted("download") == 1 and _exhausted("preview") == 1
+
+
+@pytest.mark.asyncio
+async def test_budget_is_inherited_by_spawned_tasks():
+    with deadline.budget(30.0, "test"):
+        left = await asyncio.create_task(asyncio.to_thread(deadline.remaining))
+    assert 29 < left <= 30
+
+
+@pytest.mark.asyncio
+async def test_greeting_is_skipped_when_the_budget_runs_low():
+    with patch("bot.services.get_greeting_text_from_protalk", AsyncMock()) as protalk:
+        with deadline.budget(3.0, "test"):
+            text = await safe_greeting("Маша", "день рождения", None)
+    protalk.assert_not_called()
+    assert text == "желаю счастья, здоровья и всего самого лучшего!"
+    assert _exhausted("protalk") == 1
+
+
+@pytest.mark.asyncio
+async def test_fetch_does_not_sleep_past_the_budget():
+    session = MagicMock()
+    session.timeout.total = 30
+    session.get = AsyncMock(return_value=MagicMock(status=500))
+    started = time.monotonic()
+    with deadline.budget(1.0, "test"), pytest.raises(DeadlineExceeded):
+        await fetch_with_retry("https://cdn/image.png", session, retries=3, delay=2)
+    assert time.monotonic() - started < 0.5
+    assert session.get.await_count == 1
+    assert session.get.await_args.kwargs["timeout"].total <= 1.0
+    assert _exhausted("fetch_retry") == 1
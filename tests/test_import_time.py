@@ -0,0 +1,55 @@
+"""Import-time profile of the Vercel entry point (`python -X importtime`).
+
+Runs in a fresh interpreter so module caches from other tests don't hide
+the real cold-start cost.  The measured numbers are attached to the test
+report via ``record_property`` and printed with ``pytest -s``.
+"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must not be loaded just to serve a plain wizard step.
+LAZY_MODULES = ("PIL", "bot.render", "upstash_redis", "requests")
+
+
+def _profile_import(statement: str) -> dict[str, int]:
+    """Return {module: cumulative import time in µs} for ``statement``."""
+    env = dict(
+        os.environ,
+        TELEGRAM_BOT_TOKEN="123456:TEST-TOKEN",
+        UPSTASH_REDIS_REST_URL="https://example.invalid",
+        UPSTASH_REDIS_REST_TOKEN="test",
+    )
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    timings = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line.split("|")
+        timings[module.strip()] = int(cumulative)
+    return timings
+
+
+def test_entry_point_does_not_import_renderer(record_property):
+    """Importing api.index must not load Pillow, the renderer or the Redis client."""
+    timings = _profile_import("import api.index")
+
+    top = sorted(timings.items(), key=lambda kv: kv[1], reverse=True)[:10]
+    own = {m: us for m, us in timings.items() if m.startswith(("api.", "bot."))}
+    record_property("import_time_total_us", timings["api.index"])
+    record_property("import_time_own_us", own)
+    record_property("import_time_top_us", dict(top))
+
+    loaded = [m for m in LAZY_MODULES if m in timings]
+    assert not loaded, f"heavy modules imported at cold start: {loaded}"
+
+
+def test_renderer_loads_pillow_on_demand():
+    """The lazy services.apply_text_to_image alias pulls in the renderer when used."""
+    timings = _profile_import("import bot.services as s; s.apply_text_to_image")
+    assert "bot.render" in timings and "PIL" in timings
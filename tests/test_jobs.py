@@ -0,0 +1,82 @@
+import asyncio
+import json
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from bot import jobs, worker
+from bot.worker import handle_job
+
+
+def test_read_jobs_parses_stream_reply():
+    """XREADGROUP replies are decoded into {id, kind, data} jobs."""
+    kv = MagicMock()
+    kv.execute.return_value = [
+        ["jobs:generation", [["1-0", ["kind", "create", "data", json.dumps({"chat_id": 7})]]]],
+    ]
+    with patch("bot.jobs.kv", kv):
+        assert jobs.read_jobs("c1") == [{"id": "1-0", "kind": "create", "data": {"chat_id": 7}}]
+
+
+def test_reclaim_claims_retryable_and_dead_letters_exhausted():
+    """Jobs under the delivery limit are XCLAIMed, exhausted ones go to the dead-letter stream."""
+    kv = MagicMock()
+    entry = ["kind", "complete", "data", json.dumps({"task_id": "t"})]
+
+    def execute(cmd):
+        if cmd[0] == "XPENDING":
+            return [["1-0", "old", 90000, 1], ["2-0", "old", 90000, jobs.JOB_MAX_DELIVERIES]]
+        if cmd[0] == "XRANGE":
+            return [["2-0", entry]]
+        if cmd[0] == "XCLAIM":
+            assert cmd[-1] == "1-0"
+            return [["1-0", entry]]
+        return "ok"
+
+    kv.execute.side_effect = execute
+    with patch("bot.jobs.kv", kv):
+        claimed = jobs.reclaim_stale_jobs("c2", min_idle_ms=60000)
+
+    assert [j["id"] for j in claimed] == ["1-0"]
+    dead = [c.args[0] for c in kv.execute.call_args_list if c.args[0][:2] == ["XADD", jobs.DEAD_LETTER_STREAM]]
+    assert len(dead) == 1 and "2-0" in dead[0]
+
+
+@pytest.mark.asyncio
+async def test_handle_job_dispatches_by_kind():
+    """create jobs start a generation, complete jobs process the Kie callback."""
+    bot = MagicMock()
+    with patch("bot.worker.start_generation", AsyncMock()) as start, \
+         patch("bot.worker.process_kie_callback", AsyncMock()) as complete:
+        await handle_job({"id": "1", "kind": "create",
+                          "data": {"chat_id": 1, "message_id": 2, "payload": {}}}, bot)
+        await handle_job({"id": "2", "kind": "complete",
+                          "data": {"task_id": "t", "state": "success", "result_json": {}}}, bot)
+    start.assert_awaited_once_with(1, 2, {}, bot, None)
+    assert complete.await_args.kwargs["task_id"] == "t"
+
+
+@pytest.mark.asyncio
+async def test_handed_back_callback_job_stays_pending_and_is_reclaimed():
+    """A complete job whose task was handed back isn't acked; the reclaim runs it again."""
+    job = {"id": "1-0", "kind": "complete", "data": {"task_id": "t", "state": "success"}}
+    stop = asyncio.Event()
+    reclaimed = iter([[], [job]])
+    acked = []
+
+    def ack(job_id):
+        acked.append(job_id)
+        stop.set()
+
+    with patch("bot.worker.JOB_RECLAIM_IDLE_MS", 20), \
+         patch("bot.worker.WORKER_POLL_INTERVAL", 0.01), \
+         patch("bot.worker.reclaim_stale_jobs", side_effect=lambda *a: next(reclaimed, [])), \
+         patch("bot.worker.read_jobs", side_effect=[[job]] + [[]] * 100), \
+         patch("bot.worker.ack_job", side_effect=ack), \
+         patch("bot.worker.is_image_task_open", return_value=True), \
+         patch("bot.worker.process_kie_callback", AsyncMock(side_effect=[False, True])) as process, \
+         patch("bot.worker.aggregator"), patch("bot.worker.metrics"):
+        await asyncio.wait_for(worker.consume("c1", MagicMock(), stop, reclaim=True), timeout=2)
+
+    assert process.await_count == 2
+    assert acked == ["1-0"]  # only after the retry succeeded
@@ -0,0 +1,95 @@
+import asyncio
+import time
+
+import pytest
+
+from bot import kie_queue
+from bot.database import (
+    PAID_USERS_KEY,
+    admit_kie_ticket,
+    enqueue_kie_ticket,
+    kie_queue_depth,
+    kv,
+    leave_kie_queue,
+    release_kie_slot,
+)
+
+SLOT_MS = 60_000
+STALE_MS = 30_000
+
+
+def _admit(user_id: int, ticket: str, capacity: int = 1) -> int:
+    return admit_kie_ticket(user_id, ticket, capacity, SLOT_MS, STALE_MS)
+
+
+def test_paid_users_go_first_and_users_take_turns(memory_kv):
+    kv.sadd(PAID_USERS_KEY, 3)
+    enqueue_kie_ticket(1, "1:a")
+    assert _admit(1, "1:a") == 0  # the only slot
+
+    for user_id, ticket in ((1, "1:b"), (1, "1:c"), (2, "2:a"), (3, "3:a")):
+        time.sleep(0.002)  # distinct arrival times
+        assert enqueue_kie_ticket(user_id, ticket) is (user_id == 3)
+    positions = {t: _admit(int(t[0]), t) for t in ("1:b", "1:c", "2:a", "3:a")}
+    # Paying user first, then everyone's first submission, then the second one
+    assert positions == {"3:a": 1, "1:b": 2, "2:a": 3, "1:c": 4}
+    assert kie_queue_depth() == (4, 1)
+
+    release_kie_slot("1:a")
+    assert _admit(1, "1:b") == 2
+    assert _admit(3, "3:a") == 0
+
+
+def test_abandoned_waiters_and_expired_slots_are_dropped(memory_kv):
+    enqueue_kie_ticket(1, "1:a")
+    assert admit_kie_ticket(1, "1:a", 1, -1, STALE_MS) == 0  # its slot is already expired
+    enqueue_kie_ticket(2, "2:a")
+    enqueue_kie_ticket(3, "3:a")
+    assert admit_kie_ticket(2, "2:a", 0, SLOT_MS, -60_000) == -1  # everybody looks silent
+    assert kie_queue_depth() == (0, 0)
+
+
+def test_round_counts_only_live_tickets(memory_kv):
+    """Re-enqueued, withdrawn and admitted tickets don't push the user back a round."""
+    enqueue_kie_ticket(9, "9:x")
+    assert _admit(9, "9:x") == 0  # holds the only slot
+
+    enqueue_kie_ticket(1, "1:a")
+    enqueue_kie_ticket(1, "1:a")  # dropped as abandoned and queued again
+    leave_kie_queue(1, "1:a")
+    enqueue_kie_ticket(1, "1:b")
+    assert _admit(1, "1:b", capacity=2) == 0  # admitted: no longer waiting
+    for ticket in ("1:c", "1:d"):
+        enqueue_kie_ticket(1, ticket)
+        leave_kie_queue(1, ticket)
+
+    time.sleep(0.002)
+    enqueue_kie_ticket(1, "1:f")
+    time.sleep(0.002)
+    enqueue_kie_ticket(2, "2:a")
+    # User 1 has nothing else waiting, so 1:f is a first-round ticket and goes first
+    assert _admit(1, "1:f", capacity=0) == 1
+    assert _admit(2, "2:a", capacity=0) == 2
+
+
+@pytest.mark.asyncio
+async def test_acquire_slot_reports_position_and_times_out(memory_kv, monkeypatch):
+    monkeypatch.setattr(kie_queue, "KIE_MAX_INFLIGHT", 1)
+    monkeypatch.setattr(kie_queue, "KIE_QUEUE_TIMEOUT", 0.3)
+    monkeypatch.setattr(kie_queue, "_POLL_INITIAL", 0.01)
+    first = await kie_queue.acquire_slot(1)
+
+    positions = []
+
+    async def on_position(position):
+        positions.append(position)
+
+    with pytest.raises(kie_queue.KieQueueTimeout):
+        await kie_queue.acquire_slot(2, on_position)
+    assert positions == [1]
+    assert kie_queue_depth() == (0, 1)
+
+    waiter = asyncio.create_task(kie_queue.acquire_slot(2, on_position))
+    await asyncio.sleep(0.05)
+    kie_queue.release_slot(first)
+    assert (await waiter).startswith("2:")
@@ -0,0 +1,42 @@
+import asyncio
+import time
+
+from bot import metrics
+from bot.loop_monitor import LoopMonitor, attribute_frame
+
+
+def _blocking_stage(seconds: float) -> None:
+    time.sleep(seconds)
+
+
+async def _handler_like():
+    _blocking_stage(0.3)
+
+
+async def test_stall_is_attributed_to_blocking_function():
+    """A blocking call on the loop is counted under the innermost function of our packages."""
+    metrics.reset()
+    monitor = LoopMonitor(threshold=0.05, capture_stacks=True, packages=(__name__,))
+    monitor.start()
+    await asyncio.sleep(0.05)
+    await _handler_like()
+    await asyncio.sleep(0.1)
+    await monitor.stop()
+
+    sources = {source for source, _ in monitor.stalls}
+    assert "_blocking_stage" in sources
+    snapshot = metrics.snapshot()["counters"]
+    assert any(name.startswith("loop_stalls_total") and "_blocking_stage" in name for name in snapshot)
+
+
+async def test_no_stall_without_blocking():
+    monitor = LoopMonitor(threshold=0.2, packages=(__name__,))
+    monitor.start()
+    await asyncio.sleep(0.3)
+    await monitor.stop()
+    assert not monitor.stalls
+
+
+def test_attribute_frame_without_our_frames():
+    import sys
+    assert attribute_frame(sys._getframe(), packages=("nonexistent.",)) == ("unknown", "unknown")
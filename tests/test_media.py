@@ -0,0 +1,56 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile
+
+from bot import media
+
+PREVIEW = "fonts/fonts_preview.jpg"
+
+
+def _sent(file_id: str) -> MagicMock:
+    msg = MagicMock()
+    msg.photo = [MagicMock(file_id="small"), MagicMock(file_id=file_id)]
+    return msg
+
+
+@pytest.fixture(autouse=True)
+def _clear_registry():
+    media._file_ids.clear()
+    yield
+    media._file_ids.clear()
+
+
+@pytest.mark.asyncio
+async def test_first_send_uploads_then_reuses_file_id():
+    """The asset is uploaded once; the next send references the stored file_id."""
+    store = {}
+    bot = MagicMock()
+    bot.send_photo = AsyncMock(return_value=_sent("AgAC-preview"))
+    with patch("bot.media.get_media_file_id", side_effect=store.get), \
+         patch("bot.media.set_media_file_id", side_effect=store.__setitem__):
+        await media.send_static_photo(bot, 1, PREVIEW, caption="x")
+        media._file_ids.clear()  # simulate another instance: only Redis knows the id
+        await media.send_static_photo(bot, 2, PREVIEW, caption="x")
+
+    first, second = bot.send_photo.await_args_list
+    assert isinstance(first.kwargs["photo"], BufferedInputFile)
+    assert second.kwargs["photo"] == "AgAC-preview"
+    assert store == {media.asset_digest(PREVIEW): "AgAC-preview"}
+
+
+@pytest.mark.asyncio
+async def test_rejected_file_id_is_replaced_by_upload():
+    """A stale file_id falls back to a fresh upload and is overwritten."""
+    bot = MagicMock()
+    bot.send_photo = AsyncMock(side_effect=[
+        TelegramBadRequest(method=MagicMock(), message="wrong file identifier"),
+        _sent("AgAC-new"),
+    ])
+    with patch("bot.media.get_media_file_id", return_value="AgAC-old"), \
+         patch("bot.media.delete_media_file_id") as delete, \
+         patch("bot.media.set_media_file_id") as store:
+        await media.send_static_photo(bot, 1, PREVIEW)
+    delete.assert_called_once()
+    store.assert_called_once_with(media.asset_digest(PREVIEW), "AgAC-new")
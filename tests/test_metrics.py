@@ -0,0 +1,92 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from bot import metrics
+
+
+@pytest.fixture(autouse=True)
+def _clean_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_prometheus_histogram_is_cumulative_with_labels():
+    """Buckets are cumulative, labelled per stage, with _sum and _count."""
+    metrics.observe("postcard_stage_seconds", 0.02, stage="render")
+    metrics.observe("postcard_stage_seconds", 3.0, stage="render")
+    metrics.incr("webhook_updates_total")
+    text = metrics.render_prometheus()
+
+    assert "# TYPE pozdravish_postcard_stage_seconds histogram" in text
+    assert 'pozdravish_postcard_stage_seconds_bucket{stage="render",le="0.025"} 1' in text
+    assert 'pozdravish_postcard_stage_seconds_bucket{stage="render",le="5"} 2' in text
+    assert 'pozdravish_postcard_stage_seconds_bucket{stage="render",le="+Inf"} 2' in text
+    assert 'pozdravish_postcard_stage_seconds_count{stage="render"} 2' in text
+    assert "pozdravish_webhook_updates_total 1" in text
+
+
+def test_flush_sends_deltas_once_in_one_pipeline():
+    """A flush pushes pending deltas in one pipeline; the next flush has nothing to send."""
+    kv = MagicMock()
+    pipe = kv.client.pipeline.return_value
+    metrics.observe("postcard_stage_seconds", 0.2, stage="download")
+    with patch("bot.database.kv", kv):
+        assert metrics.flush_to_redis(force=True) is True
+        assert metrics.flush_to_redis(force=True) is False
+    pipe.exec.assert_called_once()
+    pipe.hincrby.assert_any_call('metrics:hist:postcard_stage_seconds{stage="download"}', "b5", 1)
+
+
+def test_load_from_redis_merges_instances():
+    """Aggregated hashes are decoded back into histograms and counters."""
+    kv = MagicMock()
+    kv.client.smembers.return_value = ['postcard_stage_seconds{stage="render"}']
+    kv.client.pipeline.return_value.exec.return_value = [
+        {"webhook_updates_total": "7"},
+        {"b3": "2", "b8": "1", "sum": "2.1"},
+    ]
+    with patch("bot.database.kv", kv):
+        counters, histograms = metrics.load_from_redis()
+    hist = histograms[("postcard_stage_seconds", (("stage", "render"),))]
+    assert hist.count == 3 and hist.sum == pytest.approx(2.1)
+    assert counters[("webhook_updates_total", ())] == 7
+
+
+def test_histogram_quantile_interpolates_inside_bucket():
+    hist = metrics.Histogram()
+    for _ in range(10):
+        hist.observe(0.3)  # all in the (0.25, 0.5] bucket
+    assert 0.25 < hist.quantile(0.5) <= 0.5
+    assert hist.quantile(0.99) == pytest.approx(0.4975)
+    assert metrics.Histogram().quantile(0.5) is None
+
+
+def test_flush_writes_rollup_buckets_with_ttl():
+    kv = MagicMock()
+    pipe = kv.client.pipeline.return_value
+    metrics.incr("webhook_updates_total")
+    with patch("bot.database.kv", kv), patch("bot.metrics.time.time", return_value=7200.0):
+        metrics.flush_to_redis(force=True)
+    pipe.hincrbyfloat.assert_any_call("metrics:roll:60:120", "c|webhook_updates_total", 1)
+    pipe.expire.assert_any_call("metrics:roll:3600:2", 26 * 3600)
+
+
+def test_load_windows_reads_all_buckets_in_one_pipeline():
+    """The 5 min window sums minute buckets; all windows share one round trip."""
+    kv = MagicMock()
+    pipe = kv.client.pipeline.return_value
+    bucket = {
+        "c|webhook_updates_total": "2",
+        'h|postcard_stage_seconds{stage="render"}|b5': "1",
+        'h|postcard_stage_seconds{stage="render"}|sum': "0.3",
+    }
+    pipe.exec.return_value = [bucket] * 6 + [{}] * 13
+    with patch("bot.database.kv", kv):
+        windows = metrics.load_windows([300, 3600], now=600.0)
+    pipe.exec.assert_called_once()
+    counters, histograms = windows[300]
+    assert counters[("webhook_updates_total", ())] == 12
+    assert histograms[("postcard_stage_seconds", (("stage", "render"),))].count == 6
+    assert windows[3600] == ({}, {})
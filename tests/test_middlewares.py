@@ -0,0 +1,106 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from bot.middlewares import ChatSerializationMiddleware, release_chat_lock
+
+
+def _fake_locks():
+    held: dict[str, str] = {}
+
+    def acquire(key, token, ttl_ms):
+        if key in held:
+            return False
+        held[key] = token
+        return True
+
+    def release(key, token):
+        if held.get(key) == token:
+            del held[key]
+            return True
+        return False
+
+    return patch("bot.middlewares.acquire_lock", side_effect=acquire), \
+        patch("bot.middlewares.release_lock", side_effect=release)
+
+
+def _update_data(chat_id: int):
+    event = MagicMock(inline_query=None, callback_query=None)
+    bot = MagicMock(send_message=AsyncMock())
+    return event, {"event_chat": MagicMock(id=chat_id), "event_from_user": None, "bot": bot}
+
+
+async def _run(middleware, chat_id, log, delay=0.05):
+    async def handler(event, data):
+        log.append(("start", chat_id))
+        await asyncio.sleep(delay)
+        log.append(("end", chat_id))
+
+    event, data = _update_data(chat_id)
+    await middleware(handler, event, data)
+
+
+@pytest.mark.asyncio
+async def test_same_chat_updates_do_not_overlap():
+    """A second update from the same chat waits until the first one finishes."""
+    acquire, release = _fake_locks()
+    log = []
+    with acquire, release:
+        mw = ChatSerializationMiddleware(max_wait=2)
+        await asyncio.gather(_run(mw, 1, log), _run(mw, 1, log))
+    assert log == [("start", 1), ("end", 1), ("start", 1), ("end", 1)]
+
+
+@pytest.mark.asyncio
+async def test_different_chats_run_in_parallel():
+    """Updates from different chats don't wait on each other."""
+    acquire, release = _fake_locks()
+    log = []
+    with acquire, release:
+        mw = ChatSerializationMiddleware(max_wait=2)
+        await asyncio.gather(_run(mw, 1, log), _run(mw, 2, log))
+    assert log[:2] == [("start", 1), ("start", 2)]
+
+
+@pytest.mark.asyncio
+async def test_gives_up_after_max_wait_without_processing_unlocked():
+    """A lock that can't be taken skips the update and asks the user to resend it."""
+    log = []
+    event, data = _update_data(1)
+
+    async def handler(event, data):
+        log.append("handled")
+
+    with patch("bot.middlewares.acquire_lock", return_value=False), \
+         patch("bot.middlewares.release_lock") as release:
+        mw = ChatSerializationMiddleware(max_wait=0.05)
+        await mw(handler, event, data)
+    assert log == []
+    assert "ещё раз" in data["bot"].send_message.await_args.args[1]
+    release.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_early_release_lets_the_next_update_run():
+    """A handler that releases the lock before slow work doesn't hold up the chat."""
+    acquire, release = _fake_locks()
+    log = []
+
+    async def slow_handler(event, data):
+        log.append("state written")
+        release_chat_lock()
+        await asyncio.sleep(0.1)  # ProTalk, Kie...
+        log.append("generation started")
+
+    async def next_handler(event, data):
+        log.append("next update")
+
+    with acquire, release as released:
+        mw = ChatSerializationMiddleware(max_wait=2)
+        first = asyncio.create_task(mw(slow_handler, *_update_data(1)))
+        await asyncio.sleep(0.01)
+        await mw(next_handler, *_update_data(1))
+        await first
+    assert log == ["state written", "next update", "generation started"]
+    assert released.call_count == 2  # once per update, not again when the first returns
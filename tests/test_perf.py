@@ -0,0 +1,33 @@
+from bot import metrics
+from bot.perf import format_window
+
+
+def test_format_window_reports_percentiles_and_rates():
+    hist = metrics.Histogram()
+    for value in (0.3, 0.3, 4.0):
+        hist.observe(value)
+    counters = {
+        ("protalk_requests_total", (("result", "ok"),)): 3,
+        ("protalk_requests_total", (("result", "fallback"),)): 1,
+        ("kie_tasks_total", (("outcome", "success"),)): 9,
+        ("kie_tasks_total", (("outcome", "fail"),)): 1,
+        ("webhook_updates_total", ()): 4,
+        ("redis_calls_total", ()): 10,
+        ("redis_tracked_total", (("handler", "start"),)): 2,
+        ("redis_round_trips_total", (("handler", "start"),)): 8,
+        ("redis_tracked_total", (("handler", "choose_font"),)): 2,
+        ("redis_round_trips_total", (("handler", "choose_font"),)): 2,
+    }
+    text = format_window("5 мин", counters, {("postcard_stage_seconds", (("stage", "render"),)): hist})
+
+    assert "render" in text and "n=3" in text
+    assert "ProTalk fallback: 25.0%" in text
+    assert "Kie ошибки: 10.0%" in text
+    assert "Redis-вызовов на апдейт: 2.5" in text
+    assert "Redis на вызов: start 4.0 · choose_font 1.0" in text
+
+
+def test_format_window_without_data():
+    text = format_window("1 час", {}, {})
+    assert "нет генераций" in text
+    assert "Redis-вызовов на апдейт: —" in text
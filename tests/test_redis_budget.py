@@ -0,0 +1,190 @@
+"""Redis round-trip budgets per handler.
+
+Every wizard step is fed through a real dispatcher against the in-memory
+backend, with the middlewares api/index.py installs and only the outbound
+HTTP calls stubbed, and must stay within its budget of storage round
+trips.  If a
+change adds a sequential Redis call to one of these hot paths, the test
+fails: batch it into an existing pipeline or raise the budget on purpose.
+"""
+import datetime
+import json
+from unittest.mock import patch
+
+import pytest
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Chat, Message, PhotoSize, Update
+
+from bot import redis_usage
+from bot.counters import aggregator
+from bot.database import get_pending_image_task, get_user_state, set_user_state
+from bot.handlers import DEFAULT_STATE, register_handlers
+from bot.middlewares import ChatSerializationMiddleware, install_handler_tags
+
+CHAT_ID = 555
+
+# handler -> max round trips for one update, including the chat lock's
+# SET NX and release EVAL (ChatSerializationMiddleware is on by default)
+BUDGETS = {
+    "start": 5,                  # returning user: exists check, state, credits
+    "choose_occasion": 3,
+    "choose_style": 6,           # state, preview file_id lookup (+ save after first upload)
+    "choose_font": 4,
+    "choose_text_mode": 4,
+    "text_input_and_route": 4,   # an intermediate step: state, save
+    "paid": 6,
+    "inline_query_handler": 1,   # read-only, takes no chat lock
+}
+# The last wizard step with the generation start: lock (2), state, save,
+# reset, credits/variants MGET, Kie queue enqueue and admit EVALs,
+# pending-task save
+GENERATION_BUDGET = 9
+
+
+class FakeSession(BaseSession):
+    """Answers every Bot API call locally with a minimal valid result."""
+
+    async def make_request(self, bot, method, timeout=None):
+        returning = method.__returning__
+        if returning is bool:
+            return True
+        chat_id = getattr(method, "chat_id", CHAT_ID)
+        photo = [PhotoSize(file_id="photo", file_unique_id="photo", width=1, height=1)]
+        return Message(
+            message_id=1,
+            date=datetime.datetime.now(),
+            chat=Chat(id=chat_id, type="private"),
+            photo=photo if type(method).__name__ == "SendPhoto" else None,
+        )
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class FakeHttpResponse:
+    def __init__(self, body: dict):
+        self.status = 200
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def text(self):
+        return json.dumps(self.body)
+
+    async def json(self):
+        return self.body
+
+
+class FakeHttpSession:
+    """Stands in for the ProTalk and Kie HTTP calls of ``start_generation``."""
+
+    def __init__(self, timeout=None):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def post(self, url, **kwargs):
+        if "createTask" in url:
+            return FakeHttpResponse({"data": {"taskId": "task-budget"}})
+        return FakeHttpResponse({"done": "Желаю счастья и вдохновения!"})
+
+
+@pytest.fixture
+def dispatch(memory_kv, monkeypatch):
+    """Feed updates through the handlers; returns the storage usage of each."""
+    bot = Bot(token="123456:TEST-TOKEN", session=FakeSession())
+    dp = Dispatcher()
+    register_handlers(dp, bot)
+    install_handler_tags(dp)
+    dp.update.outer_middleware(ChatSerializationMiddleware())  # as api/index.py does by default
+    # Buffered counters are flushed after the invocation, never inside these budgets
+    monkeypatch.setattr(aggregator, "flush_interval", 3600)
+    monkeypatch.setattr(aggregator, "flush_threshold", 10**6)
+    update_ids = iter(range(1, 1000))
+
+    async def feed(**event) -> redis_usage.RedisUsage:
+        update = Update(update_id=next(update_ids), **event)
+        with redis_usage.track("update") as usage:
+            await dp.feed_update(bot=bot, update=update)
+        return usage
+
+    yield feed
+    aggregator.flush()
+
+
+def _message(text: str | None = None, **extra) -> dict:
+    return {"message": {
+        "message_id": 1, "date": datetime.datetime.now(),
+        "chat": {"id": CHAT_ID, "type": "private"},
+        "from": {"id": CHAT_ID, "is_bot": False, "first_name": "Test"},
+        "text": text, **extra,
+    }}
+
+
+def _assert_within_budget(usage: redis_usage.RedisUsage, handler: str) -> None:
+    assert usage.handler == handler
+    assert usage.round_trips <= BUDGETS[handler], (
+        f"{handler} made {usage.round_trips} Redis round trips, budget is {BUDGETS[handler]}"
+    )
+
+
+@pytest.mark.asyncio
+async def test_wizard_steps_stay_within_budget(dispatch):
+    await dispatch(**_message("/start"))  # registration of a new user is a one-off
+    _assert_within_budget(await dispatch(**_message("/start")), "start")
+    _assert_within_budget(await dispatch(**_message("🎂 День рождения")), "choose_occasion")
+    _assert_within_budget(await dispatch(**_message("Акварель")), "choose_style")
+    _assert_within_budget(await dispatch(**_message("Lobster")), "choose_font")
+    _assert_within_budget(await dispatch(**_message("✨ Сгенерировать ИИ")), "choose_text_mode")
+    _assert_within_budget(await dispatch(**_message("коллеге, успехов")), "text_input_and_route")
+    # The last step runs the whole generation start: greeting, Kie queue, task creation
+    with patch("bot.services._session", FakeHttpSession), \
+         patch("bot.services.WEBHOOK_URL", "https://example.test"):
+        usage = await dispatch(**_message("Маша"))
+    assert get_pending_image_task("task-budget") is not None
+    assert usage.handler == "text_input_and_route"
+    assert usage.round_trips <= GENERATION_BUDGET, (
+        f"generation start made {usage.round_trips} Redis round trips, budget is {GENERATION_BUDGET}"
+    )
+
+
+@pytest.mark.asyncio
+async def test_paid_stays_within_budget(dispatch):
+    set_user_state(CHAT_ID, DEFAULT_STATE.copy())
+    payment = {
+        "currency": "RUB", "total_amount": 9000, "invoice_payload": f"pkg:3:{CHAT_ID}",
+        "telegram_payment_charge_id": "t", "provider_payment_charge_id": "p",
+    }
+    _assert_within_budget(await dispatch(**_message(successful_payment=payment)), "paid")
+
+
+@pytest.mark.asyncio
+async def test_inline_query_stays_within_budget(dispatch):
+    query = {"id": "q1", "from": {"id": CHAT_ID, "is_bot": False, "first_name": "Test"},
+             "query": "Маша", "offset": ""}
+    _assert_within_budget(await dispatch(inline_query=query), "inline_query_handler")
+
+
+def test_pipeline_is_one_round_trip(memory_kv):
+    from bot.database import kv
+
+    with redis_usage.track("test") as usage:
+        pipe = kv.pipeline()
+        pipe.set("a", 1)
+        pipe.incr("b")
+        pipe.exec()
+        kv.get("a")
+        get_user_state(CHAT_ID)
+    assert (usage.round_trips, usage.ops) == (3, 4)
@@ -0,0 +1,65 @@
+import io
+
+import pytest
+from PIL import Image
+
+from bot import rerender as rr
+from bot.blobs import LocalBlobCache, encoded_size, pack, unpack
+
+CONTEXT = {"chat_id": 42, "text": "Маша, с Днём Рождения!", "font": "Lobster",
+           "caption": "..., желаю счастья!", "greeting": "желаю счастья!"}
+
+
+@pytest.fixture(autouse=True)
+def empty_local_cache(monkeypatch):
+    monkeypatch.setattr(rr, "backgrounds", LocalBlobCache(10 * 1024 * 1024))
+
+
+def _noisy_png(size: int = 600) -> bytes:
+    buf = io.BytesIO()
+    Image.effect_noise((size, size), 80).convert("RGB").save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def test_pack_reencodes_oversized_blobs():
+    png = _noisy_png()
+    fits = encoded_size(len(png)) + 4096
+    assert unpack(pack(png, fits)) == png
+    assert Image.open(io.BytesIO(unpack(pack(png, len(png))))).format == "JPEG"  # the cap is on base64
+    shrunk = pack(png, len(png) // 2)
+    assert shrunk is not None and len(shrunk) <= len(png) // 2
+    assert Image.open(io.BytesIO(unpack(shrunk))).format == "JPEG"
+    assert pack(png, 100) is None
+
+
+def test_local_cache_evicts_least_recently_used():
+    cache = LocalBlobCache(max_bytes=10)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    cache.get("a")
+    cache.put("c", b"1234")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1234" and cache.get("c") == b"1234"
+    assert cache.size == 8
+
+
+@pytest.mark.asyncio
+async def test_rerender_from_store_with_new_font(memory_kv, sample_image_bytes):
+    assert rr.remember_background("t1", sample_image_bytes, CONTEXT) is True
+    rr.backgrounds = LocalBlobCache(10 * 1024 * 1024)  # another instance: read it back
+
+    card, context = await rr.rerender("t1", 42, font="Caveat")
+
+    assert Image.open(io.BytesIO(card)).size == (400, 300)
+    assert context["font"] == "Caveat" and context["text"] == CONTEXT["text"]
+    assert rr.get_rerender_context("t1")["font"] == "Caveat"
+    assert rr.backgrounds.get("t1") == sample_image_bytes
+
+
+@pytest.mark.asyncio
+async def test_rerender_rejects_other_chats_and_expired_sources(memory_kv, sample_image_bytes):
+    rr.remember_background("t1", sample_image_bytes, CONTEXT)
+    with pytest.raises(rr.RerenderUnavailable):
+        await rr.rerender("t1", 7, font="Caveat")
+    with pytest.raises(rr.RerenderUnavailable):
+        await rr.rerender("missing", 42, text="Привет")
@@ -0,0 +1,87 @@
+import asyncio
+import time
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from bot import scheduled
+from bot.database import (
+    SCHEDULED_CLAIMED_KEY,
+    claim_due_postcards,
+    count_scheduled_postcards,
+    kv,
+    save_scheduled_postcard,
+)
+from bot.scheduled import SCHEDULE_TZ, deliver_due, parse_schedule_time
+
+NOW = datetime(2026, 10, 19, 15, 30, tzinfo=SCHEDULE_TZ)
+
+
+def test_parse_schedule_time():
+    assert parse_schedule_time("31.12 00:00", NOW) == datetime(2026, 12, 31, tzinfo=SCHEDULE_TZ)
+    assert parse_schedule_time("08.03", NOW) == datetime(2027, 3, 8, tzinfo=SCHEDULE_TZ)  # next year
+    assert parse_schedule_time("19.10.2026 18:05", NOW) == datetime(2026, 10, 19, 18, 5, tzinfo=SCHEDULE_TZ)
+    for text in ("19.10.2026 10:00", "31.02 10:00", "завтра", "01.01.2030 00:00"):
+        assert parse_schedule_time(text, NOW) is None
+
+
+def _jobs(n: int, due: float) -> None:
+    for i in range(n):
+        save_scheduled_postcard({"id": f"j{i}", "chat_id": 100 + i, "file_id": f"F{i}",
+                                 "caption": "🎉", "due": due + i * 0.001, "attempts": 0})
+
+
+def test_claim_takes_due_jobs_in_order_and_recovers_expired_claims(memory_kv):
+    _jobs(3, time.time() - 10)
+    save_scheduled_postcard({"id": "later", "chat_id": 1, "file_id": "F", "caption": "",
+                             "due": time.time() + 3600, "attempts": 0})
+    assert [j["id"] for j in claim_due_postcards(2, lease_secs=-1)] == ["j0", "j1"]
+    # The lease above has already expired: the next claim returns them first
+    assert [j["id"] for j in claim_due_postcards(10, lease_secs=60)] == ["j0", "j1", "j2"]
+    assert claim_due_postcards(10, lease_secs=60) == []
+    assert count_scheduled_postcards() == 1
+
+
+@pytest.mark.asyncio
+async def test_deliver_due_sends_by_file_id_and_retries_failures(memory_kv, monkeypatch):
+    monkeypatch.setattr(scheduled, "BROADCAST_RATE_PER_SEC", 1000)
+    monkeypatch.setattr(scheduled, "SCHEDULED_BATCH_SIZE", 2)
+    _jobs(5, time.time() - 1)
+    bot = MagicMock()
+    bot.send_photo = AsyncMock(side_effect=lambda chat_id, *a, **kw: (
+        (_ for _ in ()).throw(RuntimeError("boom")) if chat_id == 104 else MagicMock()
+    ))
+
+    counts = await deliver_due(bot, time_budget=5)
+
+    assert counts == {"sent": 4, "blocked": 0, "failed": 0, "retried": 1, "unsent": 0}
+    assert {c.args[1] for c in bot.send_photo.await_args_list} == {"F0", "F1", "F2", "F3", "F4"}
+    assert count_scheduled_postcards() == 1  # j4 is due again in a minute
+    assert not kv.zcard(SCHEDULED_CLAIMED_KEY)
+    assert await deliver_due(bot, time_budget=5) == {
+        "sent": 0, "blocked": 0, "failed": 0, "retried": 0, "unsent": 0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_deliver_due_stops_at_the_budget_and_gives_unsent_jobs_back(memory_kv, monkeypatch):
+    """Sends stop when the budget is spent mid-batch; the rest go back to the due set unsent."""
+    monkeypatch.setattr(scheduled, "BROADCAST_RATE_PER_SEC", 1000)
+    monkeypatch.setattr(scheduled, "BROADCAST_CONCURRENCY", 1)
+    _jobs(10, time.time() - 1)
+    bot = MagicMock()
+
+    async def slow_send(*args, **kwargs):
+        await asyncio.sleep(0.05)
+
+    bot.send_photo = AsyncMock(side_effect=slow_send)
+    counts = await deliver_due(bot, time_budget=0.12)
+
+    assert 0 < counts["sent"] < 10
+    assert counts["sent"] + counts["unsent"] == 10
+    assert count_scheduled_postcards() == counts["unsent"]
+    assert not kv.zcard(SCHEDULED_CLAIMED_KEY)
+    # The given-back jobs are the next ones claimed
+    sent = {c.args[1] for c in bot.send_photo.await_args_list}
+    assert not sent & {j["file_id"] for j in claim_due_postcards(10, lease_secs=60)}
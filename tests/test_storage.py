@@ -0,0 +1,248 @@
+"""Conformance suite shared by all storage backends.
+
+memory and sqlite always run, and so does the RESP client against a local
+RESP server backed by the memory engine.  Real servers are used when
+configured: TEST_REDIS_URL for the RESP client, TEST_UPSTASH=1 (with the
+usual UPSTASH_REDIS_REST_* variables) for Upstash.  Use a scratch database:
+the tests write keys under the "conformance:" prefix and delete them.
+"""
+import io
+import os
+import socketserver
+import threading
+import time
+import uuid
+from unittest.mock import patch
+
+import pytest
+
+from bot import database
+from bot.storage import StorageError, create_backend
+from bot.storage.memory import MemoryBackend
+from bot.storage.resp import _Connection, encode_command
+
+
+def _encode_reply(reply) -> bytes:
+    if isinstance(reply, Exception):
+        return f"-{reply}\r\n".encode()
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, int):
+        return f":{reply}\r\n".encode()
+    if isinstance(reply, list):
+        return f"*{len(reply)}\r\n".encode() + b"".join(_encode_reply(r) for r in reply)
+    data = str(reply).encode()
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+class _RespHandler(socketserver.StreamRequestHandler):
+    """Speaks RESP to the client and executes commands on an in-memory engine."""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                command.append(self.rfile.read(length + 2)[:-2].decode())
+            try:
+                reply = self.server.engine._run(command)
+            except StorageError as e:
+                reply = e
+            self.wfile.write(_encode_reply(reply))
+
+
+@pytest.fixture(scope="module")
+def resp_server():
+    """A local RESP server so the TCP client runs the suite without a real Redis."""
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _RespHandler)
+    server.daemon_threads = True
+    server.engine = MemoryBackend()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"redis://127.0.0.1:{server.server_address[1]}/0"
+    server.shutdown()
+
+
+def _backend_params():
+    params = ["memory", "sqlite", "resp-local"]
+    params.append(pytest.param("redis", marks=pytest.mark.skipif(
+        not os.getenv("TEST_REDIS_URL"), reason="TEST_REDIS_URL not set")))
+    params.append(pytest.param("upstash", marks=pytest.mark.skipif(
+        os.getenv("TEST_UPSTASH") != "1", reason="TEST_UPSTASH not set")))
+    return params
+
+
+@pytest.fixture(params=_backend_params())
+def store(request, tmp_path):
+    name = request.param
+    if name == "sqlite":
+        with patch("bot.config.SQLITE_PATH", str(tmp_path / "kv.db")):
+            backend = create_backend("sqlite")
+    elif name in ("redis", "resp-local"):
+        url = os.environ["TEST_REDIS_URL"] if name == "redis" else request.getfixturevalue("resp_server")
+        with patch("bot.config.REDIS_URL", url):
+            backend = create_backend("redis")
+    else:
+        backend = create_backend(name)
+    yield backend
+
+
+@pytest.fixture
+def key():
+    """A unique key prefix per test, so runs on a shared server don't collide."""
+    return f"conformance:{uuid.uuid4().hex}"
+
+
+def test_strings(store, key):
+    assert store.get(key) is None
+    assert store.set(key, "v") is True
+    assert store.get(key) == "v"
+    assert store.set(key, "other", nx=True) is False
+    assert store.get(key) == "v"
+    assert store.set(f"{key}:n", 1) is True
+    assert store.get(f"{key}:n") == "1"  # values come back as strings
+    assert store.mget(key, f"{key}:missing") == ["v", None]
+    assert store.getdel(key) == "v"
+    assert store.get(key) is None
+    assert store.delete(f"{key}:n", f"{key}:missing") == 1
+
+
+def test_counters(store, key):
+    assert store.incr(key) == 1
+    assert store.incrby(key, 5) == 6
+    assert store.decrby(key, 2) == 4
+    store.set(f"{key}:s", "abc")
+    with pytest.raises(Exception):
+        store.incr(f"{key}:s")
+    store.delete(key, f"{key}:s")
+
+
+def test_expiry(store, key):
+    assert store.set(key, "v", px=50) is True
+    assert store.ttl(key) in (0, 1)
+    time.sleep(0.1)
+    assert store.get(key) is None
+    assert store.setex(key, 100, "v") is True
+    assert 0 < store.ttl(key) <= 100
+    assert store.expire(key, 200) is True
+    assert store.expire(f"{key}:missing", 10) is False
+    assert store.ttl(f"{key}:missing") == -2
+    store.set(key, "again")
+    assert store.ttl(key) == -1  # SET without EX clears the TTL
+    store.delete(key)
+
+
+def test_sets_and_scan(store, key):
+    assert store.sadd(key, 1, 2, 3) == 3
+    assert store.sadd(key, 3) == 0
+    assert store.sismember(key, 2) is True
+    assert store.sismember(key, 9) is False
+    assert store.scard(key) == 3
+    seen, cursor = [], 0
+    while True:
+        cursor, members = store.sscan(key, cursor, count=2)
+        seen += members
+        if cursor == 0:
+            break
+    assert sorted(seen) == ["1", "2", "3"]
+    assert store.srem(key, 1, 9) == 1
+    assert sorted(store.smembers(key)) == ["2", "3"]
+    store.delete(key)
+
+
+def test_hashes(store, key):
+    assert store.hincrby(key, "a", 2) == 2
+    assert store.hincrby(key, "a", 3) == 5
+    assert store.hincrbyfloat(key, "sum", 0.5) == pytest.approx(0.5)
+    assert store.hincrbyfloat(key, "sum", 1.25) == pytest.approx(1.75)
+    assert store.hgetall(key) == {"a": "5", "sum": "1.75"}
+    assert store.hgetall(f"{key}:missing") == {}
+    store.delete(key)
+
+
+def test_wrong_type(store, key):
+    store.set(key, "v")
+    with pytest.raises(Exception, match="WRONGTYPE"):
+        store.sadd(key, "m")
+    store.delete(key)
+
+
+def test_hyperloglog(store, key):
+    assert store.pfadd(f"{key}:a", 1, 2, 3) is True
+    assert store.pfadd(f"{key}:b", 3, 4) is True
+    assert store.pfcount(f"{key}:a") == 3
+    assert store.pfcount(f"{key}:a", f"{key}:b") == 4
+    store.delete(f"{key}:a", f"{key}:b")
+
+
+def test_sorted_sets(store, key):
+    assert store.zadd(key, {"a": 3, "b": 1, "c": 2}) == 3
+    assert store.zadd(key, {"a": 10}, nx=True) == 0
+    assert store.zrangebyscore(key, "-inf", 2) == ["b", "c"]
+    assert store.zrangebyscore(key, "(1", "+inf", withscores=True) == [("c", 2.0), ("a", 3.0)]
+    assert store.zrangebyscore(key, "-inf", "+inf", offset=0, count=1) == ["b"]
+    assert store.zscore(key, "a") == 3.0
+    assert store.zrem(key, "a", "zz") == 1
+    assert store.zcard(key) == 2
+    store.delete(key)
+
+
+def test_pipeline_returns_cast_results(store, key):
+    pipe = store.pipeline()
+    pipe.set(key, "v", ex=60)
+    pipe.get(key)
+    pipe.hincrby(f"{key}:h", "f", 1)
+    pipe.hgetall(f"{key}:h")
+    pipe.sismember(f"{key}:s", "x")
+    assert pipe.exec() == [True, "v", 1, {"f": "1"}, False]
+    store.delete(key, f"{key}:h")
+
+
+def test_lua_scripts_match_fallbacks(store, key):
+    """The database's Lua scripts behave the same natively and via Python fallbacks."""
+    with patch.object(database, "kv", store):
+        assert database.acquire_lock(f"{key}:lock", "me", 10_000) is True
+        assert database.acquire_lock(f"{key}:lock", "you", 10_000) is False
+        assert database.release_lock(f"{key}:lock", "you") is False
+        assert database.release_lock(f"{key}:lock", "me") is True
+
+        with patch.object(database, "pending_image_key", lambda t: f"{key}:task:{t}"), \
+             patch.object(database, "image_task_done_key", lambda t: f"{key}:task:{t}:done"), \
+             patch.object(database, "image_task_lease_key", lambda t: f"{key}:task:{t}:lease"):
+            assert database.claim_pending_image_task("t", "a") == ("missing", None)
+            store.set(f"{key}:task:t", '{"chat_id": 1}')
+            assert database.claim_pending_image_task("t", "a") == ("claimed", {"chat_id": 1})
+            assert database.claim_pending_image_task("t", "b") == ("busy", None)
+            store.set(f"{key}:task:t:done", 1)
+            assert database.claim_pending_image_task("t", "b") == ("done", None)
+            store.delete(f"{key}:task:t", f"{key}:task:t:done", f"{key}:task:t:lease")
+
+
+def test_sqlite_persists_between_connections(tmp_path):
+    with patch("bot.config.SQLITE_PATH", str(tmp_path / "kv.db")):
+        first = create_backend("sqlite")
+        first.hincrby("h", "f", 2)
+        second = create_backend("sqlite")
+    assert second.hgetall("h") == {"f": "2"}
+
+
+def test_embedded_backends_reject_streams():
+    with pytest.raises(StorageError, match="not supported"):
+        create_backend("memory").execute(["XLEN", "jobs"])
+
+
+def test_resp_encoding_and_parsing():
+    assert encode_command(["SET", "k", 1]) == b"*3\r\n$3\r\nSET\r\n$1\r\nk\r\n$1\r\n1\r\n"
+    conn = _Connection.__new__(_Connection)
+    conn.reader = io.BytesIO(b"*3\r\n+OK\r\n:5\r\n$-1\r\n-ERR boom\r\n$3\r\nabc\r\n")
+    assert conn.read_reply() == ["OK", 5, None]
+    error = conn.read_reply()
+    assert isinstance(error, StorageError) and "boom" in str(error)
+    assert conn.read_reply() == "abc"
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        create_backend("cassandra")
@@ -0,0 +1,177 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from bot import variants
+from bot.database import (
+    create_variant_set,
+    get_credits,
+    get_variant_cards,
+    get_variant_progress,
+    record_variant_result,
+    save_pending_image_task,
+)
+from bot.services import process_kie_callback
+
+PAYLOAD = {"occasion": "🎂 День рождения", "style": "Акварель", "font": "Lobster",
+           "text_mode": "ai", "text_input": "коллеге", "addressee": "Маша", "variants": 3}
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(variants, "_POLL_INITIAL", 0.01)
+    monkeypatch.setattr(variants, "_POLL_MAX", 0.02)
+
+
+def _variant_set(set_id: str, deadline_in: float) -> None:
+    create_variant_set(set_id, {"chat_id": 42, "expected": 3, "deadline": time.time() + deadline_in}, 60)
+    for i in range(3):
+        save_pending_image_task(f"v{i}", {
+            "chat_id": 42, "message_id": 7, "payload": PAYLOAD,
+            "caption_for_db": "желаю счастья!", "variant_set": set_id,
+        }, ttl=60)
+
+
+def _bot() -> MagicMock:
+    bot = MagicMock()
+    bot.delete_message = AsyncMock()
+    bot.send_message = AsyncMock()
+    bot.edit_message_text = AsyncMock()
+    photo = MagicMock()
+    photo.photo = [MagicMock(file_id="AgAC-variant")]
+    bot.send_photo = AsyncMock(return_value=photo)
+    bot.send_media_group = AsyncMock(side_effect=lambda chat_id, media: [photo] * len(media))
+    return bot
+
+
+@pytest.mark.asyncio
+async def test_collector_waits_for_all_variants_and_sends_one_album(memory_kv, sample_image_bytes):
+    """Two successes and a failure: one album of two, pick buttons, one credit."""
+    _variant_set("s1", deadline_in=5)
+    bot = _bot()
+    with patch("bot.services.download_image", AsyncMock(return_value=sample_image_bytes)), \
+         patch("bot.rerender.remember_background") as remember:
+        results = await asyncio.gather(
+            process_kie_callback("v0", "success", {"resultUrls": ["u0"]}, None, bot),
+            process_kie_callback("v1", "fail", {}, "nsfw", bot),
+            process_kie_callback("v2", "success", {"resultUrls": ["u2"]}, None, bot),
+        )
+
+    assert all(results)
+    media = bot.send_media_group.await_args.kwargs["media"]
+    assert [m.caption for m in media] == ["Вариант 1", "Вариант 2"]
+    buttons = bot.send_message.await_args.kwargs["reply_markup"].inline_keyboard[0]
+    assert [b.callback_data for b in buttons] == ["vp:s1:0", "vp:s1:1"]
+    assert get_credits(42) == 2  # FREE_CREDITS - 1, once per set
+    assert [c["task_id"] for c in get_variant_cards("s1")["cards"]] == ["v0", "v2"]
+    assert remember.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_deadline_delivers_whatever_arrived(memory_kv, sample_image_bytes):
+    """Only one variant reported before the deadline: it is sent alone."""
+    _variant_set("s2", deadline_in=0.05)
+    bot = _bot()
+    with patch("bot.services.download_image", AsyncMock(return_value=sample_image_bytes)), \
+         patch("bot.rerender.remember_background"):
+        assert await process_kie_callback("v0", "success", {"resultUrls": ["u0"]}, None, bot) is True
+        # A straggler after delivery is recorded but sends nothing
+        assert await process_kie_callback("v1", "success", {"resultUrls": ["u1"]}, None, bot) is True
+
+    bot.send_media_group.assert_not_called()
+    assert bot.send_photo.await_count == 1
+    assert "1 из 3" in bot.send_message.await_args.args[1]
+
+
+@pytest.mark.asyncio
+async def test_set_with_a_failed_creation_is_still_delivered(memory_kv, sample_image_bytes):
+    """A variant lost at creation is counted, and the real callbacks still deliver the set."""
+    created = iter(["v0", RuntimeError("429 Too Many Requests"), "v2"])
+
+    async def create(**kwargs):
+        result = next(created)
+        if isinstance(result, Exception):
+            raise result
+        save_pending_image_task(result, {
+            "chat_id": 42, "message_id": 7, "payload": PAYLOAD,
+            "caption_for_db": "желаю счастья!", **kwargs["extra"],
+        }, ttl=60)
+        return result
+
+    with patch("bot.services.create_image_task_async", create):
+        task_ids = await variants.start_variants(3, "prompt", 42, 7, PAYLOAD, "желаю счастья!")
+    assert task_ids == ["v0", "v2"]
+
+    bot = _bot()
+    with patch("bot.services.download_image", AsyncMock(return_value=sample_image_bytes)), \
+         patch("bot.rerender.remember_background"):
+        results = await asyncio.gather(
+            process_kie_callback("v0", "success", {"resultUrls": ["u0"]}, None, bot),
+            process_kie_callback("v2", "success", {"resultUrls": ["u2"]}, None, bot),
+        )
+
+    assert all(results)
+    assert len(bot.send_media_group.await_args.kwargs["media"]) == 2
+    assert "2 из 3" in bot.send_message.await_args.args[1]
+
+
+@pytest.mark.asyncio
+async def test_failed_collector_reports_the_error_and_a_redelivery_delivers(memory_kv, sample_image_bytes):
+    """The collector's send fails: the user is told, and the redelivered callback delivers the set."""
+    _variant_set("s4", deadline_in=0.05)
+    bot = _bot()
+    bot.send_photo.side_effect = [RuntimeError("Telegram is down"), bot.send_photo.return_value]
+    with patch("bot.services.download_image", AsyncMock(return_value=sample_image_bytes)), \
+         patch("bot.rerender.remember_background"):
+        assert await process_kie_callback("v0", "success", {"resultUrls": ["u0"]}, None, bot) is False
+        assert "Ошибка" in bot.edit_message_text.await_args.args[0]
+        assert get_credits(42) == 3
+
+        assert await process_kie_callback("v0", "success", {"resultUrls": ["u0"]}, None, bot) is True
+
+    assert bot.send_photo.await_count == 2
+    assert get_variant_cards("s4")["cards"][0]["task_id"] == "v0"
+    assert get_credits(42) == 2
+
+
+@pytest.mark.asyncio
+async def test_later_variant_takes_over_when_the_collector_lease_lapses(memory_kv, sample_image_bytes, monkeypatch):
+    """A collector that died silently is replaced by the next callback once its lease expires."""
+    monkeypatch.setattr(variants, "_COLLECTOR_LEASE", 1)
+    _variant_set("s5", deadline_in=0.05)
+    # v0 became the collector, then its invocation was killed
+    _, _, is_collector = record_variant_result("s5", "v0", "u0", 60, 1)
+    assert is_collector
+    time.sleep(1.1)
+
+    bot = _bot()
+    with patch("bot.services.download_image", AsyncMock(return_value=sample_image_bytes)), \
+         patch("bot.rerender.remember_background"):
+        assert await process_kie_callback("v1", "success", {"resultUrls": ["u1"]}, None, bot) is True
+        # Once delivered, a straggler doesn't collect again
+        assert await process_kie_callback("v2", "success", {"resultUrls": ["u2"]}, None, bot) is True
+
+    assert bot.send_media_group.await_count == 1
+    assert [c["task_id"] for c in get_variant_cards("s5")["cards"]] == ["v0", "v1"]
+    assert get_credits(42) == 2
+
+
+
+@pytest.mark.asyncio
+async def test_deadline_runs_from_the_end_of_the_creations(memory_kv, monkeypatch):
+    """A slow Kie queue doesn't eat the variants' wait: the deadline is stamped after creation."""
+    monkeypatch.setattr(variants, "VARIANTS_DEADLINE", 0.2)
+    set_ids = []
+
+    async def create(**kwargs):
+        set_ids.append(kwargs["extra"]["variant_set"])
+        await asyncio.sleep(0.3)  # waited in the Kie queue longer than the whole deadline
+        return f"q{len(set_ids)}"
+
+    with patch("bot.services.create_image_task_async", create):
+        await variants.start_variants(2, "prompt", 42, 7, PAYLOAD, "желаю счастья!")
+
+    meta, _ = get_variant_progress(set_ids[0])
+    assert meta["deadline"] > time.time() + 0.1
@@ -0,0 +1,23 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from bot import render
+from bot.config import FONTS_FILES
+from bot.warmup import warm_up
+
+
+@pytest.mark.asyncio
+async def test_warm_up_reports_every_phase_and_fills_font_cache():
+    """All phases are timed, fonts end up cached and failures are reported, not raised."""
+    render._font_data.cache_clear()
+    bot = MagicMock()
+    bot.get_me = AsyncMock()
+    with patch("bot.warmup._warm_redis"), \
+         patch("bot.warmup._warm_http", AsyncMock(side_effect=OSError("offline"))):
+        report = await warm_up(bot)
+
+    assert set(report["phases"]) == {"fonts", "render", "redis", "http", "telegram"}
+    assert list(report["errors"]) == ["http"]
+    assert render._font_data.cache_info().currsize >= len(FONTS_FILES)
+    bot.get_me.assert_awaited_once()
@@ -0,0 +1,75 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from fastapi import BackgroundTasks
+
+import api.index as index
+
+UPDATE = {
+    "update_id": 1001,
+    "message": {
+        "message_id": 1,
+        "date": 1700000000,
+        "chat": {"id": 42, "type": "private"},
+        "text": "hi",
+    },
+}
+
+
+def _request(body: dict) -> MagicMock:
+    request = MagicMock()
+    request.json = AsyncMock(return_value=body)
+    return request
+
+
+@pytest.mark.asyncio
+async def test_ack_first_schedules_processing_in_background():
+    """In ack-first mode a new update is acknowledged and queued, not processed inline."""
+    tasks = BackgroundTasks()
+    with patch.object(index, "WEBHOOK_ACK_FIRST", True), \
+         patch.object(index, "claim_update", return_value=True) as claim, \
+         patch.object(index, "finish_update") as finish, \
+         patch.object(index.dp, "feed_update", AsyncMock()) as feed:
+        result = await index.telegram_webhook(_request(UPDATE), tasks, None)
+        assert result == {"status": "ok"}
+        feed.assert_not_called()
+        finish.assert_not_called()  # only the short processing claim so far
+        assert claim.call_args.args == (1001, index.UPDATE_CLAIM_TTL)
+        assert len(tasks.tasks) == 1
+        await tasks()
+        feed.assert_awaited_once()
+    finish.assert_called_once_with(1001, index.UPDATE_DEDUP_TTL)
+
+
+@pytest.mark.asyncio
+async def test_ack_first_drops_duplicate_update():
+    """A redelivered update_id is acknowledged without being processed again."""
+    tasks = BackgroundTasks()
+    with patch.object(index, "WEBHOOK_ACK_FIRST", True), \
+         patch.object(index, "claim_update", return_value=False):
+        result = await index.telegram_webhook(_request(UPDATE), tasks, None)
+    assert result == {"status": "ok"}
+    assert tasks.tasks == []
+
+
+@pytest.mark.asyncio
+async def test_default_mode_processes_inline():
+    """Without ack-first the update is fed to the dispatcher before returning."""
+    tasks = BackgroundTasks()
+    with patch.object(index, "WEBHOOK_ACK_FIRST", False), \
+         patch.object(index.dp, "feed_update", AsyncMock()) as feed:
+        await index.telegram_webhook(_request(UPDATE), tasks, None)
+    feed.assert_awaited_once()
+    assert tasks.tasks == []
+
+
+@pytest.mark.asyncio
+async def test_kie_callback_flushes_even_when_processing_raises():
+    """Counters buffered during a failed callback are still written."""
+    body = {"code": 200, "data": {"taskId": "t1", "state": "success", "resultJson": "{}"}}
+    with patch.object(index, "GENERATION_QUEUE", False), \
+         patch("bot.services.process_kie_callback", AsyncMock(side_effect=RuntimeError("boom"))), \
+         patch.object(index, "_flush_after_invocation") as flush:
+        result = await index.kie_callback(_request(body))
+    assert result["status"] == "error"
+    flush.assert_called_once()